@@ -0,0 +1,76 @@
+"""
+Compares two reports of `benchmarks.suite` and fails on regressions:
+
+    python -m benchmarks.compare base.json head.json --threshold 0.1
+"""
+import argparse
+import json
+import sys
+
+from typing import Any
+
+
+HIGHER_IS_BETTER = (
+    "generate_rows_per_second",
+    "insert_rows_per_second",
+)
+LOWER_IS_BETTER = (
+    "tvl_seconds",
+    "get_current_price_p50_ms",
+    "get_current_price_p95_ms",
+)
+
+
+def _cells(report: dict[str, Any]) -> dict[tuple[int, int], dict]:
+    return {
+        (result["accounts"], result["days"]): result
+        for result in report["results"]
+    }
+
+
+def compare(
+    base: dict[str, Any],
+    head: dict[str, Any],
+    threshold: float,
+) -> list[str]:
+    regressions = []
+    base_cells = _cells(base)
+    for cell, head_result in sorted(_cells(head).items()):
+        base_result = base_cells.get(cell)
+        if base_result is None:
+            continue
+
+        for metric in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+            change = head_result[metric] / base_result[metric] - 1
+            line = (
+                f"accounts={cell[0]} days={cell[1]} {metric}: "
+                f"{base_result[metric]:.3f} -> {head_result[metric]:.3f} "
+                f"({change:+.1%})"
+            )
+            print(line)
+
+            if metric in HIGHER_IS_BETTER:
+                change = -change
+            if change > threshold:
+                regressions.append(line)
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("base", type=str)
+    parser.add_argument("head", type=str)
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    with open(args.base) as base, open(args.head) as head:
+        regressions = compare(json.load(base), json.load(head), args.threshold)
+
+    if regressions:
+        print("\nregressions:\n" + "\n".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
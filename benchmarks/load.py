@@ -0,0 +1,291 @@
+"""
+Load test of the read path: concurrent clients reading deposits and TVL.
+
+Runs against the database configured in `.env`. Every client takes a
+session from the connection pool per request, so waiting for a connection
+is a part of the latency. Writers run `generate_protocol_data` in separate
+processes until the clients are done:
+
+    python -m benchmarks.load --clients 50 --duration 30 \
+        --reads current,history --writers 2 --output load.json
+"""
+import argparse
+import asyncio
+import datetime as dt
+import json
+import platform
+import random
+import sys
+import time
+
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+
+from core.cache import AsyncTTLCache
+from core.config import settings
+from core.db import close_db
+from core.db import get_session
+from core.db import init_db
+from core.db.repo import TVLHistoryRepo
+from core.service import ProtocolPriceService
+from core.shell.model import GetCurrentDepositCommandOptions
+
+from .suite import _git_commit
+from .suite import _int_list
+from .suite import _percentile
+
+READS = ("current", "history", "at")
+
+
+def _str_list(value: str) -> list[str]:
+    items = value.split(",")
+    unknown = set(items) - set(READS)
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown reads: {sorted(unknown)}")
+    return items
+
+
+class LoadTest:
+    """
+    Runs `clients` concurrent loops of random reads of random protocols
+    until `duration` seconds pass or `requests` requests are sent, keeping
+    latencies per read. Prices are read through a cache only with `cache`,
+    otherwise every request is a query of its own, without the merging of
+    concurrent loads of the cache.
+    """
+
+    def __init__(
+        self,
+        protocol_ids: list[int],
+        reads: list[str],
+        clients: int,
+        duration: float | None,
+        requests: int | None,
+        cache: bool,
+        seed: int | None = None,
+    ):
+        self.protocol_ids = protocol_ids
+        self.reads = reads
+        self.clients = clients
+        self.duration = duration
+        self.requests = requests
+        self.cache = AsyncTTLCache(
+            name="load_protocol_price",
+            maxsize=settings.price_cache_size,
+            ttl=settings.price_cache_ttl,
+        ) if cache else None
+        self.random = random.Random(seed)
+        self.latencies: dict[str, list[float]] = {read: [] for read in READS}
+        self.errors: dict[str, int] = {read: 0 for read in READS}
+        self.sent = 0
+        self.seconds = 0.0
+
+    async def run(self):
+        started_at = time.perf_counter()
+        deadline = None if self.duration is None else (
+            started_at + self.duration
+        )
+        await asyncio.gather(*(
+            self._client(deadline) for _ in range(self.clients)
+        ))
+        self.seconds = time.perf_counter() - started_at
+
+    async def _client(self, deadline: float | None):
+        while True:
+            if deadline is not None and time.perf_counter() >= deadline:
+                return
+            if self.requests is not None and self.sent >= self.requests:
+                return
+            self.sent += 1
+
+            read = self.random.choice(self.reads)
+            protocol_id = self.random.choice(self.protocol_ids)
+            started_at = time.perf_counter()
+            try:
+                async with get_session() as session:
+                    await self._read(read, protocol_id)(
+                        TVLHistoryRepo(session)
+                    )
+            except Exception:
+                self.errors[read] += 1
+            else:
+                self.latencies[read].append(
+                    time.perf_counter() - started_at
+                )
+
+    def _read(
+        self,
+        read: str,
+        protocol_id: int,
+    ) -> Callable[[TVLHistoryRepo], Awaitable[Any]]:
+        if read == "current" and self.cache is None:
+            return lambda repo: repo.get_current_protocol_price(protocol_id)
+        if read == "current":
+            return lambda repo: ProtocolPriceService(
+                repo,
+                cache=self.cache,
+            ).get_protocol_price(
+                GetCurrentDepositCommandOptions(protocol=protocol_id)
+            )
+        if read == "history":
+            end = dt.datetime.now(dt.timezone.utc)
+            return lambda repo: repo.get_history(
+                protocol_id=protocol_id,
+                resolution="day",
+                start=end - dt.timedelta(days=30),
+                end=end,
+            )
+        at = dt.datetime.now(dt.timezone.utc) - dt.timedelta(
+            hours=self.random.randint(0, 24 * 7)
+        )
+        return lambda repo: repo.get_protocol_price_at(protocol_id, at=at)
+
+    def report(self) -> dict[str, Any]:
+        def summary(latencies: list[float], errors: int) -> dict[str, Any]:
+            result = {
+                "requests": len(latencies) + errors,
+                "errors": errors,
+                "requests_per_second": len(latencies) / self.seconds,
+            }
+            if len(latencies) >= 2:
+                for percent in (50, 95, 99):
+                    result[f"p{percent}_ms"] = (
+                        _percentile(latencies, percent) * 1000
+                    )
+            return result
+
+        return {
+            "clients": self.clients,
+            "seconds": self.seconds,
+            "total": summary(
+                [
+                    latency
+                    for read in self.reads
+                    for latency in self.latencies[read]
+                ],
+                sum(self.errors[read] for read in self.reads),
+            ),
+            "reads": {
+                read: summary(self.latencies[read], self.errors[read])
+                for read in dict.fromkeys(self.reads)
+            },
+        }
+
+
+async def _writer(arguments: list[str], stop: asyncio.Event) -> int:
+    """
+    Generates protocols one after another until `stop` is set, then
+    terminates the running generation, so writers end with the clients.
+    """
+    protocols = 0
+    stopped = asyncio.create_task(stop.wait())
+    try:
+        while not stop.is_set():
+            process = await asyncio.create_subprocess_exec(
+                sys.executable,
+                "-m",
+                "core.main",
+                "generate_protocol_data",
+                *arguments,
+                stdout=asyncio.subprocess.DEVNULL,
+            )
+            finished = asyncio.create_task(process.wait())
+            await asyncio.wait(
+                {stopped, finished},
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not finished.done():
+                process.terminate()
+                await finished
+            elif finished.result() == 0:
+                protocols += 1
+    finally:
+        stopped.cancel()
+    return protocols
+
+
+async def _get_protocol_ids(limit: int) -> list[int]:
+    async with get_session() as session:
+        protocols = await TVLHistoryRepo(session).get_top_protocols(limit)
+    return [protocol.protocol_id for protocol in protocols]
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    await init_db()
+    try:
+        protocol_ids = args.protocols or await _get_protocol_ids(1000)
+        if not protocol_ids:
+            raise SystemExit("there are no protocols with TVL to read")
+
+        load_test = LoadTest(
+            protocol_ids=protocol_ids,
+            reads=args.reads,
+            clients=args.clients,
+            duration=args.duration,
+            requests=args.requests,
+            cache=args.cache,
+            seed=args.seed,
+        )
+        stop = asyncio.Event()
+        writers = [
+            asyncio.create_task(_writer(
+                [
+                    "--accounts", str(args.write_accounts),
+                    "--start", (
+                        dt.datetime.now(dt.timezone.utc)
+                        - dt.timedelta(days=args.write_days)
+                    ).isoformat(),
+                ],
+                stop,
+            ))
+            for _ in range(args.writers)
+        ]
+        try:
+            await load_test.run()
+        finally:
+            stop.set()
+            written = await asyncio.gather(*writers)
+    finally:
+        await close_db()
+
+    return {
+        "commit": _git_commit(),
+        "created_at": dt.datetime.now(dt.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "pg_pool_size": settings.pg_pool_size,
+        "pg_max_overflow": settings.pg_max_overflow,
+        "writers": args.writers,
+        "written_protocols": sum(written),
+        **load_test.report(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=None)
+    parser.add_argument("--requests", type=int, default=None)
+    parser.add_argument("--reads", type=_str_list, default=["current"])
+    parser.add_argument("--protocols", type=_int_list, default=None)
+    parser.add_argument("--cache", action="store_true")
+    parser.add_argument("--writers", type=int, default=0)
+    parser.add_argument("--write-accounts", type=int, default=1_000)
+    parser.add_argument("--write-days", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+    if args.duration is None and args.requests is None:
+        args.duration = 10.0
+    if args.clients < 1:
+        parser.error("--clients must be at least 1")
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Benchmark of CLI startup: wall time of one-shot commands.
+
+Every command is run `--runs` times as a new process, the way a script
+would call it. `import` only measures importing the shell:
+
+    python -m benchmarks.startup --runs 20 \
+        --command "get_current_deposit --protocol 1" --output startup.json
+"""
+import argparse
+import datetime as dt
+import json
+import platform
+import shlex
+import subprocess
+import sys
+import time
+
+from typing import Any
+
+from .suite import _git_commit
+from .suite import _percentile
+
+IMPORT_COMMAND = "import"
+
+
+def _run_command(command: str) -> float:
+    if command == IMPORT_COMMAND:
+        argv = [sys.executable, "-c", "import core.shell"]
+    else:
+        argv = [sys.executable, "-m", "core.main", *shlex.split(command)]
+
+    started_at = time.perf_counter()
+    subprocess.run(argv, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - started_at
+
+
+def benchmark_command(command: str, runs: int) -> dict[str, Any]:
+    # the first run warms up the file system cache and bytecode
+    _run_command(command)
+    seconds = [_run_command(command) for _ in range(runs)]
+    return {
+        "command": command,
+        "runs": runs,
+        "p50_ms": _percentile(seconds, 50) * 1000,
+        "p95_ms": _percentile(seconds, 95) * 1000,
+        "max_ms": max(seconds) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument(
+        "--command",
+        action="append",
+        default=None,
+        help=f"command to run, `{IMPORT_COMMAND}` only imports the shell",
+    )
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+    if args.runs < 2:
+        parser.error("--runs must be at least 2")
+
+    results = []
+    for command in args.command or [IMPORT_COMMAND]:
+        result = benchmark_command(command, args.runs)
+        print(json.dumps(result))
+        results.append(result)
+
+    report = {
+        "commit": _git_commit(),
+        "created_at": dt.datetime.now(dt.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
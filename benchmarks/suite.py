@@ -0,0 +1,193 @@
+"""
+Benchmarks of protocol data generation, loading and TVL reads.
+
+Runs against the database configured in `.env` (see `make postgres`) and
+writes one JSON document with a result per (accounts, days) cell:
+
+    python -m benchmarks.suite --accounts 100,1000 --days 1,5 \
+        --output bench.json
+"""
+import argparse
+import asyncio
+import datetime as dt
+import json
+import platform
+import statistics
+import subprocess
+import time
+
+from typing import Any
+
+from core.db import close_db
+from core.db import get_session
+from core.db import init_db
+from core.db.repo import BaseRepo
+from core.db.repo import BulkRepo
+from core.db.repo import PartitionRepo
+from core.db.repo import ProtocolTokenRepo
+from core.db.repo import TVLHistoryRepo
+from core.service import DatabaseSink
+from core.service import ProtocolDataGeneratorService
+from core.service.engine import final_block_number
+
+
+def _int_list(value: str) -> list[int]:
+    return [int(item) for item in value.split(",")]
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _percentile(values: list[float], percent: int) -> float:
+    return statistics.quantiles(values, n=100, method="inclusive")[
+        percent - 1
+    ]
+
+
+async def benchmark_cell(
+    accounts: int,
+    days: int,
+    chunk: int,
+    reads: int,
+    explain: bool,
+) -> dict[str, Any]:
+    end = dt.datetime.now(dt.timezone.utc)
+    start = end - dt.timedelta(days=days)
+
+    async with get_session() as session:
+        tvl_history_repo = TVLHistoryRepo(session)
+        sink = DatabaseSink(
+            base_repo=BaseRepo(session),
+            bulk_repo=BulkRepo(session),
+            protocol_token_repo=ProtocolTokenRepo(session),
+            tvl_history_repo=tvl_history_repo,
+            partition_repo=PartitionRepo(session),
+        )
+        service = ProtocolDataGeneratorService(sink=sink)
+
+        await sink.open(start=start, end=end)
+        protocol = await service.generate_protocol_with_tokens()
+        await sink.write_protocol(protocol)
+        account_ids = await service.generate_and_write_accounts(
+            accounts_number=accounts,
+            chunk_size=chunk,
+        )
+
+        def frames():
+            return service.generate_balance_history_and_token_price(
+                protocol=protocol,
+                account_ids=account_ids,
+                start=start,
+                end=end,
+                deposit=2_000_000,
+                chunk_size=chunk,
+            )
+
+        # pass 1: generation only, frames are dropped right away
+        generated_rows = 0
+        started_at = time.perf_counter()
+        async for frame in frames():
+            generated_rows += len(frame)
+        generate_seconds = time.perf_counter() - started_at
+
+        # pass 2: only time spent in COPY and commit is measured
+        insert_seconds = 0.0
+        async for frame in frames():
+            started_at = time.perf_counter()
+            await service._write_frame(frame)
+            insert_seconds += time.perf_counter() - started_at
+        started_at = time.perf_counter()
+        await sink.base_repo.commit()
+        insert_seconds += time.perf_counter() - started_at
+
+        tvl_plan = None
+        if explain:
+            tvl_plan = await tvl_history_repo.explain_calculate_history(
+                protocol_id=protocol.id,
+            )
+
+        started_at = time.perf_counter()
+        tvl_rows = await tvl_history_repo.calculate_history_by_protocol_id(
+            protocol_id=protocol.id,
+        )
+        await sink.base_repo.commit()
+        tvl_seconds = time.perf_counter() - started_at
+
+        read_latencies = []
+        for _ in range(reads):
+            started_at = time.perf_counter()
+            await tvl_history_repo.get_current_protocol_price(protocol.id)
+            read_latencies.append(time.perf_counter() - started_at)
+
+    return {
+        "accounts": accounts,
+        "days": days,
+        "blocks": final_block_number(start, end) + 1,
+        "tokens": service.token_number,
+        "protocol_id": protocol.id,
+        "generated_rows": generated_rows,
+        "generate_rows_per_second": generated_rows / generate_seconds,
+        "insert_rows_per_second": service.rows_written / insert_seconds,
+        "tvl_rows": tvl_rows,
+        "tvl_seconds": tvl_seconds,
+        "tvl_plan": tvl_plan,
+        "get_current_price_p50_ms": _percentile(read_latencies, 50) * 1000,
+        "get_current_price_p95_ms": _percentile(read_latencies, 95) * 1000,
+    }
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    await init_db()
+    try:
+        results = []
+        for accounts in args.accounts:
+            for days in args.days:
+                result = await benchmark_cell(
+                    accounts=accounts,
+                    days=days,
+                    chunk=args.chunk,
+                    reads=args.reads,
+                    explain=args.explain,
+                )
+                print(json.dumps(result))
+                results.append(result)
+    finally:
+        await close_db()
+
+    return {
+        "commit": _git_commit(),
+        "created_at": dt.datetime.now(dt.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--accounts", type=_int_list, default=[100, 1_000])
+    parser.add_argument("--days", type=_int_list, default=[1, 5])
+    parser.add_argument("--chunk", type=int, default=100_000)
+    parser.add_argument("--reads", type=int, default=100)
+    parser.add_argument("--explain", action="store_true")
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+    if args.reads < 2:
+        parser.error("--reads must be at least 2")
+
+    report = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import asyncio
+import time
+
+from collections import OrderedDict
+from typing import Awaitable
+from typing import Callable
+from typing import Generic
+from typing import Hashable
+from typing import Iterable
+from typing import TypeVar
+
+from core.stats import stats
+
+T = TypeVar("T")
+
+
+class AsyncTTLCache(Generic[T]):
+    """
+    Bounded in-memory cache of async loads. The least recently used entry
+    is evicted when `maxsize` is exceeded and entries expire `ttl` seconds
+    after they were loaded. Concurrent loads of the same key are done once.
+    `None` results are not cached.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        maxsize: int,
+        ttl: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries: OrderedDict[Hashable, tuple[float, T]] = OrderedDict()
+        self.loading: dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get_or_load(
+        self,
+        key: Hashable,
+        load: Callable[[], Awaitable[T | None]],
+    ) -> T | None:
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > self.clock():
+            self.entries.move_to_end(key)
+            self._count(hit=True)
+            return entry[1]
+
+        self._count(hit=False)
+        if key in self.loading:
+            return await asyncio.shield(self.loading[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self.loading[key] = future
+        try:
+            value = await load()
+        except Exception as exc:
+            future.set_exception(exc)
+            # the exception is raised here, waiters get it from the future
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            # an invalidation during the load drops its result
+            if self.loading.get(key) is future and value is not None:
+                self._put(key, value)
+            return value
+        finally:
+            # e.g. a cancelled load, waiters are cancelled instead of hanging
+            if not future.done():
+                future.cancel()
+            if self.loading.get(key) is future:
+                del self.loading[key]
+
+    async def get_or_load_many(
+        self,
+        keys: Iterable[Hashable],
+        load: Callable[[list], Awaitable[dict[Hashable, T]]],
+    ) -> dict[Hashable, T]:
+        """
+        Same as `get_or_load` for several keys: the missing ones are loaded
+        with one call of `load`, which returns values of the keys it found.
+        Keys without a value are left out of the result.
+        """
+        values: dict[Hashable, T] = {}
+        waiting: dict[Hashable, asyncio.Future] = {}
+        futures: dict[Hashable, asyncio.Future] = {}
+        for key in dict.fromkeys(keys):
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > self.clock():
+                self.entries.move_to_end(key)
+                self._count(hit=True)
+                values[key] = entry[1]
+                continue
+
+            self._count(hit=False)
+            if key in self.loading:
+                waiting[key] = self.loading[key]
+            else:
+                future = asyncio.get_running_loop().create_future()
+                futures[key] = self.loading[key] = future
+
+        try:
+            loaded = await load(list(futures)) if futures else {}
+        except Exception as exc:
+            for future in futures.values():
+                future.set_exception(exc)
+                future.exception()
+            raise
+        else:
+            for key, future in futures.items():
+                value = loaded.get(key)
+                future.set_result(value)
+                if value is None:
+                    continue
+                if self.loading.get(key) is future:
+                    self._put(key, value)
+                values[key] = value
+        finally:
+            for key, future in futures.items():
+                if not future.done():
+                    future.cancel()
+                if self.loading.get(key) is future:
+                    del self.loading[key]
+
+        for key, future in waiting.items():
+            value = await asyncio.shield(future)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def invalidate(self, key: Hashable):
+        self.entries.pop(key, None)
+        self.loading.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+        self.loading.clear()
+
+    def _put(self, key: Hashable, value: T):
+        self.entries[key] = (self.clock() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def _count(self, hit: bool):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        stats.record_cache(self.name, hit)
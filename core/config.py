@@ -11,6 +11,15 @@ class _Settings(BaseSettings):
     pg_user: str
     pg_password: str
     db_url: str = None
+    pg_pool_size: int = 5
+    pg_max_overflow: int = 10
+    pg_statement_cache_size: int = 500
+
+    generation_chunk_size: int = 100_000
+    price_cache_size: int = 1024
+    price_cache_ttl: float = 60.0
+    token_price_compaction_age_days: int = 30
+    stats_dump_path: str = None
 
     @validator("db_url", pre=True, always=True)
     def construct_db_url(cls, value, values):
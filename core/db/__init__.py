@@ -1,51 +1,198 @@
+import datetime as dt
 import functools
+import hashlib
+import time
 
 from contextlib import asynccontextmanager
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncConnection
 from sqlalchemy.ext.asyncio import AsyncEngine
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import NullPool
 from sqlmodel import SQLModel
+from sqlmodel import text
 from typing import Any
 from typing import Callable
 from typing import Coroutine
 
 from core.config import settings
+from core.stats import stats
 
 # import all models for create_all function
 from .model import Account
 from .model import AccountBalanceHistory
+from .model import GenerationProgress
 from .model import Protocol
+from .model import ProtocolTVL
+from .model import ProtocolTVLRollup
 from .model import ProtocolToken
+from .model import SchemaVersion
 from .model import TVLHistory
+from .model import TVLWatermark
 from .model import Token
 from .model import TokenPrice
+from .model import TokenPriceHourly
 
 
 db_engine: AsyncEngine = create_async_engine(
     settings.db_url,
     # echo=True,
     future=True,
-    poolclass=NullPool,
+    pool_size=settings.pg_pool_size,
+    max_overflow=settings.pg_max_overflow,
+    connect_args={
+        # prepared statements are cached per pooled connection,
+        # so repo SQL is parsed and planned once per connection
+        "prepared_statement_cache_size": settings.pg_statement_cache_size,
+    },
 )
 
 
+# start times are keyed by execution context, so a failed statement can
+# not leave its start time to later statements of the pooled connection
+@event.listens_for(db_engine.sync_engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, *_):
+    conn.info.setdefault("statement_started_at", {})[context] = (
+        time.perf_counter()
+    )
+
+
+@event.listens_for(db_engine.sync_engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, *_):
+    started_at = conn.info["statement_started_at"].pop(context)
+    stats.record_statement(statement, time.perf_counter() - started_at)
+
+
+@event.listens_for(db_engine.sync_engine, "handle_error")
+def _handle_error(exception_context):
+    # failed statements get no after_cursor_execute
+    conn = exception_context.connection
+    if conn is not None:
+        conn.info.get("statement_started_at", {}).pop(
+            exception_context.execution_context,
+            None,
+        )
+
+
+async_session_factory = sessionmaker(
+    db_engine,
+    class_=AsyncSession,
+    expire_on_commit=False,
+)
+
+
+HAS_RELATION_SQL = text("""
+    SELECT to_regclass(CAST(:name AS text)) IS NOT NULL;
+""")
+
+GET_SCHEMA_VERSION_SQL = text("""
+    SELECT version FROM schema_version;
+""")
+
+# asyncpg prepares every statement, so each holds a single command
+DELETE_SCHEMA_VERSION_SQL = text("""
+    DELETE FROM schema_version;
+""")
+
+INSERT_SCHEMA_VERSION_SQL = text("""
+    INSERT INTO schema_version(version) VALUES (:version);
+""")
+
+
+def schema_version() -> str:
+    """Hash of tables, columns, indexes and constraints of all models."""
+    definition = []
+    for table in SQLModel.metadata.sorted_tables:
+        definition.append(
+            f"{table.name} {sorted(table.dialect_kwargs.items())}"
+        )
+        definition.extend(
+            f"{column.name} {column.type!r} {column.nullable} "
+            f"{column.primary_key} {column.foreign_keys}"
+            for column in table.columns
+        )
+        definition.extend(sorted(
+            f"{index.name} {list(index.columns.keys())} "
+            f"{sorted(index.dialect_kwargs.items())}"
+            for index in table.indexes
+        ))
+        definition.extend(sorted(
+            f"{type(constraint).__name__} {list(constraint.columns.keys())}"
+            for constraint in table.constraints
+        ))
+    return hashlib.sha1("\n".join(definition).encode()).hexdigest()
+
+
+async def create_missing_indexes(conn: AsyncConnection) -> list[str]:
+    """
+    `create_all` skips tables which already exist, so indexes added to
+    the models later are created here. Returns names of created indexes.
+    """
+    created = []
+    for table in SQLModel.metadata.sorted_tables:
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if await conn.scalar(HAS_RELATION_SQL, {"name": index.name}):
+                continue
+            await conn.run_sync(index.create)
+            created.append(index.name)
+    return created
+
+
+_db_initialized = False
+
+
 async def init_db():
+    """
+    Creates missing tables and indexes, skipped when the schema version
+    stored in the database matches the models, so a launch against a
+    current schema does not create every table again. Partitions for the
+    current month are created on every run, since a new month may have
+    begun since the schema was created. Changed columns of existing tables
+    are not migrated.
+    """
+    from .repo import PartitionRepo
+
+    global _db_initialized
+    version = schema_version()
     async with db_engine.begin() as conn:
-        # await conn.run_sync(SQLModel.metadata.drop_all)
-        await conn.run_sync(SQLModel.metadata.create_all)
+        is_current = bool(
+            await conn.scalar(HAS_RELATION_SQL, {"name": "schema_version"})
+            and await conn.scalar(GET_SCHEMA_VERSION_SQL) == version
+        )
+        if not is_current:
+            # await conn.run_sync(SQLModel.metadata.drop_all)
+            await conn.run_sync(SQLModel.metadata.create_all)
+            await create_missing_indexes(conn)
+
+    async with get_session() as session:
+        now = dt.datetime.now(dt.timezone.utc)
+        await PartitionRepo(session).ensure_partitions(start=now, end=now)
+        if not is_current:
+            await session.execute(DELETE_SCHEMA_VERSION_SQL)
+            await session.execute(
+                INSERT_SCHEMA_VERSION_SQL,
+                {"version": version},
+            )
+    _db_initialized = True
+
+
+async def ensure_db():
+    """
+    Runs `init_db` on the first use of the database, so commands which do
+    not use it (e.g. file exports) do not connect.
+    """
+    if not _db_initialized:
+        await init_db()
+
+
+async def close_db():
+    await db_engine.dispose()
 
 
 @asynccontextmanager
 async def get_session() -> AsyncSession:
-    async_session = sessionmaker(
-        db_engine,
-        class_=AsyncSession,
-        expire_on_commit=False,
-    )
-
-    async with async_session() as session:
+    async with async_session_factory() as session:
         session: AsyncSession
         try:
             yield session
@@ -60,6 +207,7 @@ def inject_session(
 ) -> Callable[..., Coroutine[Any, Any, Any]]:
     @functools.wraps(func)
     async def wrapper(*args, **kwargs) -> Any:
+        await ensure_db()
         async with get_session() as session:
             kwargs["session"] = session
             return await func(*args, **kwargs)
@@ -16,6 +16,11 @@ uint256: type[Decimal] = condecimal(
 )
 
 
+# history tables are split into monthly partitions by `created_at`,
+# see `core.db.repo.PartitionRepo`
+HISTORY_PARTITIONING = {"postgresql_partition_by": "RANGE (created_at)"}
+
+
 class BaseSQLModel(sm.SQLModel):
     @declared_attr
     def __tablename__(cls) -> str:
@@ -81,6 +86,16 @@ class Account(BaseSQLModel, table=True):
 
 
 class AccountBalanceHistory(BaseSQLModel, table=True):
+    __table_args__ = (
+        sa.Index(
+            "ix_account_balance_history_protocol_token_id_block",
+            "protocol_token_id",
+            "created_at_block",
+            postgresql_include=["created_at", "amount"],
+        ),
+        HISTORY_PARTITIONING,
+    )
+
     id: Optional[int] = sm.Field(
         default=None,
         sa_column=sa.Column(
@@ -92,7 +107,6 @@ class AccountBalanceHistory(BaseSQLModel, table=True):
     protocol_token_id: Optional[int] = sm.Field(
         nullable=False,
         foreign_key="protocol_token.id",
-        index=True,
     )
     account_id: Optional[int] = sm.Field(
         sa_column=sa.Column(
@@ -106,6 +120,8 @@ class AccountBalanceHistory(BaseSQLModel, table=True):
     created_at: dt.datetime = sm.Field(
         sa_column=sa.Column(
             sa.DateTime(timezone=True),
+            # partition key has to be a part of the primary key
+            primary_key=True,
             nullable=False,
             index=True,
         ),
@@ -127,6 +143,16 @@ class AccountBalanceHistory(BaseSQLModel, table=True):
 
 
 class TokenPrice(BaseSQLModel, table=True):
+    __table_args__ = (
+        sa.Index(
+            "ix_token_price_token_id_created_at",
+            "token_id",
+            "created_at",
+            postgresql_include=["usd_price"],
+        ),
+        HISTORY_PARTITIONING,
+    )
+
     id: Optional[int] = sm.Field(
         default=None,
         sa_column=sa.Column(
@@ -138,12 +164,13 @@ class TokenPrice(BaseSQLModel, table=True):
     token_id: Optional[int] = sm.Field(
         nullable=False,
         foreign_key="token.id",
-        index=True,
     )
     usd_price: Decimal = sm.Field(nullable=False)
     created_at: dt.datetime = sm.Field(
         sa_column=sa.Column(
             sa.DateTime(timezone=True),
+            # partition key has to be a part of the primary key
+            primary_key=True,
             nullable=False,
             index=True,
         ),
@@ -152,7 +179,57 @@ class TokenPrice(BaseSQLModel, table=True):
     token: Optional[Token] = sm.Relationship(back_populates="prices")
 
 
+class TokenPriceHourly(BaseSQLModel, table=True):
+    """
+    Ticks of `token_price` compacted into hourly OHLC buckets (UTC) by
+    `TokenPriceRepo.compact_before`. The close price is kept with the time
+    of its tick, so it stands in for the raw ticks of the hour.
+    """
+    __table_args__ = (
+        sa.Index(
+            "ix_token_price_hourly_token_id_close_created_at",
+            "token_id",
+            "close_created_at",
+            postgresql_include=["close_usd_price"],
+        ),
+    )
+
+    token_id: Optional[int] = sm.Field(
+        default=None,
+        primary_key=True,
+        foreign_key="token.id",
+    )
+    bucket: dt.datetime = sm.Field(
+        sa_column=sa.Column(sa.DateTime(timezone=True), primary_key=True),
+    )
+    open_usd_price: Decimal = sm.Field(nullable=False)
+    high_usd_price: Decimal = sm.Field(nullable=False)
+    low_usd_price: Decimal = sm.Field(nullable=False)
+    close_usd_price: Decimal = sm.Field(nullable=False)
+    close_created_at: dt.datetime = sm.Field(
+        sa_column=sa.Column(sa.DateTime(timezone=True), nullable=False),
+    )
+    ticks: int = sm.Field(nullable=False)
+
+
 class TVLHistory(BaseSQLModel, table=True):
+    __table_args__ = (
+        # also serves lookups of the last row of a token at a block
+        sa.UniqueConstraint(
+            "protocol_token_id",
+            "created_at_block",
+            "created_at",
+        ),
+        # lookups of the last row of a token at a time
+        sa.Index(
+            "ix_tvl_history_protocol_token_id_created_at",
+            "protocol_token_id",
+            "created_at",
+            postgresql_include=["created_at_block", "amount_usd"],
+        ),
+        HISTORY_PARTITIONING,
+    )
+
     id: Optional[int] = sm.Field(
         default=None,
         sa_column=sa.Column(
@@ -171,6 +248,8 @@ class TVLHistory(BaseSQLModel, table=True):
     created_at: dt.datetime = sm.Field(
         sa_column=sa.Column(
             sa.DateTime(timezone=True),
+            # partition key has to be a part of the primary key
+            primary_key=True,
             nullable=False,
             index=True,
         ),
@@ -186,3 +265,91 @@ class TVLHistory(BaseSQLModel, table=True):
     protocol_token: Optional[ProtocolToken] = sm.Relationship(
         back_populates="tvl_history",
     )
+
+
+class TVLWatermark(BaseSQLModel, table=True):
+    protocol_id: Optional[int] = sm.Field(
+        default=None,
+        primary_key=True,
+        foreign_key="protocol.id",
+    )
+    created_at_block: int = sm.Field(
+        sa_column=sa.Column(sa.BigInteger(), nullable=False),
+    )
+    created_at: dt.datetime = sm.Field(
+        sa_column=sa.Column(sa.DateTime(timezone=True), nullable=False),
+    )
+
+
+class ProtocolTVL(BaseSQLModel, table=True):
+    protocol_id: Optional[int] = sm.Field(
+        default=None,
+        primary_key=True,
+        foreign_key="protocol.id",
+    )
+    created_at_block: int = sm.Field(
+        sa_column=sa.Column(sa.BigInteger(), nullable=False),
+    )
+    # lets protocols be ranked by TVL with a backward index scan
+    amount_usd: Decimal = sm.Field(nullable=False, index=True)
+
+
+class ProtocolTVLRollup(BaseSQLModel, table=True):
+    """
+    TVL of a protocol per hour or day bucket (UTC), maintained from
+    `tvl_history` by `TVLHistoryRepo`. `amount_usd` is the TVL at the last
+    price tick of the bucket.
+    """
+    protocol_id: Optional[int] = sm.Field(
+        default=None,
+        primary_key=True,
+        foreign_key="protocol.id",
+    )
+    resolution: str = sm.Field(primary_key=True)
+    bucket: dt.datetime = sm.Field(
+        sa_column=sa.Column(sa.DateTime(timezone=True), primary_key=True),
+    )
+    amount_usd: Decimal = sm.Field(nullable=False)
+    min_amount_usd: Decimal = sm.Field(nullable=False)
+    max_amount_usd: Decimal = sm.Field(nullable=False)
+
+
+class GenerationProgress(BaseSQLModel, table=True):
+    """
+    Options of a protocol generation and the number of its generation jobs
+    (block ranges, slices of final balances and of price ticks) which are
+    committed, so an interrupted generation can be resumed.
+    """
+    protocol_id: Optional[int] = sm.Field(
+        default=None,
+        primary_key=True,
+        foreign_key="protocol.id",
+    )
+    seed: int = sm.Field(
+        sa_column=sa.Column(sa.BigInteger(), nullable=False),
+    )
+    accounts: int = sm.Field(nullable=False)
+    start: dt.datetime = sm.Field(
+        sa_column=sa.Column(sa.DateTime(timezone=True), nullable=False),
+    )
+    end: dt.datetime = sm.Field(
+        sa_column=sa.Column(sa.DateTime(timezone=True), nullable=False),
+    )
+    deposit: float = sm.Field(nullable=False)
+    chunk: int = sm.Field(nullable=False)
+    tvl: str = sm.Field(nullable=False)
+    # last id of the account pool accounts were sampled from, if they were
+    account_pool_max_id: Optional[int] = sm.Field(
+        default=None,
+        sa_column=sa.Column(sa.BigInteger(), nullable=True),
+    )
+    committed_jobs: int = sm.Field(default=0, nullable=False)
+    finished_at: Optional[dt.datetime] = sm.Field(
+        default=None,
+        sa_column=sa.Column(sa.DateTime(timezone=True), nullable=True),
+    )
+
+
+class SchemaVersion(BaseSQLModel, table=True):
+    """Hash of the models the tables were last created from."""
+    version: str = sm.Field(primary_key=True)
@@ -1,4 +1,9 @@
 from .base import BaseRepo
 
+from .account import AccountRepo
+from .bulk import BulkRepo
+from .generation_progress import GenerationProgressRepo
+from .partition import PartitionRepo
 from .protocol_token import ProtocolTokenRepo
+from .token_price import TokenPriceRepo
 from .tvl_history import TVLHistoryRepo
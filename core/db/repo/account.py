@@ -0,0 +1,63 @@
+from sqlmodel import text
+
+from .base import BaseRepo
+
+
+class AccountRepo(BaseRepo):
+    """Accounts as a pool shared by generated protocols."""
+    MAX_ID = 2 ** 63 - 1
+
+    # both are read from the ends of the primary key index
+    GET_ID_RANGE_SQL = text("""
+        SELECT
+            MIN(id) AS first_id,
+            MAX(id) AS last_id
+        FROM account
+        WHERE id <= :max_id;
+    """)
+
+    # stops at `limit` accounts, so it does not scan the whole pool
+    COUNT_UP_TO_SQL = text("""
+        SELECT COUNT(*)
+        FROM (
+            SELECT 1
+            FROM account
+            WHERE id <= :max_id
+            LIMIT :limit
+        ) pool;
+    """)
+
+    GET_EXISTING_IDS_SQL = text("""
+        SELECT id
+        FROM account
+        WHERE id = ANY(CAST(:ids AS bigint[]));
+    """)
+
+    async def get_id_range(
+        self,
+        max_id: int | None = None,
+    ) -> tuple[int | None, int | None]:
+        """First and last id of accounts up to `max_id`."""
+        result = await self.session.execute(
+            self.GET_ID_RANGE_SQL,
+            {"max_id": self.MAX_ID if max_id is None else max_id},
+        )
+        return tuple(result.one())
+
+    async def count_up_to(self, limit: int, max_id: int | None = None) -> int:
+        """Number of accounts up to `max_id`, counted up to `limit`."""
+        result = await self.session.execute(
+            self.COUNT_UP_TO_SQL,
+            {
+                "max_id": self.MAX_ID if max_id is None else max_id,
+                "limit": limit,
+            },
+        )
+        return result.scalar_one()
+
+    async def get_existing_ids(self, ids: list[int]) -> set[int]:
+        result = await self.session.execute(
+            self.GET_EXISTING_IDS_SQL,
+            {"ids": ids},
+        )
+        return set(result.scalars().all())
@@ -1,6 +1,7 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from core.db.model import BaseSQLModel
+from core.stats import stats
 
 
 class BaseRepo:
@@ -14,4 +15,11 @@ class BaseRepo:
     ):
         self.session.add_all(objects)
         if with_commit:
+            with stats.phase("orm_flush") as phase:
+                await self.session.flush()
+                phase.rows += len(objects)
+            await self.commit()
+
+    async def commit(self):
+        with stats.phase("commit"):
             await self.session.commit()
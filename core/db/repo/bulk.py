@@ -0,0 +1,129 @@
+from sqlalchemy.engine import Row
+from sqlmodel import text
+from typing import Any
+from typing import Iterable
+from typing import Sequence
+
+from core.stats import stats
+
+from .base import BaseRepo
+
+
+class BulkRepo(BaseRepo):
+    RESERVE_IDS_SQL = text("""
+        SELECT nextval(pg_get_serial_sequence(:table_name, 'id'))
+        FROM generate_series(1, :number);
+    """)
+
+    # indexes which do not back a primary key or a unique constraint
+    GET_SECONDARY_INDEXES_SQL = text("""
+        SELECT
+            i.relname AS name,
+            pg_get_indexdef(i.oid) AS definition
+        FROM pg_index x
+        JOIN pg_class i ON x.indexrelid = i.oid
+        WHERE
+            x.indrelid = to_regclass(:table_name)
+            AND NOT EXISTS (
+                SELECT 1
+                FROM pg_constraint c
+                WHERE c.conindid = x.indexrelid
+            )
+        ORDER BY i.relname;
+    """)
+
+    async def reserve_ids(self, table_name: str, number: int) -> list[int]:
+        """
+        Takes `number` ids from the `id` sequence of the table, so rows can
+        be copied with ids known up front.
+        """
+        result = await self.session.execute(
+            self.RESERVE_IDS_SQL,
+            {"table_name": table_name, "number": number},
+        )
+        return result.scalars().all()
+
+    async def copy_records(
+        self,
+        table_name: str,
+        columns: Sequence[str],
+        records: Iterable[tuple[Any, ...]],
+        with_commit: bool = False,
+    ):
+        with stats.phase(f"copy.{table_name}") as phase:
+            connection = await self.session.connection()
+            raw_connection = await connection.get_raw_connection()
+            status = await (
+                raw_connection.driver_connection.copy_records_to_table(
+                    table_name,
+                    records=records,
+                    columns=list(columns),
+                )
+            )
+            # status is "COPY <number of rows>"
+            phase.rows += int(status.split()[-1])
+
+        if with_commit:
+            await self.commit()
+
+    async def create_staging_table(
+        self,
+        table_name: str,
+        staging_table_name: str,
+        columns: Sequence[str],
+    ):
+        """
+        Creates an UNLOGGED table with `columns` of the table and without
+        its constraints and indexes, so copied rows are not WAL-logged.
+        """
+        await self.session.execute(text(
+            f"CREATE UNLOGGED TABLE {staging_table_name} AS "
+            f"SELECT {', '.join(columns)} FROM {table_name} WITH NO DATA;"
+        ))
+
+    async def merge_staging_table(
+        self,
+        table_name: str,
+        staging_table_name: str,
+        columns: Sequence[str],
+    ) -> int:
+        """
+        Moves all rows of the staging table to the table with one statement
+        and drops the staging table. Returns number of moved rows.
+        """
+        with stats.phase(f"merge.{table_name}") as phase:
+            result = await self.session.execute(text(
+                f"INSERT INTO {table_name}({', '.join(columns)}) "
+                f"SELECT {', '.join(columns)} FROM {staging_table_name};"
+            ))
+            await self.session.execute(
+                text(f"DROP TABLE {staging_table_name};")
+            )
+            phase.rows += result.rowcount
+        return result.rowcount
+
+    async def drop_secondary_indexes(self, table_name: str) -> list[Row]:
+        """
+        Drops indexes of the table which do not back a constraint. Returns
+        their names and definitions for `create_indexes`.
+        """
+        result = await self.session.execute(
+            self.GET_SECONDARY_INDEXES_SQL,
+            {"table_name": table_name},
+        )
+        indexes = result.all()
+        for index in indexes:
+            await self.session.execute(text(f"DROP INDEX {index.name};"))
+        return indexes
+
+    async def create_indexes(self, indexes: list[Row]):
+        with stats.phase("create_indexes"):
+            for index in indexes:
+                # indexes of partitioned tables are defined `ON ONLY` the
+                # parent, which would not build them on the partitions
+                definition = index.definition.replace(" ON ONLY ", " ON ", 1)
+                await self.session.execute(text(f"{definition};"))
+
+    async def analyze(self, table_name: str):
+        with stats.phase("analyze"):
+            await self.session.execute(text(f"ANALYZE {table_name};"))
@@ -0,0 +1,68 @@
+from sqlmodel import select
+from sqlmodel import text
+
+from core.db.model import GenerationProgress
+from core.db.model import Token
+
+from .base import BaseRepo
+
+
+class GenerationProgressRepo(BaseRepo):
+    """
+    Checkpoints of protocol generations and lookups of the rows an
+    interrupted generation already wrote.
+    """
+    SET_COMMITTED_JOBS_SQL = text("""
+        UPDATE generation_progress
+        SET committed_jobs = :committed_jobs
+        WHERE protocol_id = :protocol_id;
+    """)
+
+    # addresses are bound as one array, asyncpg takes at most 32767
+    # arguments per statement
+    GET_ACCOUNT_IDS_BY_WALLET_ADDRESS_SQL = text("""
+        SELECT wallet_address, id
+        FROM account
+        WHERE wallet_address = ANY(CAST(:wallet_addresses AS text[]));
+    """)
+
+    FINISH_SQL = text("""
+        UPDATE generation_progress
+        SET finished_at = now()
+        WHERE protocol_id = :protocol_id;
+    """)
+
+    async def get_progress(
+        self,
+        protocol_id: int,
+    ) -> GenerationProgress | None:
+        return await self.session.get(GenerationProgress, protocol_id)
+
+    async def set_committed_jobs(self, protocol_id: int, committed_jobs: int):
+        """Is committed together with the frames of the jobs."""
+        await self.session.execute(
+            self.SET_COMMITTED_JOBS_SQL,
+            {"protocol_id": protocol_id, "committed_jobs": committed_jobs},
+        )
+
+    async def finish(self, protocol_id: int):
+        await self.session.execute(
+            self.FINISH_SQL,
+            {"protocol_id": protocol_id},
+        )
+
+    async def get_token_ids_by_name(self, names: list[str]) -> dict[str, int]:
+        result = await self.session.execute(
+            select(Token.name, Token.id).where(Token.name.in_(names))
+        )
+        return dict(result.all())
+
+    async def get_account_ids_by_wallet_address(
+        self,
+        wallet_addresses: list[str],
+    ) -> dict[str, int]:
+        result = await self.session.execute(
+            self.GET_ACCOUNT_IDS_BY_WALLET_ADDRESS_SQL,
+            {"wallet_addresses": wallet_addresses},
+        )
+        return dict(result.all())
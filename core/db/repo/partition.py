@@ -0,0 +1,133 @@
+import datetime as dt
+import re
+
+from sqlmodel import text
+
+from .base import BaseRepo
+
+
+def _utc_date(value: dt.datetime) -> dt.date:
+    """Date of `value` in UTC, naive values are taken as UTC."""
+    if value.tzinfo is not None:
+        value = value.astimezone(dt.timezone.utc)
+    return value.date()
+
+
+def _month_start(value: dt.datetime) -> dt.date:
+    return _utc_date(value).replace(day=1)
+
+
+def _next_month(value: dt.date) -> dt.date:
+    return (value.replace(day=1) + dt.timedelta(days=32)).replace(day=1)
+
+
+class PartitionRepo(BaseRepo):
+    """
+    Monthly `created_at` range partitions of the history tables. Partitions
+    are named `<table>_pYYYYMM` and cover [first day of month, first day of
+    next month) in UTC.
+    """
+    PARTITIONED_TABLES = (
+        "account_balance_history",
+        "token_price",
+        "tvl_history",
+    )
+    PARTITION_NAME_REGEX = re.compile(r"_p(?P<year>\d{4})(?P<month>\d{2})$")
+
+    # partitions may be created by concurrent generations
+    LOCK_PARTITIONS_SQL = text("""
+        SELECT pg_advisory_xact_lock(hashtext('history_partitions'));
+    """)
+
+    GET_PARTITIONED_TABLES_SQL = text("""
+        SELECT relname
+        FROM pg_class
+        WHERE
+            relname = ANY(:tables)
+            AND relkind = 'p';
+    """)
+
+    GET_PARTITIONS_SQL = text("""
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+        JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+        WHERE parent.relname = :table;
+    """)
+
+    async def ensure_partitions(
+        self,
+        start: dt.datetime,
+        end: dt.datetime,
+    ) -> list[str]:
+        """
+        Creates missing partitions for [start, end] with a day of margin on
+        both sides for local time zones. Returns names of created ones.
+        """
+        months = []
+        month = _month_start(start - dt.timedelta(days=1))
+        while month <= _month_start(end + dt.timedelta(days=1)):
+            months.append(month)
+            month = _next_month(month)
+
+        await self.session.execute(self.LOCK_PARTITIONS_SQL)
+        created = []
+        for table in await self._get_partitioned_tables():
+            existing = set(await self._get_partitions(table))
+            for month in months:
+                partition = f"{table}_p{month:%Y%m}"
+                if partition in existing:
+                    continue
+
+                await self.session.execute(text(
+                    f"CREATE TABLE {partition} PARTITION OF {table} "
+                    f"FOR VALUES FROM ('{month} 00:00:00+00') "
+                    f"TO ('{_next_month(month)} 00:00:00+00');"
+                ))
+                created.append(partition)
+
+        return created
+
+    async def drop_partitions_before(
+        self,
+        before: dt.datetime,
+        tables: tuple[str, ...] = PARTITIONED_TABLES,
+    ) -> list[str]:
+        """
+        Drops partitions of `tables` which only hold rows created before
+        `before`. Returns names of dropped ones.
+        """
+        await self.session.execute(self.LOCK_PARTITIONS_SQL)
+        dropped = []
+        for table in await self._get_partitioned_tables(tables):
+            for partition in await self._get_partitions(table):
+                match = self.PARTITION_NAME_REGEX.search(partition)
+                if not match:
+                    continue
+
+                month = dt.date(int(match["year"]), int(match["month"]), 1)
+                if _next_month(month) <= _utc_date(before):
+                    await self.session.execute(
+                        text(f"DROP TABLE {partition};")
+                    )
+                    dropped.append(partition)
+
+        return dropped
+
+    async def _get_partitioned_tables(
+        self,
+        tables: tuple[str, ...] = PARTITIONED_TABLES,
+    ) -> list[str]:
+        # tables created before partitioning was introduced are skipped
+        result = await self.session.execute(
+            self.GET_PARTITIONED_TABLES_SQL,
+            {"tables": list(tables)},
+        )
+        return result.scalars().all()
+
+    async def _get_partitions(self, table: str) -> list[str]:
+        result = await self.session.execute(
+            self.GET_PARTITIONS_SQL,
+            {"table": table},
+        )
+        return result.scalars().all()
@@ -1,4 +1,5 @@
 from sqlmodel import select
+from sqlmodel import text
 
 from core.db.model import ProtocolToken
 
@@ -6,6 +7,37 @@ from .base import BaseRepo
 
 
 class ProtocolTokenRepo(BaseRepo):
+    GET_EXISTING_NAMES_SQL = text("""
+        SELECT 'protocol ' || name
+        FROM protocol
+        WHERE name = :protocol_name
+        UNION ALL
+        SELECT 'token ' || name
+        FROM token
+        WHERE name = ANY(CAST(:token_names AS text[]))
+        UNION ALL
+        SELECT 'token symbol ' || symbol
+        FROM token
+        WHERE symbol = ANY(CAST(:token_symbols AS text[]));
+    """)
+
+    async def get_existing_names(
+        self,
+        protocol_name: str,
+        token_names: list[str],
+        token_symbols: list[str],
+    ) -> list[str]:
+        """Unique names and symbols which are already taken."""
+        result = await self.session.execute(
+            self.GET_EXISTING_NAMES_SQL,
+            {
+                "protocol_name": protocol_name,
+                "token_names": token_names,
+                "token_symbols": token_symbols,
+            },
+        )
+        return result.scalars().all()
+
     async def get_protocol_token_by_protocol_id(
         self,
         protocol_id: int,
@@ -13,6 +45,8 @@ class ProtocolTokenRepo(BaseRepo):
         result = await self.session.execute(
             select(ProtocolToken)
             .where(ProtocolToken.protocol_id == protocol_id)
+            # generation samples tokens by position, so the order is fixed
+            .order_by(ProtocolToken.id)
         )
 
         return result.scalars().all()
@@ -0,0 +1,104 @@
+import datetime as dt
+
+from sqlalchemy.engine import Row
+from sqlmodel import text
+from typing import AsyncIterator
+
+from core.stats import stats
+
+from .base import BaseRepo
+
+
+class TokenPriceRepo(BaseRepo):
+    # buckets are whole hours, so ticks of a bucket are compacted at once;
+    # a bucket compacted again (e.g. ticks written after compaction) keeps
+    # its open price and extends its range
+    COMPACT_SQL = text("""
+        INSERT INTO token_price_hourly(
+            token_id,
+            bucket,
+            open_usd_price,
+            high_usd_price,
+            low_usd_price,
+            close_usd_price,
+            close_created_at,
+            ticks
+        )
+        SELECT
+            token_id,
+            date_trunc('hour', created_at, 'UTC'),
+            (ARRAY_AGG(usd_price ORDER BY created_at))[1],
+            MAX(usd_price),
+            MIN(usd_price),
+            (ARRAY_AGG(usd_price ORDER BY created_at DESC))[1],
+            MAX(created_at),
+            COUNT(*)
+        FROM token_price
+        WHERE created_at < :before
+        GROUP BY
+            token_id,
+            date_trunc('hour', created_at, 'UTC')
+        ON CONFLICT (token_id, bucket)
+        DO UPDATE SET
+            high_usd_price = GREATEST(
+                token_price_hourly.high_usd_price,
+                EXCLUDED.high_usd_price
+            ),
+            low_usd_price = LEAST(
+                token_price_hourly.low_usd_price,
+                EXCLUDED.low_usd_price
+            ),
+            close_usd_price = EXCLUDED.close_usd_price,
+            close_created_at = EXCLUDED.close_created_at,
+            ticks = token_price_hourly.ticks + EXCLUDED.ticks;
+    """)
+
+    DELETE_BEFORE_SQL = text("""
+        DELETE FROM token_price
+        WHERE created_at < :before;
+    """)
+
+    GET_TICKS_BEFORE_SQL = text("""
+        SELECT token_id, usd_price, created_at
+        FROM token_price
+        WHERE created_at < :before
+        ORDER BY token_id, created_at;
+    """)
+
+    async def compact_before(self, before: dt.datetime) -> int:
+        """
+        Rolls ticks created before `before` into hourly buckets, `before`
+        has to be a whole hour. Returns number of upserted buckets.
+        """
+        with stats.phase("compact_token_prices") as phase:
+            result = await self.session.execute(
+                self.COMPACT_SQL,
+                {"before": before},
+            )
+            phase.rows += result.rowcount
+        return result.rowcount
+
+    async def delete_before(self, before: dt.datetime) -> int:
+        """
+        Deletes ticks created before `before` which are not in dropped
+        partitions, e.g. of a table created before partitioning. Returns
+        number of deleted ticks.
+        """
+        result = await self.session.execute(
+            self.DELETE_BEFORE_SQL,
+            {"before": before},
+        )
+        return result.rowcount
+
+    async def iter_ticks_before(
+        self,
+        before: dt.datetime,
+        batch_size: int,
+    ) -> AsyncIterator[list[Row]]:
+        """Ticks created before `before` in batches, read with a cursor."""
+        result = await self.session.stream(
+            self.GET_TICKS_BEFORE_SQL,
+            {"before": before},
+        )
+        async for batch in result.partitions(batch_size):
+            yield batch
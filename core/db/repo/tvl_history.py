@@ -1,11 +1,23 @@
+import datetime as dt
+
 from decimal import Decimal
+from sqlalchemy.engine import Row
 from sqlmodel import text
 
+from core.stats import stats
+
 from .base import BaseRepo
 
 
 class TVLHistoryRepo(BaseRepo):
-    CALCULATE_HISTORY_SQL = """
+    MIN_CREATED_AT = dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)
+
+    # Balance rows are aggregated per (token, block) first, so every
+    # price lookup is a single range scan of the
+    # (token_id, created_at) index on token_price per aggregated block.
+    # Compacted hours take part with their close tick, read from the
+    # (token_id, close_created_at) index on token_price_hourly.
+    CALCULATE_HISTORY_SQL = text("""
         INSERT INTO tvl_history(
             protocol_token_id,
             created_at_block,
@@ -14,60 +26,480 @@ class TVLHistoryRepo(BaseRepo):
             created_at
         )
         SELECT
-            abh.protocol_token_id,
-            abh.created_at_block,
-            SUM(abh.amount) AS amount,
-            UNNEST(MIN(usd_price_ticks.usd_price)) * SUM(abh.amount)
-                AS amount_usd,
-            UNNEST(MIN(usd_price_ticks.created_at)) AS created_at
-        FROM account_balance_history abh
-        JOIN protocol_token pt ON abh.protocol_token_id = pt.id,
-        LATERAL (
+            balance.protocol_token_id,
+            balance.created_at_block,
+            balance.amount,
+            tp.usd_price * balance.amount AS amount_usd,
+            tp.created_at
+        FROM (
             SELECT
-                ARRAY_AGG(tp.usd_price ORDER BY tp.created_at) AS usd_price,
-                ARRAY_AGG(tp.created_at ORDER BY tp.created_at) AS created_at
-            FROM token_price tp
+                abh.protocol_token_id,
+                pt.token_id,
+                abh.created_at_block,
+                MIN(abh.created_at) AS created_at,
+                SUM(abh.amount) AS amount
+            FROM account_balance_history abh
+            JOIN protocol_token pt ON abh.protocol_token_id = pt.id
             WHERE
-                tp.token_id = pt.token_id
-                AND (
-                    tp.created_at - abh.created_at
-                    BETWEEN INTERVAL '0' AND INTERVAL '1 hour'
-                )
-        ) usd_price_ticks
-        WHERE pt.protocol_id = :protocol_id
-        GROUP BY
-            abh.protocol_token_id,
-            abh.created_at_block;
-    """
+                pt.protocol_id = :protocol_id
+                AND abh.created_at_block > :from_block
+                AND abh.created_at >= :from_created_at
+            GROUP BY
+                abh.protocol_token_id,
+                pt.token_id,
+                abh.created_at_block
+        ) balance
+        JOIN (
+            SELECT token_id, usd_price, created_at
+            FROM token_price
+            UNION ALL
+            SELECT token_id, close_usd_price, close_created_at
+            FROM token_price_hourly
+        ) tp ON
+            tp.token_id = balance.token_id
+            AND tp.created_at >= balance.created_at
+            AND tp.created_at <= balance.created_at + INTERVAL '1 hour'
+        ON CONFLICT (protocol_token_id, created_at_block, created_at)
+        DO UPDATE SET
+            amount = EXCLUDED.amount,
+            amount_usd = EXCLUDED.amount_usd;
+    """)
 
-    GET_CURRENT_PROTOCOL_PRICE_SQL = """
-        WITH block AS (
-            SELECT MAX(tvl.created_at_block) AS max_block_num
-            FROM tvl_history tvl
-            JOIN protocol_token pt ON tvl.protocol_token_id = pt.id
-            WHERE pt.protocol_id = :protocol_id
+    GET_WATERMARK_SQL = text("""
+        SELECT created_at_block, created_at
+        FROM tvl_watermark
+        WHERE protocol_id = :protocol_id;
+    """)
+
+    UPDATE_WATERMARK_SQL = text("""
+        INSERT INTO tvl_watermark(
+            protocol_id,
+            created_at_block,
+            created_at
         )
         SELECT
-            SUM(amount_usd)
-        FROM tvl_history tvl
-        JOIN protocol_token pt ON tvl.protocol_token_id = pt.id
+            pt.protocol_id,
+            MAX(abh.created_at_block),
+            MAX(abh.created_at)
+        FROM account_balance_history abh
+        JOIN protocol_token pt ON abh.protocol_token_id = pt.id
         WHERE
             pt.protocol_id = :protocol_id
-            AND tvl.created_at_block = (SELECT max_block_num FROM block);
-    """
+            AND abh.created_at_block > :from_block
+            AND abh.created_at >= :from_created_at
+        GROUP BY pt.protocol_id
+        ON CONFLICT (protocol_id)
+        DO UPDATE SET
+            created_at_block = EXCLUDED.created_at_block,
+            created_at = EXCLUDED.created_at;
+    """)
+
+    SET_WATERMARK_SQL = text("""
+        INSERT INTO tvl_watermark(
+            protocol_id,
+            created_at_block,
+            created_at
+        )
+        VALUES (:protocol_id, :created_at_block, :created_at)
+        ON CONFLICT (protocol_id)
+        DO UPDATE SET
+            created_at_block = EXCLUDED.created_at_block,
+            created_at = EXCLUDED.created_at;
+    """)
+
+    REFRESH_PROTOCOL_TVL_SQL = text("""
+        INSERT INTO protocol_tvl(
+            protocol_id,
+            created_at_block,
+            amount_usd
+        )
+        SELECT
+            pt.protocol_id,
+            tvl.created_at_block,
+            SUM(tvl.amount_usd)
+        FROM tvl_watermark wm
+        JOIN protocol_token pt ON wm.protocol_id = pt.protocol_id
+        JOIN tvl_history tvl ON
+            tvl.protocol_token_id = pt.id
+            AND tvl.created_at_block = wm.created_at_block
+        WHERE wm.protocol_id = :protocol_id
+        GROUP BY
+            pt.protocol_id,
+            tvl.created_at_block
+        ON CONFLICT (protocol_id)
+        DO UPDATE SET
+            created_at_block = EXCLUDED.created_at_block,
+            amount_usd = EXCLUDED.amount_usd;
+    """)
+
+    # protocol TVL at a price tick is the sum over its tokens, hour buckets
+    # keep the last, min and max of it and day buckets are built from hours.
+    # A tick on a block boundary is in the windows of two blocks, so only
+    # its row of the later block is summed.
+    REFRESH_HOUR_ROLLUP_SQL = text("""
+        INSERT INTO protocol_tvl_rollup(
+            protocol_id,
+            resolution,
+            bucket,
+            amount_usd,
+            min_amount_usd,
+            max_amount_usd
+        )
+        SELECT
+            tick.protocol_id,
+            'hour',
+            tick.bucket,
+            (ARRAY_AGG(tick.amount_usd ORDER BY tick.created_at DESC))[1],
+            MIN(tick.amount_usd),
+            MAX(tick.amount_usd)
+        FROM (
+            SELECT
+                token_tick.protocol_id,
+                token_tick.created_at,
+                date_trunc('hour', token_tick.created_at, 'UTC') AS bucket,
+                SUM(token_tick.amount_usd) AS amount_usd
+            FROM (
+                SELECT DISTINCT ON (tvl.protocol_token_id, tvl.created_at)
+                    pt.protocol_id,
+                    tvl.created_at,
+                    tvl.amount_usd
+                FROM tvl_history tvl
+                JOIN protocol_token pt ON tvl.protocol_token_id = pt.id
+                WHERE
+                    pt.protocol_id = :protocol_id
+                    AND tvl.created_at >= date_trunc(
+                        'hour',
+                        CAST(:from_created_at AS timestamptz),
+                        'UTC'
+                    )
+                ORDER BY
+                    tvl.protocol_token_id,
+                    tvl.created_at,
+                    tvl.created_at_block DESC
+            ) token_tick
+            GROUP BY
+                token_tick.protocol_id,
+                token_tick.created_at
+        ) tick
+        GROUP BY
+            tick.protocol_id,
+            tick.bucket
+        ON CONFLICT (protocol_id, resolution, bucket)
+        DO UPDATE SET
+            amount_usd = EXCLUDED.amount_usd,
+            min_amount_usd = EXCLUDED.min_amount_usd,
+            max_amount_usd = EXCLUDED.max_amount_usd;
+    """)
+
+    REFRESH_DAY_ROLLUP_SQL = text("""
+        INSERT INTO protocol_tvl_rollup(
+            protocol_id,
+            resolution,
+            bucket,
+            amount_usd,
+            min_amount_usd,
+            max_amount_usd
+        )
+        SELECT
+            protocol_id,
+            'day',
+            date_trunc('day', bucket, 'UTC'),
+            (ARRAY_AGG(amount_usd ORDER BY bucket DESC))[1],
+            MIN(min_amount_usd),
+            MAX(max_amount_usd)
+        FROM protocol_tvl_rollup
+        WHERE
+            protocol_id = :protocol_id
+            AND resolution = 'hour'
+            AND bucket >= date_trunc(
+                'day',
+                CAST(:from_created_at AS timestamptz),
+                'UTC'
+            )
+        GROUP BY
+            protocol_id,
+            date_trunc('day', bucket, 'UTC')
+        ON CONFLICT (protocol_id, resolution, bucket)
+        DO UPDATE SET
+            amount_usd = EXCLUDED.amount_usd,
+            min_amount_usd = EXCLUDED.min_amount_usd,
+            max_amount_usd = EXCLUDED.max_amount_usd;
+    """)
 
-    async def calculate_history_by_protocol_id(self, protocol_id: int):
+    GET_HISTORY_SQL = text("""
+        SELECT
+            bucket,
+            amount_usd,
+            min_amount_usd,
+            max_amount_usd
+        FROM protocol_tvl_rollup
+        WHERE
+            protocol_id = :protocol_id
+            AND resolution = CAST(:resolution AS text)
+            AND bucket >= date_trunc(
+                CAST(:resolution AS text),
+                CAST(:start AS timestamptz),
+                'UTC'
+            )
+            AND bucket <= :end
+        ORDER BY bucket;
+    """)
+
+    GET_CURRENT_PROTOCOL_PRICE_SQL = text("""
+        SELECT amount_usd
+        FROM protocol_tvl
+        WHERE protocol_id = :protocol_id;
+    """)
+
+    GET_CURRENT_PROTOCOL_PRICES_SQL = text("""
+        SELECT protocol_id, amount_usd
+        FROM protocol_tvl
+        WHERE protocol_id = ANY(CAST(:protocol_ids AS integer[]));
+    """)
+
+    GET_TOP_PROTOCOLS_SQL = text("""
+        SELECT
+            tvl.protocol_id,
+            p.name,
+            tvl.amount_usd
+        FROM protocol_tvl tvl
+        JOIN protocol p ON tvl.protocol_id = p.id
+        ORDER BY tvl.amount_usd DESC
+        LIMIT :limit;
+    """)
+
+    # one backward index seek per protocol token finds its last tick at or
+    # before the target and only that row is summed. A tick on a block
+    # boundary is in the windows of two blocks, so its row of the later
+    # block is taken, as in the hour rollup. The seek is not bounded by
+    # `created_at`: it probes the index of every monthly partition once.
+    GET_PROTOCOL_PRICE_AT_BLOCK_SQL = text("""
+        SELECT
+            SUM(last.amount_usd) AS amount_usd,
+            MAX(last.created_at_block) AS created_at_block,
+            MAX(last.created_at) AS created_at
+        FROM protocol_token pt
+        CROSS JOIN LATERAL (
+            SELECT created_at_block, created_at, amount_usd
+            FROM tvl_history
+            WHERE
+                protocol_token_id = pt.id
+                AND created_at_block <= :block
+            ORDER BY created_at_block DESC, created_at DESC
+            LIMIT 1
+        ) last
+        WHERE pt.protocol_id = :protocol_id;
+    """)
+
+    GET_PROTOCOL_PRICE_AT_SQL = text("""
+        SELECT
+            SUM(last.amount_usd) AS amount_usd,
+            MAX(last.created_at_block) AS created_at_block,
+            MAX(last.created_at) AS created_at
+        FROM protocol_token pt
+        CROSS JOIN LATERAL (
+            SELECT created_at_block, created_at, amount_usd
+            FROM tvl_history
+            WHERE
+                protocol_token_id = pt.id
+                AND created_at <= :at
+            ORDER BY created_at DESC, created_at_block DESC
+            LIMIT 1
+        ) last
+        WHERE pt.protocol_id = :protocol_id;
+    """)
+
+    async def calculate_history_by_protocol_id(
+        self,
+        protocol_id: int,
+        incremental: bool = False,
+    ) -> int:
+        """
+        Upserts TVL history of the protocol and moves its watermark to the
+        last processed block, then refreshes the latest TVL of the protocol
+        in `protocol_tvl` and its hour/day rollups. In incremental mode only
+        blocks after the current watermark are calculated and only buckets
+        from the one of the watermark are rebuilt. Returns number of upserted
+        rows.
+        """
+        from_block, from_created_at = -1, self.MIN_CREATED_AT
+        if incremental:
+            from_block, from_created_at = await self.get_watermark(
+                protocol_id
+            )
+
+        params = {
+            "protocol_id": protocol_id,
+            "from_block": from_block,
+            # lets history partitions before the watermark be pruned
+            "from_created_at": from_created_at,
+        }
+        with stats.phase("calculate_tvl") as phase:
+            result = await self.session.execute(
+                self.CALCULATE_HISTORY_SQL,
+                params,
+            )
+            await self.session.execute(self.UPDATE_WATERMARK_SQL, params)
+            await self.session.execute(
+                self.REFRESH_PROTOCOL_TVL_SQL,
+                {"protocol_id": protocol_id},
+            )
+            await self.refresh_rollups(protocol_id, from_created_at)
+            phase.rows += result.rowcount
+
+        return result.rowcount
+
+    async def update_watermark(
+        self,
+        protocol_id: int,
+        created_at_block: int,
+        created_at: dt.datetime,
+        from_created_at: dt.datetime | None = None,
+    ):
+        """
+        Moves the watermark of the protocol to the given block after its TVL
+        history was written without `calculate_history_by_protocol_id`, then
+        refreshes the latest TVL of the protocol in `protocol_tvl` and its
+        rollups from the bucket of `from_created_at`, the time of the first
+        written row (default: all rollups).
+        """
+        await self.session.execute(
+            self.SET_WATERMARK_SQL,
+            {
+                "protocol_id": protocol_id,
+                "created_at_block": created_at_block,
+                "created_at": created_at,
+            },
+        )
         await self.session.execute(
-            text(self.CALCULATE_HISTORY_SQL),
+            self.REFRESH_PROTOCOL_TVL_SQL,
             {"protocol_id": protocol_id},
         )
+        await self.refresh_rollups(
+            protocol_id,
+            from_created_at or self.MIN_CREATED_AT,
+        )
+
+    async def refresh_rollups(
+        self,
+        protocol_id: int,
+        from_created_at: dt.datetime = MIN_CREATED_AT,
+    ):
+        """Rebuilds hour and day buckets from the ones of `from_created_at`."""
+        params = {
+            "protocol_id": protocol_id,
+            "from_created_at": from_created_at,
+        }
+        with stats.phase("refresh_rollups"):
+            await self.session.execute(self.REFRESH_HOUR_ROLLUP_SQL, params)
+            await self.session.execute(self.REFRESH_DAY_ROLLUP_SQL, params)
+
+    async def get_history(
+        self,
+        protocol_id: int,
+        resolution: str,
+        start: dt.datetime,
+        end: dt.datetime,
+    ) -> list[Row]:
+        """
+        TVL of the protocol per bucket of `resolution` (hour or day) from
+        the bucket of `start` up to `end`.
+        """
+        result = await self.session.execute(
+            self.GET_HISTORY_SQL,
+            {
+                "protocol_id": protocol_id,
+                "resolution": resolution,
+                "start": start,
+                "end": end,
+            },
+        )
+        return result.all()
+
+    async def explain_calculate_history(
+        self,
+        protocol_id: int,
+        from_block: int = -1,
+        from_created_at: dt.datetime = MIN_CREATED_AT,
+    ) -> str:
+        result = await self.session.execute(
+            text(f"EXPLAIN {self.CALCULATE_HISTORY_SQL.text}"),
+            {
+                "protocol_id": protocol_id,
+                "from_block": from_block,
+                "from_created_at": from_created_at,
+            },
+        )
+        return "\n".join(result.scalars().all())
+
+    async def get_watermark(
+        self,
+        protocol_id: int,
+    ) -> tuple[int, dt.datetime]:
+        """Last processed block and its creation time of the protocol."""
+        result = await self.session.execute(
+            self.GET_WATERMARK_SQL,
+            {"protocol_id": protocol_id},
+        )
+        watermark = result.one_or_none()
+        if watermark is None:
+            return -1, self.MIN_CREATED_AT
+        return watermark.created_at_block, watermark.created_at
 
     async def get_current_protocol_price(
         self,
         protocol_id: int
     ) -> Decimal | None:
         result = await self.session.execute(
-            text(self.GET_CURRENT_PROTOCOL_PRICE_SQL),
+            self.GET_CURRENT_PROTOCOL_PRICE_SQL,
             {"protocol_id": protocol_id},
         )
         return result.one_or_none()
+
+    async def get_current_protocol_prices(
+        self,
+        protocol_ids: list[int],
+    ) -> dict[int, Decimal]:
+        """Current TVL of every found protocol, read with one query."""
+        result = await self.session.execute(
+            self.GET_CURRENT_PROTOCOL_PRICES_SQL,
+            {"protocol_ids": protocol_ids},
+        )
+        return {row.protocol_id: row.amount_usd for row in result}
+
+    async def get_protocol_price_at(
+        self,
+        protocol_id: int,
+        block: int | None = None,
+        at: dt.datetime | None = None,
+    ) -> Row | None:
+        """
+        TVL of the protocol from the last tick of every token at or before
+        `block` or `at`, with the latest block and time of those ticks. At
+        the latest block it equals the current TVL of the protocol if every
+        token has a row in that block.
+        """
+        if block is not None:
+            query, params = self.GET_PROTOCOL_PRICE_AT_BLOCK_SQL, {
+                "block": block,
+            }
+        else:
+            query, params = self.GET_PROTOCOL_PRICE_AT_SQL, {"at": at}
+
+        result = await self.session.execute(
+            query,
+            {"protocol_id": protocol_id, **params},
+        )
+        price = result.one()
+        return price if price.amount_usd is not None else None
+
+    async def get_top_protocols(self, limit: int) -> list[Row]:
+        """
+        Protocols with the highest current TVL, read from the
+        `protocol_tvl.amount_usd` index.
+        """
+        result = await self.session.execute(
+            self.GET_TOP_PROTOCOLS_SQL,
+            {"limit": limit},
+        )
+        return result.all()
@@ -1,5 +1,20 @@
+import shlex
+import sys
+
 from core.shell import protocol_generator_shell_handler
 
 
+def main(argv: list[str]) -> int:
+    """
+    Starts the interactive shell, or runs one command given as arguments:
+
+        python -m core.main get_current_deposit --protocol 1
+    """
+    if not argv:
+        protocol_generator_shell_handler.cmdloop()
+        return 0
+    return protocol_generator_shell_handler.run_once(shlex.join(argv))
+
+
 if __name__ == "__main__":
-    protocol_generator_shell_handler.cmdloop()
+    sys.exit(main(sys.argv[1:]))
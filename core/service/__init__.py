@@ -1,2 +1,36 @@
-from .generator import ProtocolDataGeneratorService
-from .price import ProtocolPriceService
+import importlib
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .generator import ProtocolDataGeneratorService
+    from .importer import ProtocolDataImportService
+    from .partition import PartitionService
+    from .price import ProtocolPriceService
+    from .price import protocol_price_cache
+    from .sink import DatabaseSink
+    from .sink import FileSink
+    from .sink import OutputSink
+    from .compaction import TokenPriceCompactionService
+    from .tvl import TVLHistoryService
+
+# services are imported on first access, so commands which only read from
+# the database do not import NumPy and PyArrow
+_MODULES = {
+    "ProtocolDataGeneratorService": ".generator",
+    "ProtocolDataImportService": ".importer",
+    "PartitionService": ".partition",
+    "ProtocolPriceService": ".price",
+    "protocol_price_cache": ".price",
+    "DatabaseSink": ".sink",
+    "FileSink": ".sink",
+    "OutputSink": ".sink",
+    "TokenPriceCompactionService": ".compaction",
+    "TVLHistoryService": ".tvl",
+}
+
+
+def __getattr__(name: str):
+    if name not in _MODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(_MODULES[name], __name__), name)
@@ -0,0 +1,120 @@
+import datetime as dt
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from typing import TYPE_CHECKING
+
+from core.db.repo import PartitionRepo
+from core.db.repo import TokenPriceRepo
+from core.stats import stats
+
+if TYPE_CHECKING:
+    from core.shell.model import CompactTokenPricesCommandOptions
+
+
+ARCHIVE_SCHEMA = pa.schema([
+    ("token_id", pa.int64()),
+    ("usd_price", pa.decimal128(38, 10)),
+    ("created_at", pa.timestamp("us", tz="UTC")),
+])
+
+
+def compaction_cutoff(now: dt.datetime, age: dt.timedelta) -> dt.datetime:
+    """
+    Start of the month (UTC) of the time `age` before `now`, the bound of
+    the monthly partitions which are compacted as a whole.
+    """
+    cutoff = (now - age).astimezone(dt.timezone.utc)
+    return cutoff.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+class TokenPriceCompactionService:
+    """
+    Keeps `token_price` bounded: ticks of months older than the compaction
+    age are rolled into hourly OHLC rows of `token_price_hourly` and their
+    partitions are dropped, optionally after being archived to a Parquet
+    file. Everything runs in the transaction of the session.
+    """
+
+    def __init__(
+        self,
+        token_price_repo: TokenPriceRepo,
+        partition_repo: PartitionRepo,
+    ):
+        self.token_price_repo = token_price_repo
+        self.partition_repo = partition_repo
+
+    async def compact(
+        self,
+        options: "CompactTokenPricesCommandOptions",
+    ) -> tuple[dt.datetime, int, list[str], int]:
+        """
+        Returns the cutoff, number of upserted buckets, names of dropped
+        partitions and number of ticks deleted outside of them.
+        """
+        now = dt.datetime.now(dt.timezone.utc)
+        before = compaction_cutoff(now, dt.timedelta(days=options.age))
+        if options.archive:
+            await self.archive(
+                before,
+                options.archive,
+                options.chunk,
+                archived_at=now,
+            )
+        buckets = await self.token_price_repo.compact_before(before)
+        dropped = await self.partition_repo.drop_partitions_before(
+            before,
+            tables=("token_price",),
+        )
+        # only finds rows of a table created before partitioning
+        deleted = await self.token_price_repo.delete_before(before)
+        return before, buckets, dropped, deleted
+
+    async def archive(
+        self,
+        before: dt.datetime,
+        directory: str,
+        batch_size: int,
+        archived_at: dt.datetime,
+    ) -> str:
+        """
+        Writes ticks created before `before` to a new Parquet file named
+        after the cutoff and the time of the run. Runs with the same cutoff
+        (e.g. twice in a month) get files of their own and an existing file
+        is never overwritten, since its ticks may already be dropped.
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(
+            directory,
+            f"token_price_before_{before:%Y%m%dT%H%M}"
+            f"_at_{archived_at:%Y%m%dT%H%M%S%f}.parquet",
+        )
+        with (
+            open(path, "xb") as file,
+            pq.ParquetWriter(file, ARCHIVE_SCHEMA) as writer,
+        ):
+            async for batch in self.token_price_repo.iter_ticks_before(
+                before,
+                batch_size,
+            ):
+                with stats.phase("archive_token_prices") as phase:
+                    writer.write_batch(pa.RecordBatch.from_arrays(
+                        [
+                            pa.array(
+                                [row.token_id for row in batch],
+                                type=ARCHIVE_SCHEMA.field("token_id").type,
+                            ),
+                            pa.array(
+                                [row.usd_price for row in batch],
+                                type=ARCHIVE_SCHEMA.field("usd_price").type,
+                            ),
+                            pa.array(
+                                [row.created_at for row in batch],
+                                type=ARCHIVE_SCHEMA.field("created_at").type,
+                            ),
+                        ],
+                        schema=ARCHIVE_SCHEMA,
+                    ))
+                    phase.rows += len(batch)
+        return path
@@ -0,0 +1,408 @@
+import datetime as dt
+import functools
+import math
+import numpy as np
+
+from decimal import Decimal
+from typing import Any
+from typing import Callable
+from typing import ClassVar
+from typing import Iterator
+from typing import Sequence
+
+
+BLOCK_INTERVAL = dt.timedelta(hours=1)
+PRICE_TICK_INTERVAL = dt.timedelta(minutes=10)
+PRICE_DECIMALS = 10
+
+
+def _to_decimal(values: np.ndarray) -> list[Decimal]:
+    if values.dtype.kind == "f":
+        values = np.round(values, PRICE_DECIMALS).astype(str)
+    return list(map(Decimal, values.tolist()))
+
+
+class ColumnarFrame:
+    """
+    Table data kept as one NumPy array per column. Rows are only
+    materialized as tuples by `records`, right before they are written.
+    """
+    table_name: ClassVar[str]
+    columns: ClassVar[tuple[str, ...]]
+    converters: ClassVar[dict[str, Callable[[np.ndarray], list[Any]]]] = {}
+
+    def __init__(self, **arrays: np.ndarray):
+        for column in self.columns:
+            setattr(self, column, arrays[column])
+
+    def __len__(self) -> int:
+        return len(getattr(self, self.columns[0]))
+
+    def column_values(self, column: str) -> list[Any]:
+        values: np.ndarray = getattr(self, column)
+        converter = self.converters.get(column)
+        return converter(values) if converter else values.tolist()
+
+    def records(self) -> Iterator[tuple[Any, ...]]:
+        return zip(*(self.column_values(column) for column in self.columns))
+
+
+class BalanceHistoryFrame(ColumnarFrame):
+    table_name = "account_balance_history"
+    columns = (
+        "protocol_token_id",
+        "account_id",
+        "amount",
+        "created_at",
+        "created_at_block",
+    )
+    converters = {"amount": _to_decimal}
+
+
+class TokenPriceFrame(ColumnarFrame):
+    table_name = "token_price"
+    columns = ("token_id", "usd_price", "created_at")
+    converters = {"usd_price": _to_decimal}
+
+
+class TVLHistoryFrame(ColumnarFrame):
+    table_name = "tvl_history"
+    columns = (
+        "protocol_token_id",
+        "created_at_block",
+        "amount",
+        "amount_usd",
+        "created_at",
+    )
+    converters = {"amount": _to_decimal, "amount_usd": _to_decimal}
+
+
+def final_block_number(start: dt.datetime, end: dt.datetime) -> int:
+    return math.ceil((end - start) / BLOCK_INTERVAL)
+
+
+def price_ticks_number(start: dt.datetime, end: dt.datetime) -> int:
+    return math.ceil((end - start) / PRICE_TICK_INTERVAL)
+
+
+class ColumnarGenerationEngine:
+    """
+    Builds balance history and token prices in batched NumPy operations.
+
+    Blocks are hourly and numbered from 0 at `start` up to the final block
+    at `end`. On the final block every account holds `final_token_amount`
+    of its tokens, on every other block a random 5% of accounts change
+    their balance. Prices tick every 10 minutes backwards from `end`,
+    where the price is exactly `final_token_price`.
+
+    The `iter_*_jobs` methods split a table into jobs producing frames of at
+    most `chunk_size` rows (but never less than one block or one slice of
+    accounts or ticks), so memory use depends on the chunk size and not on
+    the size of the dataset. Jobs can run in other processes.
+
+    Random streams are derived from `seed` per block, per slice of accounts
+    on the final block and per slice of ticks of a token, so the generated
+    data only depends on the seed, not on the chunk size or on how jobs are
+    spread over processes.
+    """
+    changing_accounts_share = 0.05
+    max_deviation_percent = 15
+
+    accounts_per_slice = 1024
+    ticks_per_slice = 1024
+
+    BALANCE_STREAM = 0
+    FINAL_BALANCE_STREAM = 1
+    PRICE_STREAM = 2
+
+    def __init__(self, seed: int | None = None):
+        self.seed = np.random.SeedSequence(seed).entropy
+
+    def changing_accounts_number(self, accounts_number: int) -> int:
+        return math.ceil(accounts_number * self.changing_accounts_share)
+
+    def iter_balance_history(self, **kwargs) -> Iterator[BalanceHistoryFrame]:
+        for job in self.iter_balance_history_jobs(**kwargs):
+            yield job()
+
+    def iter_balance_history_jobs(
+        self,
+        protocol_token_ids: np.ndarray,
+        account_ids: np.ndarray,
+        tokens_per_account: int,
+        final_token_amount: int,
+        start: dt.datetime,
+        end: dt.datetime,
+        chunk_size: int,
+    ) -> Iterator[Callable[[], BalanceHistoryFrame]]:
+        final_block = final_block_number(start, end)
+        rows_per_block = (
+            self.changing_accounts_number(len(account_ids))
+            * tokens_per_account
+        )
+        blocks_per_chunk = max(1, chunk_size // rows_per_block)
+        for first_block in range(0, final_block, blocks_per_chunk):
+            yield functools.partial(
+                self.balance_history,
+                protocol_token_ids=protocol_token_ids,
+                account_ids=account_ids,
+                tokens_per_account=tokens_per_account,
+                final_token_amount=final_token_amount,
+                start=start,
+                end=end,
+                blocks=range(
+                    first_block,
+                    min(first_block + blocks_per_chunk, final_block),
+                ),
+            )
+
+        accounts_per_chunk = self.accounts_per_slice * max(
+            1,
+            chunk_size // (tokens_per_account * self.accounts_per_slice),
+        )
+        for first_account in range(0, len(account_ids), accounts_per_chunk):
+            yield functools.partial(
+                self.final_balance_history,
+                protocol_token_ids=protocol_token_ids,
+                account_ids=account_ids[
+                    first_account:first_account + accounts_per_chunk
+                ],
+                first_account=first_account,
+                tokens_per_account=tokens_per_account,
+                final_token_amount=final_token_amount,
+                start=start,
+                end=end,
+            )
+
+    def balance_history(
+        self,
+        protocol_token_ids: np.ndarray,
+        account_ids: np.ndarray,
+        tokens_per_account: int,
+        final_token_amount: int,
+        start: dt.datetime,
+        end: dt.datetime,
+        blocks: range,
+    ) -> BalanceHistoryFrame:
+        """Balance changes of a random 5% of accounts on each of `blocks`."""
+        final_block = final_block_number(start, end)
+        changing_accounts_number = self.changing_accounts_number(
+            len(account_ids)
+        )
+
+        account_index, block_amount, token_index = [], [], []
+        for block in blocks:
+            rng = self._rng(self.BALANCE_STREAM, block)
+            account_index.append(rng.choice(
+                len(account_ids),
+                changing_accounts_number,
+                replace=False,
+            ))
+            block_amount.append(
+                final_token_amount
+                * (100 - self._deviation(rng, 1))
+                // 100
+            )
+            token_index.append(self._sample_without_replacement(
+                rng=rng,
+                population=len(protocol_token_ids),
+                k=tokens_per_account,
+                size=changing_accounts_number,
+            ))
+
+        block_number = np.repeat(
+            np.arange(blocks.start, blocks.stop),
+            changing_accounts_number,
+        )
+        block_created_at = np.array(
+            [
+                end - (final_block - block) * BLOCK_INTERVAL
+                for block in blocks
+            ],
+            dtype=object,
+        )
+
+        return self._balance_history_frame(
+            protocol_token_ids=protocol_token_ids,
+            token_index=np.concatenate(token_index),
+            account_ids=account_ids[np.concatenate(account_index)],
+            amount=np.concatenate(block_amount)[block_number - blocks.start],
+            created_at=block_created_at[block_number - blocks.start],
+            created_at_block=block_number,
+        )
+
+    def final_balance_history(
+        self,
+        protocol_token_ids: np.ndarray,
+        account_ids: np.ndarray,
+        first_account: int,
+        tokens_per_account: int,
+        final_token_amount: int,
+        start: dt.datetime,
+        end: dt.datetime,
+    ) -> BalanceHistoryFrame:
+        """
+        Final balances of `account_ids` on the block at `end`.
+        `first_account` is the index of the first of them among all accounts
+        and has to be the first account of a slice.
+        """
+        first_slice = first_account // self.accounts_per_slice
+        token_index = np.concatenate([
+            self._sample_without_replacement(
+                rng=self._rng(self.FINAL_BALANCE_STREAM, first_slice + i),
+                population=len(protocol_token_ids),
+                k=tokens_per_account,
+                size=len(accounts_slice),
+            )
+            for i, accounts_slice in enumerate(
+                self._slices(account_ids, self.accounts_per_slice)
+            )
+        ])
+
+        rows_number = len(account_ids)
+        return self._balance_history_frame(
+            protocol_token_ids=protocol_token_ids,
+            token_index=token_index,
+            account_ids=account_ids,
+            amount=np.full(rows_number, final_token_amount),
+            created_at=np.full(rows_number, end, dtype=object),
+            created_at_block=np.full(
+                rows_number,
+                final_block_number(start, end),
+            ),
+        )
+
+    @staticmethod
+    def _balance_history_frame(
+        protocol_token_ids: np.ndarray,
+        token_index: np.ndarray,
+        account_ids: np.ndarray,
+        amount: np.ndarray,
+        created_at: np.ndarray,
+        created_at_block: np.ndarray,
+    ) -> BalanceHistoryFrame:
+        tokens_per_account = token_index.shape[1]
+        return BalanceHistoryFrame(
+            protocol_token_id=protocol_token_ids[token_index.ravel()],
+            account_id=np.repeat(account_ids, tokens_per_account),
+            amount=np.repeat(amount, tokens_per_account),
+            created_at=np.repeat(created_at, tokens_per_account),
+            created_at_block=np.repeat(created_at_block, tokens_per_account),
+        )
+
+    def iter_token_prices(self, **kwargs) -> Iterator[TokenPriceFrame]:
+        for job in self.iter_token_prices_jobs(**kwargs):
+            yield job()
+
+    def iter_token_prices_jobs(
+        self,
+        token_ids: np.ndarray,
+        final_token_price: float,
+        start: dt.datetime,
+        end: dt.datetime,
+        chunk_size: int,
+    ) -> Iterator[Callable[[], TokenPriceFrame]]:
+        ticks_number = price_ticks_number(start, end)
+        if ticks_number == 0:
+            # `start == end` gives no ticks, as in the row by row generation
+            return
+        ticks_per_chunk = min(
+            ticks_number,
+            self.ticks_per_slice * max(1, chunk_size // self.ticks_per_slice),
+        )
+        tokens_per_chunk = max(1, chunk_size // ticks_number)
+        for first_token in range(0, len(token_ids), tokens_per_chunk):
+            for first_tick in range(0, ticks_number, ticks_per_chunk):
+                yield functools.partial(
+                    self.token_prices,
+                    token_ids=token_ids[
+                        first_token:first_token + tokens_per_chunk
+                    ],
+                    first_token=first_token,
+                    final_token_price=final_token_price,
+                    ticks=range(
+                        first_tick,
+                        min(first_tick + ticks_per_chunk, ticks_number),
+                    ),
+                    end=end,
+                )
+
+    def token_prices(
+        self,
+        token_ids: np.ndarray,
+        first_token: int,
+        final_token_price: float,
+        ticks: range,
+        end: dt.datetime,
+    ) -> TokenPriceFrame:
+        """
+        Prices of `token_ids` on `ticks` counted backwards from `end`.
+        `first_token` is the index of the first of them among all tokens,
+        `ticks` has to start with the first tick of a slice.
+        """
+        first_slice = ticks.start // self.ticks_per_slice
+        usd_price = final_token_price * np.stack([
+            np.concatenate([
+                (
+                    100
+                    - self._deviation(
+                        self._rng(self.PRICE_STREAM, token, first_slice + i),
+                        len(ticks_slice),
+                    )
+                ) / 100
+                for i, ticks_slice in enumerate(
+                    self._slices(ticks, self.ticks_per_slice)
+                )
+            ])
+            for token in range(first_token, first_token + len(token_ids))
+        ])
+        if ticks.start == 0:
+            usd_price[:, 0] = final_token_price
+        tick_created_at = np.array(
+            [end - tick * PRICE_TICK_INTERVAL for tick in ticks],
+            dtype=object,
+        )
+
+        return TokenPriceFrame(
+            token_id=np.repeat(token_ids, len(ticks)),
+            usd_price=usd_price.ravel(),
+            created_at=np.tile(tick_created_at, len(token_ids)),
+        )
+
+    def _rng(self, *stream: int) -> np.random.Generator:
+        return np.random.default_rng(
+            np.random.SeedSequence(self.seed, spawn_key=stream)
+        )
+
+    @staticmethod
+    def _slices(values: Sequence, size: int) -> Iterator[Sequence]:
+        for first in range(0, len(values), size):
+            yield values[first:first + size]
+
+    def _deviation(
+        self,
+        rng: np.random.Generator,
+        size: int | tuple[int, ...],
+    ) -> np.ndarray:
+        return rng.integers(
+            -self.max_deviation_percent,
+            self.max_deviation_percent,
+            size=size,
+            endpoint=True,
+        )
+
+    @staticmethod
+    def _sample_without_replacement(
+        rng: np.random.Generator,
+        population: int,
+        k: int,
+        size: int,
+    ) -> np.ndarray:
+        """Draws `size` independent samples of `k` distinct indices."""
+        if k == 1:
+            return rng.integers(population, size=(size, 1))
+        return np.argpartition(
+            rng.random((size, population)),
+            k - 1,
+            axis=1,
+        )[:, :k]
@@ -1,21 +1,31 @@
+import asyncio
+import collections
 import datetime as dt
+import itertools
 import math
+import numpy as np
 import random
 import secrets
 import string
 
-from decimal import Decimal
+from concurrent.futures import Executor
+from typing import AsyncIterator
+from typing import Awaitable
+from typing import Callable
+from typing import Iterator
 from typing import TYPE_CHECKING
 
 from core.db.model import Account
-from core.db.model import AccountBalanceHistory
+from core.db.model import GenerationProgress
 from core.db.model import Protocol
-from core.db.model import ProtocolToken
 from core.db.model import Token
-from core.db.model import TokenPrice
-from core.db.repo import BaseRepo
-from core.db.repo import ProtocolTokenRepo
-from core.db.repo import TVLHistoryRepo
+from core.stats import stats
+
+from .engine import ColumnarFrame
+from .engine import ColumnarGenerationEngine
+from .engine import TVLHistoryFrame
+from .sink import OutputSink
+from .tvl_engine import ColumnarTVLEngine
 
 if TYPE_CHECKING:
     from core.shell.model import GenerateProtocolDataCommandOptions
@@ -24,39 +34,157 @@ if TYPE_CHECKING:
 class ProtocolDataGeneratorService:
     def __init__(
         self,
-        base_repo: BaseRepo,
-        protocol_token_repo: ProtocolTokenRepo,
-        tvl_history_repo: TVLHistoryRepo,
+        sink: OutputSink,
+        executor: Executor | None = None,
+        shards: int = 1,
+        seed: int | None = None,
     ):
-        self.base_repo = base_repo
-        self.protocol_token_repo = protocol_token_repo
-        self.tvl_history_repo = tvl_history_repo
-        self.token_number = random.randint(10, 50)
+        self.sink = sink
+        self.executor = executor
+        self.shards = shards
+        # everything generated is derived from the seed, so a protocol can
+        # be regenerated bit for bit by passing the printed seed back
+        self.seed = secrets.randbits(63) if seed is None else seed
+        self.random = random.Random(self.seed)
+        self.token_number = self.random.randint(10, 50)
+        self.engine = ColumnarGenerationEngine(self.seed)
+        self.rows_written = 0
 
     async def generate_all(
         self,
         options: "GenerateProtocolDataCommandOptions",
     ) -> int:
+        await self.sink.open(start=options.start, end=options.end)
         protocol = await self.generate_protocol_with_tokens()
-        await self.base_repo.add_all([protocol], with_commit=True)
+        await self.sink.write_protocol(protocol)
 
-        accounts = await self.generate_accounts(options.accounts)
-        token_prices = await self.generate_balance_history_and_token_price(
+        account_ids = account_pool_max_id = None
+        if options.account_pool:
+            account_ids, account_pool_max_id = await self.sample_accounts(
+                accounts_number=options.accounts,
+            )
+        await self.sink.start_progress(GenerationProgress(
+            protocol_id=protocol.id,
+            seed=self.seed,
+            accounts=options.accounts,
+            start=options.start,
+            end=options.end,
+            deposit=options.deposit,
+            chunk=options.chunk,
+            tvl=options.tvl,
+            account_pool_max_id=account_pool_max_id,
+        ))
+
+        if account_ids is None:
+            account_ids = await self.generate_and_write_accounts(
+                accounts_number=options.accounts,
+                chunk_size=options.chunk,
+            )
+        await self.generate_and_write_history(
             protocol=protocol,
-            accounts=accounts,
+            account_ids=account_ids,
             start=options.start,
             end=options.end,
             deposit=options.deposit,
+            chunk_size=options.chunk,
+            tvl=options.tvl,
         )
 
-        await self.base_repo.add_all(accounts, with_commit=True)
-        await self.base_repo.add_all(token_prices, with_commit=True)
-        await self.tvl_history_repo.calculate_history_by_protocol_id(
-            protocol_id=protocol.id,
+        return protocol.id
+
+    async def resume_all(self, progress: GenerationProgress) -> int:
+        """
+        Continues an interrupted generation after its last committed job.
+        The service has to be created with the seed of the generation:
+        protocol, tokens and accounts are generated again and matched to the
+        written rows, accounts which were not written yet are written.
+        """
+        await self.sink.open(start=progress.start, end=progress.end)
+        protocol = await self.generate_protocol_with_tokens()
+        await self.sink.restore_protocol(protocol, progress.protocol_id)
+
+        if progress.account_pool_max_id is not None:
+            account_ids, _ = await self.sample_accounts(
+                accounts_number=progress.accounts,
+                max_id=progress.account_pool_max_id,
+            )
+        else:
+            account_ids = await self.generate_and_write_accounts(
+                accounts_number=progress.accounts,
+                chunk_size=progress.chunk,
+                restore=True,
+            )
+        await self.generate_and_write_history(
+            protocol=protocol,
+            account_ids=account_ids,
+            start=progress.start,
+            end=progress.end,
+            deposit=progress.deposit,
+            chunk_size=progress.chunk,
+            tvl=progress.tvl,
+            first_job=progress.committed_jobs,
         )
 
         return protocol.id
 
+    async def generate_and_write_history(
+        self,
+        protocol: Protocol,
+        account_ids: np.ndarray,
+        start: dt.datetime,
+        end: dt.datetime,
+        deposit: float,
+        chunk_size: int,
+        tvl: str,
+        first_job: int = 0,
+    ):
+        """
+        Writes balance history and token prices from job `first_job` on,
+        saving progress after every job, then TVL history. Frames of
+        skipped jobs are not generated again, so TVL history of a resumed
+        generation is calculated with SQL.
+        """
+        tvl_engine = None
+        if tvl == "numpy" and first_job == 0:
+            tvl_engine = ColumnarTVLEngine(
+                *await self.sink.get_protocol_tokens(protocol),
+                start=start,
+                end=end,
+            )
+
+        committed_jobs = first_job
+        async for frame in self.generate_balance_history_and_token_price(
+            protocol=protocol,
+            account_ids=account_ids,
+            start=start,
+            end=end,
+            deposit=deposit,
+            chunk_size=chunk_size,
+            first_job=first_job,
+        ):
+            await self._write_frame(frame)
+            if tvl_engine is not None:
+                await self.write_tvl_history(tvl_engine.add_frame(frame))
+            committed_jobs += 1
+            await self.sink.save_progress(protocol.id, committed_jobs)
+
+        # without balances there is no watermark and TVL falls back to SQL
+        await self.sink.close(
+            protocol_id=protocol.id,
+            tvl_watermark=(
+                None if tvl_engine is None else tvl_engine.watermark()
+            ),
+        )
+
+    async def write_tvl_history(self, frames: Iterator[TVLHistoryFrame]):
+        while True:
+            with stats.phase("calculate_tvl") as phase:
+                frame = next(frames, None)
+                if frame is None:
+                    break
+                phase.rows += len(frame)
+            await self._write_frame(frame)
+
     async def generate_protocol_with_tokens(self) -> Protocol:
         protocol = Protocol(name=self.generate_name())
 
@@ -65,166 +193,153 @@ class ProtocolDataGeneratorService:
             token = Token(
                 name=self.generate_name(4, 7),
                 symbol=self.generate_name(3, 4).upper(),
-                decimals=random.randint(1, 20),
+                decimals=self.random.randint(1, 20),
             )
             protocol.tokens.append(token)
 
         return protocol
 
-    @staticmethod
-    async def generate_accounts(accounts_number: int) -> list[Account]:
+    async def generate_accounts(self, accounts_number: int) -> list[Account]:
         accounts = [
-            Account(wallet_address=secrets.token_hex(20))
+            Account(wallet_address=self.random.randbytes(20).hex())
             for _ in range(accounts_number)
         ]
         return accounts
 
+    async def sample_accounts(
+        self,
+        accounts_number: int,
+        max_id: int | None = None,
+    ) -> tuple[np.ndarray, int]:
+        """
+        Draws accounts from the pool of existing ones instead of generating
+        new ones. Returns their ids and the last id of the pool.
+        """
+        with stats.phase("sample_accounts") as phase:
+            account_ids, max_id = await self.sink.sample_accounts(
+                accounts_number=accounts_number,
+                rng=np.random.default_rng(self.random.getrandbits(64)),
+                max_id=max_id,
+            )
+            phase.rows += len(account_ids)
+        return account_ids, max_id
+
+    async def generate_and_write_accounts(
+        self,
+        accounts_number: int,
+        chunk_size: int,
+        restore: bool = False,
+    ) -> np.ndarray:
+        """
+        With `restore` accounts written by an interrupted generation are
+        looked up instead of being written again.
+        """
+        write_accounts = (
+            self.sink.restore_accounts if restore else self.sink.write_accounts
+        )
+        account_ids = np.empty(accounts_number, dtype=np.int64)
+        for first in range(0, accounts_number, chunk_size):
+            with stats.phase("generate_accounts") as phase:
+                accounts = await self.generate_accounts(
+                    min(chunk_size, accounts_number - first)
+                )
+                phase.rows += len(accounts)
+            account_ids[first:first + len(accounts)] = (
+                await write_accounts(accounts)
+            )
+        return account_ids
+
     async def generate_balance_history_and_token_price(
         self,
         protocol: Protocol,
-        accounts: list[Account],
+        account_ids: np.ndarray,
         start: dt.datetime,
         end: dt.datetime,
         deposit: float,
-    ) -> list[TokenPrice]:
+        chunk_size: int,
+        first_job: int = 0,
+    ) -> AsyncIterator[ColumnarFrame]:
+        """
+        Yields one frame per generation job, starting from job `first_job`.
+        Jobs only depend on the seed and the arguments, so the same
+        arguments give the same jobs in the same order.
+        """
         number_of_tokens_per_account = math.ceil(0.02 * self.token_number)
         final_token_amount = 100
         final_token_price = deposit / (
-            len(accounts)
+            len(account_ids)
             * number_of_tokens_per_account
             * final_token_amount
         )
 
-        await self._generate_balance_history(
-            protocol=protocol,
-            accounts=accounts,
-            number_of_tokens_per_account=number_of_tokens_per_account,
-            final_token_amount=Decimal(final_token_amount),
+        protocol_token_ids, _ = await self.sink.get_protocol_tokens(protocol)
+
+        balance_history_jobs = self.engine.iter_balance_history_jobs(
+            protocol_token_ids=protocol_token_ids,
+            account_ids=account_ids,
+            tokens_per_account=number_of_tokens_per_account,
+            final_token_amount=final_token_amount,
             start=start,
             end=end,
+            chunk_size=chunk_size,
         )
-
-        tokens_prices = await self._generate_tokens_prices(
-            protocol=protocol,
-            final_token_price=Decimal(final_token_price),
+        token_prices_jobs = self.engine.iter_token_prices_jobs(
+            token_ids=np.array([token.id for token in protocol.tokens]),
+            final_token_price=final_token_price,
             start=start,
             end=end,
+            chunk_size=chunk_size,
         )
 
-        return tokens_prices
-
-    async def _generate_balance_history(
-        self,
-        protocol: Protocol,
-        accounts: list[Account],
-        number_of_tokens_per_account: int,
-        final_token_amount: Decimal,
-        start: dt.datetime,
-        end: dt.datetime,
-    ):
-        final_created_at_block = math.ceil(
-            (end - start).total_seconds() / 3600
-        )
-        number_of_changing_accounts = math.ceil(len(accounts) * 0.05)
-
-        protocol_token_list = await (
-            self.protocol_token_repo.get_protocol_token_by_protocol_id(
-                protocol_id=protocol.id
-            )
-        )
-
-        await self._generate_account_token_balance(
-            protocol_token_list=protocol_token_list,
-            accounts=accounts,
-            number_of_tokens_per_account=number_of_tokens_per_account,
-            token_amount=final_token_amount,
-            created_at=end,
-            created_at_block=final_created_at_block,
+        jobs = itertools.islice(
+            itertools.chain(balance_history_jobs, token_prices_jobs),
+            first_job,
+            None,
         )
+        async for frame in self._run_jobs(jobs):
+            yield frame
 
-        for current_block in reversed(range(final_created_at_block)):
-            token_amount = (
-                final_token_amount
-                * (100 - random.randint(-15, 15))
-                / 100
-            )
-            created_at = end - dt.timedelta(
-                seconds=(final_created_at_block - current_block) * 3600
-            )
-
-            await self._generate_account_token_balance(
-                protocol_token_list=protocol_token_list,
-                accounts=random.sample(
-                    accounts,
-                    number_of_changing_accounts,
-                ),
-                number_of_tokens_per_account=number_of_tokens_per_account,
-                token_amount=token_amount,
-                created_at=created_at,
-                created_at_block=current_block,
-            )
+    async def _run_jobs(
+        self,
+        jobs: Iterator[Callable[[], ColumnarFrame]],
+    ) -> AsyncIterator[ColumnarFrame]:
+        """
+        Runs generation jobs and yields their frames in job order. With an
+        executor up to `shards` jobs run ahead while the caller writes the
+        current frame, so at most `shards + 1` frames are held in memory.
+        Jobs carry their own random streams, so the frames do not depend
+        on the number of shards.
+        """
+        if self.executor is None:
+            for job in jobs:
+                with stats.phase("generate") as phase:
+                    frame = job()
+                    phase.rows += len(frame)
+                yield frame
+            return
 
-    @staticmethod
-    async def _generate_account_token_balance(
-        protocol_token_list: list[ProtocolToken],
-        accounts: list[Account],
-        number_of_tokens_per_account: int,
-        token_amount: Decimal,
-        created_at: dt.datetime,
-        created_at_block: int,
-    ):
-        for account in accounts:
-            account.balance_history = account.balance_history or []
-
-            for protocol_token in random.sample(
-                protocol_token_list,
-                number_of_tokens_per_account,
-            ):
-                protocol_token: ProtocolToken
-                account.balance_history.append(
-                    AccountBalanceHistory(
-                        protocol_token_id=protocol_token.id,
-                        amount=token_amount,
-                        created_at=created_at,
-                        created_at_block=created_at_block,
-                    )
-                )
+        loop = asyncio.get_running_loop()
+        pending = collections.deque()
+        for job in jobs:
+            pending.append(loop.run_in_executor(self.executor, job))
+            if len(pending) > self.shards:
+                yield await self._wait_frame(pending.popleft())
+        while pending:
+            yield await self._wait_frame(pending.popleft())
 
     @staticmethod
-    async def _generate_tokens_prices(
-        protocol: Protocol,
-        final_token_price: Decimal,
-        start: dt.datetime,
-        end: dt.datetime,
-    ) -> list[TokenPrice]:
-        tokens_prices: list[TokenPrice] = []
-        tick_in_minutes = 10
-        segments_number = math.ceil(
-            (end - start).total_seconds()
-            / (60 * tick_in_minutes)
-        )
+    async def _wait_frame(future: Awaitable[ColumnarFrame]) -> ColumnarFrame:
+        # only the time the writer is blocked on generation is measured
+        with stats.phase("generate") as phase:
+            frame = await future
+            phase.rows += len(frame)
+        return frame
 
-        for token in protocol.tokens:
-            for delta in range(segments_number):
-                created_at = end - dt.timedelta(
-                    minutes=delta * tick_in_minutes
-                )
-                usd_price = (
-                    final_token_price
-                    * (100 - random.randint(-15, 15))
-                    / 100
-                )
-                tokens_prices.append(
-                    TokenPrice(
-                        token_id=token.id,
-                        usd_price=usd_price if delta else final_token_price,
-                        created_at=created_at,
-                    )
-                )
-        return tokens_prices
+    async def _write_frame(self, frame: ColumnarFrame):
+        await self.sink.write_frame(frame)
+        self.rows_written += len(frame)
 
-    @staticmethod
-    def generate_name(from_k: int = 5, to_k: int = 5) -> str:
-        name_len = random.choice(range(from_k, to_k + 1))
-        name_letters = random.choices(string.ascii_letters, k=name_len)
+    def generate_name(self, from_k: int = 5, to_k: int = 5) -> str:
+        name_len = self.random.choice(range(from_k, to_k + 1))
+        name_letters = self.random.choices(string.ascii_letters, k=name_len)
         return "".join(name_letters)
@@ -0,0 +1,193 @@
+import datetime as dt
+import numpy as np
+import pyarrow as pa
+
+from typing import TYPE_CHECKING
+
+from core.db.repo import BulkRepo
+from core.db.repo import PartitionRepo
+from core.db.repo import ProtocolTokenRepo
+from core.db.repo import TVLHistoryRepo
+from core.stats import stats
+
+from .engine import BalanceHistoryFrame
+from .engine import ColumnarFrame
+from .engine import TVLHistoryFrame
+from .engine import TokenPriceFrame
+from .sink import AccountFrame
+from .sink import ProtocolFrame
+from .sink import ProtocolTokenFrame
+from .sink import TokenFrame
+from .sink import iter_table_batches
+
+if TYPE_CHECKING:
+    from core.shell.model import ImportProtocolDataCommandOptions
+
+
+# tables are imported in this order, so referenced ids are already mapped
+FRAMES: tuple[type[ColumnarFrame], ...] = (
+    ProtocolFrame,
+    TokenFrame,
+    ProtocolTokenFrame,
+    AccountFrame,
+    BalanceHistoryFrame,
+    TokenPriceFrame,
+    TVLHistoryFrame,
+)
+
+FOREIGN_KEYS = {
+    "protocol_token": {"protocol_id": "protocol", "token_id": "token"},
+    "account_balance_history": {
+        "protocol_token_id": "protocol_token",
+        "account_id": "account",
+    },
+    "token_price": {"token_id": "token"},
+    "tvl_history": {"protocol_token_id": "protocol_token"},
+}
+
+
+def _to_numpy(column: pa.Array) -> np.ndarray:
+    if pa.types.is_timestamp(column.type):
+        return np.array(column.to_pylist(), dtype=object)
+    return column.to_numpy(zero_copy_only=False)
+
+
+class ProtocolDataImportService:
+    """
+    Loads a protocol exported by `FileSink` with COPY. File ids are
+    replaced by ids reserved from the table sequences, so an export can be
+    imported into any database next to existing protocols. Names of the
+    protocol and its tokens are unique, so an export is imported once per
+    database.
+    """
+
+    def __init__(
+        self,
+        bulk_repo: BulkRepo,
+        tvl_history_repo: TVLHistoryRepo,
+        partition_repo: PartitionRepo,
+        protocol_token_repo: ProtocolTokenRepo,
+    ):
+        self.bulk_repo = bulk_repo
+        self.tvl_history_repo = tvl_history_repo
+        self.partition_repo = partition_repo
+        self.protocol_token_repo = protocol_token_repo
+        # file id -> database id of every table with an `id` column
+        self.id_maps: dict[str, np.ndarray] = {}
+        self.rows_by_table: dict[str, int] = {}
+        self.tvl_watermark: tuple[int, dt.datetime] | None = None
+        self.first_created_at: dt.datetime | None = None
+        self.rows_written = 0
+
+    async def import_all(
+        self,
+        options: "ImportProtocolDataCommandOptions",
+    ) -> int:
+        await self.check_names(options.path)
+        for frame_class in FRAMES:
+            await self.import_table(frame_class, options.path, options.chunk)
+        await self.bulk_repo.commit()
+
+        protocol_id = int(self.id_maps["protocol"][1])
+        if self.rows_by_table.get(TVLHistoryFrame.table_name):
+            await self.tvl_history_repo.update_watermark(
+                protocol_id,
+                *self.tvl_watermark,
+                from_created_at=self.first_created_at,
+            )
+        else:
+            await self.tvl_history_repo.calculate_history_by_protocol_id(
+                protocol_id=protocol_id,
+            )
+        return protocol_id
+
+    async def check_names(self, directory: str):
+        """Fails before anything is written if the export was imported."""
+        protocol, = iter_table_batches(directory, "protocol", 1)
+        tokens = pa.Table.from_batches(list(
+            iter_table_batches(directory, "token", 1000)
+        ))
+        existing = await self.protocol_token_repo.get_existing_names(
+            protocol_name=protocol.column("name")[0].as_py(),
+            token_names=tokens.column("name").to_pylist(),
+            token_symbols=tokens.column("symbol").to_pylist(),
+        )
+        if existing:
+            raise ValueError(
+                f"{', '.join(existing)} already exist. The export was "
+                f"already imported into this database."
+            )
+
+    async def import_table(
+        self,
+        frame_class: type[ColumnarFrame],
+        directory: str,
+        batch_size: int,
+    ):
+        table_name = frame_class.table_name
+        file_ids, database_ids = [], []
+        batches = iter_table_batches(directory, table_name, batch_size)
+        while True:
+            with stats.phase(f"read.{table_name}") as phase:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                phase.rows += batch.num_rows
+
+            frame = frame_class(**{
+                column: _to_numpy(batch.column(column))
+                for column in frame_class.columns
+            })
+            for column, referenced in FOREIGN_KEYS.get(table_name, {}).items():
+                setattr(
+                    frame,
+                    column,
+                    self.id_maps[referenced][getattr(frame, column)],
+                )
+            if "id" in frame.columns:
+                file_ids.append(frame.id)
+                frame.id = np.array(
+                    await self.bulk_repo.reserve_ids(table_name, len(frame)),
+                    dtype=np.int64,
+                )
+                database_ids.append(frame.id)
+            if isinstance(frame, BalanceHistoryFrame):
+                self._move_tvl_watermark(frame)
+            if "created_at" in frame.columns:
+                await self.partition_repo.ensure_partitions(
+                    start=min(frame.created_at),
+                    end=max(frame.created_at),
+                )
+
+            await self.bulk_repo.copy_records(
+                table_name=table_name,
+                columns=frame.columns,
+                records=frame.records(),
+            )
+            self.rows_by_table[table_name] = (
+                self.rows_by_table.get(table_name, 0) + len(frame)
+            )
+            self.rows_written += len(frame)
+
+        if file_ids:
+            file_ids = np.concatenate(file_ids)
+            id_map = np.zeros(file_ids.max() + 1, dtype=np.int64)
+            id_map[file_ids] = np.concatenate(database_ids)
+            self.id_maps[table_name] = id_map
+
+    def _move_tvl_watermark(self, frame: BalanceHistoryFrame):
+        # exported TVL history covers all exported blocks
+        last = int(np.argmax(frame.created_at_block))
+        watermark = (
+            int(frame.created_at_block[last]),
+            frame.created_at[last],
+        )
+        if self.tvl_watermark is None or watermark > self.tvl_watermark:
+            self.tvl_watermark = watermark
+        # TVL rows are not older than the first balance
+        first_created_at = min(frame.created_at)
+        if (
+            self.first_created_at is None
+            or first_created_at < self.first_created_at
+        ):
+            self.first_created_at = first_created_at
@@ -0,0 +1,19 @@
+from typing import TYPE_CHECKING
+
+from core.db.repo import PartitionRepo
+
+if TYPE_CHECKING:
+    from core.shell.model import DropHistoryBeforeCommandOptions
+
+
+class PartitionService:
+    def __init__(self, partition_repo: PartitionRepo):
+        self.partition_repo = partition_repo
+
+    async def drop_history_before(
+        self,
+        options: "DropHistoryBeforeCommandOptions",
+    ) -> list[str]:
+        return await self.partition_repo.drop_partitions_before(
+            before=options.before,
+        )
@@ -1,29 +1,112 @@
 from decimal import Decimal
+from sqlalchemy.engine import Row
 from typing import TYPE_CHECKING
 
+from core.cache import AsyncTTLCache
+from core.config import settings
 from core.db.repo import TVLHistoryRepo
 
 if TYPE_CHECKING:
     from core.shell.model import GetCurrentDepositCommandOptions
+    from core.shell.model import GetCurrentDepositsCommandOptions
+    from core.shell.model import GetDepositAtCommandOptions
+    from core.shell.model import TopProtocolsCommandOptions
+
+
+# protocol id -> current price, shared by all services of the process and
+# invalidated by shell handlers once recalculated TVL of a protocol is
+# committed
+protocol_price_cache: AsyncTTLCache[Decimal] = AsyncTTLCache(
+    name="protocol_price",
+    maxsize=settings.price_cache_size,
+    ttl=settings.price_cache_ttl,
+)
 
 
 class ProtocolPriceService:
-    def __init__(self, tvl_history_repo: TVLHistoryRepo):
+    def __init__(
+        self,
+        tvl_history_repo: TVLHistoryRepo,
+        cache: AsyncTTLCache[Decimal] = protocol_price_cache,
+    ):
         self.tvl_history_repo = tvl_history_repo
+        self.cache = cache
 
     async def get_protocol_price(
         self,
         options: "GetCurrentDepositCommandOptions",
     ) -> Decimal:
-        protocol_price = (
-            await self.tvl_history_repo.get_current_protocol_price(
-                protocol_id=options.protocol,
-            )
+        protocol_price = await self.cache.get_or_load(
+            options.protocol,
+            lambda: self._load_protocol_price(options.protocol),
         )
 
-        if not protocol_price:
+        if protocol_price is None:
             raise ValueError(
                 "There is no such protocol. Price cannot be defined."
             )
 
-        return protocol_price[0]
+        return protocol_price
+
+    async def get_protocol_prices(
+        self,
+        options: "GetCurrentDepositsCommandOptions",
+    ) -> dict[int, Decimal]:
+        """
+        Prices of the protocols in the order of `options.protocols`, the
+        ones which are not cached are read with one query.
+        """
+        protocol_prices = await self.cache.get_or_load_many(
+            options.protocols,
+            self.tvl_history_repo.get_current_protocol_prices,
+        )
+
+        missing = [
+            protocol_id
+            for protocol_id in options.protocols
+            if protocol_id not in protocol_prices
+        ]
+        if missing:
+            raise ValueError(
+                f"There are no protocols {missing}. "
+                f"Price cannot be defined."
+            )
+
+        return {
+            protocol_id: protocol_prices[protocol_id]
+            for protocol_id in options.protocols
+        }
+
+    async def get_protocol_price_at(
+        self,
+        options: "GetDepositAtCommandOptions",
+    ) -> Row:
+        protocol_price = await self.tvl_history_repo.get_protocol_price_at(
+            protocol_id=options.protocol,
+            block=options.block,
+            at=options.at,
+        )
+
+        if protocol_price is None:
+            raise ValueError(
+                "There is no TVL history of such protocol before the "
+                "target. Price cannot be defined."
+            )
+
+        return protocol_price
+
+    async def get_top_protocols(
+        self,
+        options: "TopProtocolsCommandOptions",
+    ) -> list[Row]:
+        return await self.tvl_history_repo.get_top_protocols(
+            limit=options.limit,
+        )
+
+    async def _load_protocol_price(self, protocol_id: int) -> Decimal | None:
+        protocol_price = (
+            await self.tvl_history_repo.get_current_protocol_price(
+                protocol_id=protocol_id,
+            )
+        )
+        return protocol_price[0] if protocol_price else None
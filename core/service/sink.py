@@ -0,0 +1,664 @@
+import abc
+import datetime as dt
+import math
+import numpy as np
+import os
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+import uuid
+
+from typing import Iterator
+from typing import Literal
+
+from core.db.model import Account
+from core.db.model import GenerationProgress
+from core.db.model import Protocol
+from core.db.repo import AccountRepo
+from core.db.repo import BaseRepo
+from core.db.repo import BulkRepo
+from core.db.repo import GenerationProgressRepo
+from core.db.repo import PartitionRepo
+from core.db.repo import ProtocolTokenRepo
+from core.db.repo import TVLHistoryRepo
+from core.stats import stats
+
+from .engine import ColumnarFrame
+
+
+FileFormat = Literal["parquet", "csv"]
+
+LoadMode = Literal["direct", "staged"]
+
+FILE_EXTENSIONS: dict[FileFormat, str] = {
+    "parquet": ".parquet",
+    "csv": ".csv",
+}
+
+# types which are not inferred from NumPy arrays or CSV text reliably
+COLUMN_TYPES = {
+    "name": pa.string(),
+    "symbol": pa.string(),
+    "wallet_address": pa.string(),
+    "created_at": pa.timestamp("us", tz="UTC"),
+    "amount_usd": pa.decimal128(38, 10),
+}
+
+
+class ProtocolFrame(ColumnarFrame):
+    table_name = "protocol"
+    columns = ("id", "name")
+
+
+class TokenFrame(ColumnarFrame):
+    table_name = "token"
+    columns = ("id", "name", "symbol", "decimals")
+
+
+class ProtocolTokenFrame(ColumnarFrame):
+    table_name = "protocol_token"
+    columns = ("id", "protocol_id", "token_id")
+
+
+class AccountFrame(ColumnarFrame):
+    table_name = "account"
+    columns = ("id", "wallet_address")
+
+
+def _protocol_frames(
+    protocol: Protocol,
+    protocol_token_ids: np.ndarray,
+) -> list[ColumnarFrame]:
+    """Frames of a protocol and its tokens with their ids assigned."""
+    token_ids = np.array([token.id for token in protocol.tokens])
+    return [
+        ProtocolFrame(
+            id=np.array([protocol.id]),
+            name=np.array([protocol.name], dtype=object),
+        ),
+        TokenFrame(
+            id=token_ids,
+            name=np.array([token.name for token in protocol.tokens]),
+            symbol=np.array([token.symbol for token in protocol.tokens]),
+            decimals=np.array([token.decimals for token in protocol.tokens]),
+        ),
+        ProtocolTokenFrame(
+            id=protocol_token_ids,
+            protocol_id=np.full(len(token_ids), protocol.id),
+            token_id=token_ids,
+        ),
+    ]
+
+
+def _account_frame(accounts: list[Account]) -> AccountFrame:
+    return AccountFrame(
+        id=np.array([account.id for account in accounts], dtype=np.int64),
+        wallet_address=np.array(
+            [account.wallet_address for account in accounts],
+            dtype=object,
+        ),
+    )
+
+
+class OutputSink(abc.ABC):
+    """
+    Destination of a generated protocol. A sink assigns ids to the written
+    protocol, tokens and accounts, which are referenced by history frames.
+    """
+
+    async def open(self, start: dt.datetime, end: dt.datetime):
+        pass
+
+    @abc.abstractmethod
+    async def write_protocol(self, protocol: Protocol):
+        ...
+
+    @abc.abstractmethod
+    async def get_protocol_tokens(
+        self,
+        protocol: Protocol,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Ids of protocol tokens and ids of their tokens."""
+
+    @abc.abstractmethod
+    async def write_accounts(self, accounts: list[Account]) -> np.ndarray:
+        ...
+
+    @abc.abstractmethod
+    async def write_frame(self, frame: ColumnarFrame):
+        ...
+
+    async def sample_accounts(
+        self,
+        accounts_number: int,
+        rng: np.random.Generator,
+        max_id: int | None = None,
+    ) -> tuple[np.ndarray, int]:
+        """
+        Draws ids of `accounts_number` distinct existing accounts with ids up
+        to `max_id`. Returns them and the last id of the pool, which gives
+        the same sample for the same `rng` while accounts are not deleted.
+        """
+        raise NotImplementedError(
+            f"{type(self).__name__} has no account pool"
+        )
+
+    async def start_progress(self, progress: GenerationProgress):
+        """Records options of a generation, so it can be resumed."""
+
+    async def save_progress(self, protocol_id: int, committed_jobs: int):
+        """Makes frames of the first `committed_jobs` jobs durable."""
+
+    async def restore_protocol(self, protocol: Protocol, protocol_id: int):
+        """
+        Sets ids of a protocol and its tokens which were written by an
+        interrupted generation of the same seed.
+        """
+        raise NotImplementedError(
+            f"{type(self).__name__} cannot resume a generation"
+        )
+
+    async def restore_accounts(self, accounts: list[Account]) -> np.ndarray:
+        """
+        Same as `write_accounts` for accounts which may have been written
+        by an interrupted generation of the same seed.
+        """
+        raise NotImplementedError(
+            f"{type(self).__name__} cannot resume a generation"
+        )
+
+    async def close(
+        self,
+        protocol_id: int,
+        tvl_watermark: tuple[int, dt.datetime] | None = None,
+    ):
+        """
+        Finishes writing of the protocol. `tvl_watermark` is passed when
+        its TVL history was already written as frames.
+        """
+
+
+class DatabaseSink(OutputSink):
+    """
+    Writes to Postgres. TVL history of the protocol is calculated with SQL
+    unless it was written as frames. With `generation_progress_repo` the
+    frames of every job are committed together with the number of committed
+    jobs, otherwise everything is committed on close.
+
+    In the staged load mode frames are copied to UNLOGGED staging tables
+    and moved to the history tables with one statement per table on close,
+    optionally with secondary indexes of the history tables dropped and
+    built again afterwards, then the tables are analyzed. Jobs of a staged
+    load are not checkpointed, since unlogged tables are emptied by a crash
+    of Postgres, so a resumed one starts from the first job.
+    """
+
+    def __init__(
+        self,
+        base_repo: BaseRepo,
+        bulk_repo: BulkRepo,
+        protocol_token_repo: ProtocolTokenRepo,
+        tvl_history_repo: TVLHistoryRepo,
+        partition_repo: PartitionRepo,
+        generation_progress_repo: GenerationProgressRepo | None = None,
+        load: LoadMode = "direct",
+        rebuild_indexes: bool = False,
+        account_repo: AccountRepo | None = None,
+    ):
+        self.base_repo = base_repo
+        self.bulk_repo = bulk_repo
+        self.protocol_token_repo = protocol_token_repo
+        self.tvl_history_repo = tvl_history_repo
+        self.partition_repo = partition_repo
+        self.generation_progress_repo = generation_progress_repo
+        self.load = load
+        self.rebuild_indexes = rebuild_indexes
+        self.account_repo = account_repo
+        # table name -> (staging table name, columns)
+        self.staging_tables: dict[str, tuple[str, tuple[str, ...]]] = {}
+        self.staging_suffix = uuid.uuid4().hex[:12]
+        self.protocol_tokens: tuple[np.ndarray, np.ndarray] | None = None
+        self.start: dt.datetime | None = None
+
+    async def open(self, start: dt.datetime, end: dt.datetime):
+        self.start = start
+        await self.partition_repo.ensure_partitions(start=start, end=end)
+
+    async def write_protocol(self, protocol: Protocol):
+        existing = await self.protocol_token_repo.get_existing_names(
+            protocol_name=protocol.name,
+            token_names=[token.name for token in protocol.tokens],
+            token_symbols=[token.symbol for token in protocol.tokens],
+        )
+        if existing:
+            raise ValueError(
+                f"{', '.join(existing)} already exist. A seed reproduces "
+                f"data only into a database without its protocol, use "
+                f"another seed or database."
+            )
+
+        # ids are reserved up front, so rows are copied without flushes of
+        # the ORM and referencing rows do not wait for generated keys
+        protocol.id, = await self.bulk_repo.reserve_ids("protocol", 1)
+        token_ids = sorted(await self.bulk_repo.reserve_ids(
+            "token",
+            len(protocol.tokens),
+        ))
+        for token, token_id in zip(protocol.tokens, token_ids):
+            token.id = token_id
+        protocol_token_ids = np.array(
+            sorted(await self.bulk_repo.reserve_ids(
+                "protocol_token",
+                len(protocol.tokens),
+            )),
+            dtype=np.int64,
+        )
+        self.protocol_tokens = (
+            protocol_token_ids,
+            np.array(token_ids, dtype=np.int64),
+        )
+
+        for frame in _protocol_frames(protocol, protocol_token_ids):
+            await self._copy_frame(frame)
+        await self.base_repo.commit()
+
+    async def get_protocol_tokens(
+        self,
+        protocol: Protocol,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        if self.protocol_tokens is not None:
+            return self.protocol_tokens
+
+        protocol_token_list = await (
+            self.protocol_token_repo.get_protocol_token_by_protocol_id(
+                protocol_id=protocol.id
+            )
+        )
+        return (
+            np.array([
+                protocol_token.id for protocol_token in protocol_token_list
+            ]),
+            np.array([
+                protocol_token.token_id
+                for protocol_token in protocol_token_list
+            ]),
+        )
+
+    async def write_accounts(self, accounts: list[Account]) -> np.ndarray:
+        account_ids = await self.bulk_repo.reserve_ids(
+            "account",
+            len(accounts),
+        )
+        for account, account_id in zip(accounts, account_ids):
+            account.id = account_id
+
+        frame = _account_frame(accounts)
+        await self._copy_frame(frame)
+        await self.base_repo.commit()
+        return frame.id
+
+    async def write_frame(self, frame: ColumnarFrame):
+        table_name = frame.table_name
+        if self.load == "staged":
+            table_name = await self._get_staging_table(frame)
+        await self._copy_frame(frame, table_name)
+
+    async def sample_accounts(
+        self,
+        accounts_number: int,
+        rng: np.random.Generator,
+        max_id: int | None = None,
+    ) -> tuple[np.ndarray, int]:
+        # ids are drawn from the id range in batches and kept if they are
+        # new and the account exists, so gaps of the sequence are skipped
+        # and memory grows with the drawn ids, not with the size of the pool
+        pool_size = await self.account_repo.count_up_to(
+            accounts_number,
+            max_id,
+        )
+        if pool_size < accounts_number:
+            raise ValueError(
+                f"The account pool has {pool_size} accounts, "
+                f"{accounts_number} are needed. Grow it with "
+                f"grow_account_pool."
+            )
+        first_id, last_id = await self.account_repo.get_id_range(max_id)
+        if accounts_number == 0:
+            return np.empty(0, dtype=np.int64), last_id
+
+        range_size = last_id - first_id + 1
+        # share of existing ids in the range, ids come from a sequence, so
+        # it starts at 1 and is measured on the drawn ids; it only depends
+        # on the pool, so a resumed generation draws the same batches
+        density = 1.0
+        account_ids = np.empty(0, dtype=np.int64)
+        drawn = np.empty(0, dtype=np.int64)
+        while len(account_ids) < accounts_number:
+            if len(drawn) == range_size:
+                raise ValueError("Accounts of the pool were deleted.")
+            missing = accounts_number - len(account_ids)
+            # ids are drawn with replacement, so draws of already drawn ids
+            # are made up for
+            new_share = 1 - len(drawn) / range_size
+            batch_size = min(
+                math.ceil(missing / density / new_share * 1.1),
+                range_size,
+            )
+            candidates = rng.integers(
+                first_id,
+                last_id,
+                size=batch_size,
+                endpoint=True,
+            )
+            # first draw of every id, in the order of the draws
+            _, first_draws = np.unique(candidates, return_index=True)
+            batch = candidates[np.sort(first_draws)]
+            # membership by sorting, a lookup table would span the id range
+            batch = batch[~np.isin(batch, drawn, kind="sort")]
+            drawn = np.concatenate([drawn, batch])
+            existing = await self.account_repo.get_existing_ids(
+                batch.tolist()
+            )
+            account_ids = np.concatenate([
+                account_ids,
+                batch[np.isin(
+                    batch,
+                    np.fromiter(existing, np.int64),
+                    kind="sort",
+                )],
+            ])
+            density = max(len(account_ids), 1) / len(drawn)
+        return account_ids[:accounts_number], last_id
+
+    async def start_progress(self, progress: GenerationProgress):
+        if self.generation_progress_repo is not None:
+            await self.generation_progress_repo.add_all(
+                [progress],
+                with_commit=True,
+            )
+
+    async def save_progress(self, protocol_id: int, committed_jobs: int):
+        if self.load == "staged":
+            return
+        if self.generation_progress_repo is not None:
+            await self.generation_progress_repo.set_committed_jobs(
+                protocol_id,
+                committed_jobs,
+            )
+            await self.base_repo.commit()
+
+    async def restore_protocol(self, protocol: Protocol, protocol_id: int):
+        token_ids = await (
+            self.generation_progress_repo.get_token_ids_by_name(
+                [token.name for token in protocol.tokens]
+            )
+        )
+        if len(token_ids) != len(protocol.tokens):
+            raise ValueError(
+                f"Tokens of protocol {protocol_id} were not generated "
+                f"from its seed."
+            )
+
+        protocol.id = protocol_id
+        for token in protocol.tokens:
+            token.id = token_ids[token.name]
+
+    async def restore_accounts(self, accounts: list[Account]) -> np.ndarray:
+        account_ids = await (
+            self.generation_progress_repo.get_account_ids_by_wallet_address(
+                [account.wallet_address for account in accounts]
+            )
+        )
+        missing = []
+        for account in accounts:
+            account.id = account_ids.get(account.wallet_address)
+            if account.id is None:
+                missing.append(account)
+        if missing:
+            await self.write_accounts(missing)
+        return np.array([account.id for account in accounts], dtype=np.int64)
+
+    async def close(
+        self,
+        protocol_id: int,
+        tvl_watermark: tuple[int, dt.datetime] | None = None,
+    ):
+        if self.staging_tables:
+            await self._merge_staging_tables()
+        await self.base_repo.commit()
+        if tvl_watermark is None:
+            await self.tvl_history_repo.calculate_history_by_protocol_id(
+                protocol_id=protocol_id,
+            )
+        else:
+            # history starts at `start`, so older rollups are not rebuilt
+            await self.tvl_history_repo.update_watermark(
+                protocol_id,
+                *tvl_watermark,
+                from_created_at=self.start,
+            )
+        if self.generation_progress_repo is not None:
+            await self.generation_progress_repo.finish(protocol_id)
+
+    async def _copy_frame(
+        self,
+        frame: ColumnarFrame,
+        table_name: str | None = None,
+    ):
+        await self.bulk_repo.copy_records(
+            table_name=table_name or frame.table_name,
+            columns=frame.columns,
+            records=frame.records(),
+        )
+
+    async def _get_staging_table(self, frame: ColumnarFrame) -> str:
+        if frame.table_name not in self.staging_tables:
+            staging_table_name = (
+                f"staging_{frame.table_name}_{self.staging_suffix}"
+            )
+            await self.bulk_repo.create_staging_table(
+                table_name=frame.table_name,
+                staging_table_name=staging_table_name,
+                columns=frame.columns,
+            )
+            self.staging_tables[frame.table_name] = (
+                staging_table_name,
+                frame.columns,
+            )
+        return self.staging_tables[frame.table_name][0]
+
+    async def _merge_staging_tables(self):
+        for table_name, (staging_table_name, columns) in (
+            self.staging_tables.items()
+        ):
+            indexes = []
+            if self.rebuild_indexes:
+                indexes = await self.bulk_repo.drop_secondary_indexes(
+                    table_name
+                )
+            await self.bulk_repo.merge_staging_table(
+                table_name=table_name,
+                staging_table_name=staging_table_name,
+                columns=columns,
+            )
+            await self.bulk_repo.create_indexes(indexes)
+            await self.bulk_repo.analyze(table_name)
+        self.staging_tables.clear()
+
+
+class _TableFile:
+    """
+    One table written to a file. Batches are buffered up to
+    `row_group_size` rows, so each Parquet row group (or CSV block) is
+    written at once.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        file_format: FileFormat,
+        row_group_size: int,
+    ):
+        self.path = path
+        self.file_format = file_format
+        self.row_group_size = row_group_size
+        self.writer: pq.ParquetWriter | pa_csv.CSVWriter | None = None
+        self.batches: list[pa.RecordBatch] = []
+        self.buffered_rows = 0
+
+    def write(self, batch: pa.RecordBatch):
+        self.batches.append(batch)
+        self.buffered_rows += batch.num_rows
+        if self.buffered_rows >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batches:
+            return
+
+        table = pa.Table.from_batches(self.batches)
+        self.batches.clear()
+        self.buffered_rows = 0
+        if self.file_format == "parquet":
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.path, table.schema)
+            self.writer.write_table(table, row_group_size=self.row_group_size)
+        else:
+            if self.writer is None:
+                self.writer = pa_csv.CSVWriter(self.path, table.schema)
+            self.writer.write_table(table)
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+
+
+class FileSink(OutputSink):
+    """
+    Writes every table of one protocol to `<directory>/<table>.<format>`.
+    Ids are assigned locally starting from 1, `ProtocolDataImportService`
+    maps them to database ids on import.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        file_format: FileFormat = "parquet",
+        row_group_size: int = 100_000,
+    ):
+        self.directory = directory
+        self.file_format = file_format
+        self.row_group_size = row_group_size
+        self.files: dict[str, _TableFile] = {}
+        self.protocol_token_ids = np.empty(0, dtype=np.int64)
+        self.accounts_number = 0
+
+    async def open(self, start: dt.datetime, end: dt.datetime):
+        os.makedirs(self.directory, exist_ok=True)
+
+    async def write_protocol(self, protocol: Protocol):
+        protocol.id = 1
+        for i, token in enumerate(protocol.tokens, start=1):
+            token.id = i
+        self.protocol_token_ids = np.array(
+            [token.id for token in protocol.tokens]
+        )
+
+        for frame in _protocol_frames(protocol, self.protocol_token_ids):
+            await self.write_frame(frame)
+
+    async def get_protocol_tokens(
+        self,
+        protocol: Protocol,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        # every token has a protocol token with the same id
+        return self.protocol_token_ids, self.protocol_token_ids
+
+    async def write_accounts(self, accounts: list[Account]) -> np.ndarray:
+        account_ids = np.arange(
+            self.accounts_number + 1,
+            self.accounts_number + len(accounts) + 1,
+            dtype=np.int64,
+        )
+        self.accounts_number += len(accounts)
+        for account, account_id in zip(accounts, account_ids.tolist()):
+            account.id = account_id
+
+        await self.write_frame(_account_frame(accounts))
+        return account_ids
+
+    async def write_frame(self, frame: ColumnarFrame):
+        with stats.phase(f"write.{frame.table_name}") as phase:
+            self._get_file(frame.table_name).write(
+                pa.RecordBatch.from_arrays(
+                    [
+                        pa.array(
+                            getattr(frame, column),
+                            type=COLUMN_TYPES.get(column),
+                        )
+                        for column in frame.columns
+                    ],
+                    names=list(frame.columns),
+                )
+            )
+            phase.rows += len(frame)
+
+    async def close(
+        self,
+        protocol_id: int,
+        tvl_watermark: tuple[int, dt.datetime] | None = None,
+    ):
+        for file in self.files.values():
+            file.close()
+        self.files.clear()
+
+    def _get_file(self, table_name: str) -> _TableFile:
+        if table_name not in self.files:
+            self.files[table_name] = _TableFile(
+                path=os.path.join(
+                    self.directory,
+                    table_name + FILE_EXTENSIONS[self.file_format],
+                ),
+                file_format=self.file_format,
+                row_group_size=self.row_group_size,
+            )
+        return self.files[table_name]
+
+
+def detect_file_format(directory: str) -> FileFormat:
+    for file_format, extension in FILE_EXTENSIONS.items():
+        if os.path.exists(os.path.join(directory, "protocol" + extension)):
+            return file_format
+    raise ValueError(f"no exported protocol found in {directory}")
+
+
+def iter_table_batches(
+    directory: str,
+    table_name: str,
+    batch_size: int,
+) -> Iterator[pa.RecordBatch]:
+    """Reads a table written by `FileSink` in batches of `batch_size` rows."""
+    file_format = detect_file_format(directory)
+    path = os.path.join(directory, table_name + FILE_EXTENSIONS[file_format])
+    if not os.path.exists(path):
+        return
+
+    if file_format == "parquet":
+        yield from pq.ParquetFile(path).iter_batches(batch_size=batch_size)
+        return
+
+    reader = pa_csv.open_csv(
+        path,
+        convert_options=pa_csv.ConvertOptions(column_types=COLUMN_TYPES),
+    )
+    # CSV blocks are sized in bytes, so they are rebatched to rows
+    batches, rows = [], 0
+    for batch in reader:
+        batches.append(batch)
+        rows += batch.num_rows
+        if rows >= batch_size:
+            yield from pa.Table.from_batches(batches).to_batches(batch_size)
+            batches, rows = [], 0
+    if batches:
+        yield from pa.Table.from_batches(batches).to_batches(batch_size)
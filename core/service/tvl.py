@@ -0,0 +1,33 @@
+from sqlalchemy.engine import Row
+from typing import TYPE_CHECKING
+
+from core.db.repo import TVLHistoryRepo
+
+if TYPE_CHECKING:
+    from core.shell.model import CalculateTVLHistoryCommandOptions
+    from core.shell.model import GetTVLHistoryCommandOptions
+
+
+class TVLHistoryService:
+    def __init__(self, tvl_history_repo: TVLHistoryRepo):
+        self.tvl_history_repo = tvl_history_repo
+
+    async def calculate_history(
+        self,
+        options: "CalculateTVLHistoryCommandOptions",
+    ) -> int:
+        return await self.tvl_history_repo.calculate_history_by_protocol_id(
+            protocol_id=options.protocol,
+            incremental=options.mode == "incremental",
+        )
+
+    async def get_history(
+        self,
+        options: "GetTVLHistoryCommandOptions",
+    ) -> list[Row]:
+        return await self.tvl_history_repo.get_history(
+            protocol_id=options.protocol,
+            resolution=options.resolution,
+            start=options.start,
+            end=options.end,
+        )
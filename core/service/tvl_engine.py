@@ -0,0 +1,150 @@
+import datetime as dt
+import numpy as np
+import pyarrow as pa
+
+from typing import Iterator
+
+from .engine import BalanceHistoryFrame
+from .engine import ColumnarFrame
+from .engine import TVLHistoryFrame
+from .engine import TokenPriceFrame
+from .engine import _to_decimal
+from .engine import final_block_number
+
+
+# same window as in `TVLHistoryRepo.CALCULATE_HISTORY_SQL`
+PRICE_WINDOW = dt.timedelta(hours=1)
+
+
+def _to_microseconds(values: np.ndarray) -> np.ndarray:
+    """Datetimes as microseconds since epoch, naive ones are taken as UTC."""
+    return (
+        pa.array(values, type=pa.timestamp("us", tz="UTC"))
+        .cast(pa.int64())
+        .to_numpy()
+    )
+
+
+class ColumnarTVLEngine:
+    """
+    Calculates TVL history of a protocol from its generated frames, so it
+    does not have to be read back from the database. Produces the same rows
+    as `TVLHistoryRepo.CALCULATE_HISTORY_SQL`: balances are summed per
+    (protocol token, block) and every price tick of the token within an
+    hour from the block gives one row.
+
+    Balance sums are kept in a dense (protocol token, block) array, so all
+    balance frames have to be added before price frames. Every price frame
+    then gives the TVL rows of its ticks right away, its ticks are matched
+    to blocks with `np.searchsorted` and are not kept. All rows of a block
+    are expected to share `created_at`, as generated ones do.
+    """
+
+    def __init__(
+        self,
+        protocol_token_ids: np.ndarray,
+        token_ids: np.ndarray,
+        start: dt.datetime,
+        end: dt.datetime,
+    ):
+        order = np.argsort(protocol_token_ids)
+        self.protocol_token_ids = protocol_token_ids[order]
+        self.token_ids = token_ids[order]
+
+        shape = (len(protocol_token_ids), final_block_number(start, end) + 1)
+        self.amount = np.zeros(shape, dtype=np.int64)
+        self.has_balance = np.zeros(shape, dtype=bool)
+        self.block_created_at = np.empty(shape[1], dtype=object)
+        self.has_prices = False
+
+    def add_frame(self, frame: ColumnarFrame) -> Iterator[TVLHistoryFrame]:
+        """Adds a generated frame, yields TVL history it completes."""
+        if isinstance(frame, BalanceHistoryFrame):
+            if self.has_prices:
+                raise ValueError(
+                    "balance history has to be added before token prices"
+                )
+            self.add_balance_history(frame)
+        elif isinstance(frame, TokenPriceFrame):
+            self.has_prices = True
+            yield from self.iter_tvl_history(frame)
+
+    def add_balance_history(self, frame: BalanceHistoryFrame):
+        index = (
+            np.searchsorted(self.protocol_token_ids, frame.protocol_token_id),
+            frame.created_at_block,
+        )
+        np.add.at(self.amount, index, frame.amount)
+        self.has_balance[index] = True
+        self.block_created_at[frame.created_at_block] = frame.created_at
+
+    def watermark(self) -> tuple[int, dt.datetime] | None:
+        """Last block with balances and its creation time."""
+        blocks = np.flatnonzero(self.has_balance.any(axis=0))
+        if len(blocks) == 0:
+            return None
+        block = int(blocks[-1])
+        return block, self.block_created_at[block]
+
+    def iter_tvl_history(
+        self,
+        frame: TokenPriceFrame,
+    ) -> Iterator[TVLHistoryFrame]:
+        """Yields TVL history of the ticks of every protocol token."""
+        created_at_us = _to_microseconds(frame.created_at)
+        order = np.lexsort((created_at_us, frame.token_id))
+        token_id, created_at_us = frame.token_id[order], created_at_us[order]
+        created_at = frame.created_at[order]
+        # decimals are made once per tick and multiplied by NumPy
+        usd_price = np.array(
+            _to_decimal(frame.usd_price[order]),
+            dtype=object,
+        )
+
+        window_us = PRICE_WINDOW // dt.timedelta(microseconds=1)
+        for i, protocol_token_id in enumerate(self.protocol_token_ids):
+            first, last = np.searchsorted(
+                token_id,
+                [self.token_ids[i], self.token_ids[i] + 1],
+            )
+            if first == last:
+                continue
+            blocks = np.flatnonzero(self.has_balance[i])
+            if len(blocks) == 0:
+                continue
+
+            ticks_us = created_at_us[first:last]
+            block_us = _to_microseconds(self.block_created_at[blocks])
+            lo = first + np.searchsorted(ticks_us, block_us, side="left")
+            hi = first + np.searchsorted(
+                ticks_us,
+                block_us + window_us,
+                side="right",
+            )
+            ticks_number = hi - lo
+            rows_number = int(ticks_number.sum())
+            if rows_number == 0:
+                continue
+
+            # ranges lo..hi of every block, concatenated
+            offsets = np.cumsum(ticks_number) - ticks_number
+            tick = (
+                np.repeat(lo - offsets, ticks_number)
+                + np.arange(rows_number)
+            )
+            block_index = np.repeat(np.arange(len(blocks)), ticks_number)
+            block_amount = self.amount[i, blocks]
+            block_amount_decimal = np.array(
+                _to_decimal(block_amount),
+                dtype=object,
+            )
+
+            yield TVLHistoryFrame(
+                protocol_token_id=np.full(rows_number, protocol_token_id),
+                created_at_block=blocks[block_index],
+                amount=block_amount[block_index],
+                amount_usd=(
+                    usd_price[tick] * block_amount_decimal[block_index]
+                ),
+                created_at=created_at[tick],
+            )
@@ -1,29 +1,63 @@
 import asyncio
 import cmd
+import contextlib
+import datetime as dt
 import functools
+import json
+import os
+import time
 
+from concurrent.futures import Executor
+from concurrent.futures import ProcessPoolExecutor
 from decimal import Decimal
+from sqlalchemy.engine import Row
 from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Any
 from typing import Callable
+from typing import Coroutine
+from typing import TYPE_CHECKING
 
-from core.db import init_db
+from core.config import settings
+from core.db import close_db
+from core.db import ensure_db
 from core.db import inject_session
+from core.db.repo import AccountRepo
 from core.db.repo import BaseRepo
+from core.db.repo import BulkRepo
+from core.db.repo import GenerationProgressRepo
+from core.db.repo import PartitionRepo
 from core.db.repo import ProtocolTokenRepo
+from core.db.repo import TokenPriceRepo
 from core.db.repo import TVLHistoryRepo
-from core.service import ProtocolDataGeneratorService
-from core.service import ProtocolPriceService
+from core.stats import Stats
+from core.stats import stats
 
+from .model import CalculateTVLHistoryCommandOptions
+from .model import CompactTokenPricesCommandOptions
+from .model import DropHistoryBeforeCommandOptions
 from .model import GenerateProtocolDataCommandOptions
+from .model import GenerateProtocolsCommandOptions
 from .model import GetCurrentDepositCommandOptions
+from .model import GetCurrentDepositsCommandOptions
+from .model import GetDepositAtCommandOptions
+from .model import GetTVLHistoryCommandOptions
+from .model import GrowAccountPoolCommandOptions
+from .model import ImportProtocolDataCommandOptions
+from .model import ResumeGenerationCommandOptions
+from .model import StatsCommandOptions
+from .model import TopProtocolsCommandOptions
+
+if TYPE_CHECKING:
+    from core.service import OutputSink
 
 
 def print_exception(func: Callable) -> Callable:
     @functools.wraps(func)
-    def wrapper(*args, **kwargs):
+    def wrapper(self, *args, **kwargs):
         try:
-            func(*args, **kwargs)
+            func(self, *args, **kwargs)
         except Exception as exc:
+            self.last_exception = exc
             print(f"\033[91m{exc}\033[0m")
     return wrapper
 
@@ -35,9 +69,59 @@ class _ProtocolGeneratorShellHandler(cmd.Cmd):
     )
     prompt = "₿ > "
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.session_stats = Stats()
+        self.stats_dump_path: str | None = settings.stats_dump_path
+        self.last_exception: Exception | None = None
+
     # ----- SHELL RUNNERS -----
     def preloop(self):
-        asyncio.run(init_db())
+        # one loop for the whole shell session keeps pooled connections
+        # (bound to the loop they were opened on) usable between commands
+        # the database is initialized by the first command using it
+        self.loop = asyncio.new_event_loop()
+
+    def postloop(self):
+        self.run(close_db())
+        self.loop.close()
+
+    def precmd(self, line: str) -> str:
+        stats.reset()
+        self.last_exception = None
+        return line
+
+    def postcmd(self, stop: bool, line: str) -> bool:
+        self.session_stats.merge(stats)
+        if self.stats_dump_path and (
+            stats.phases or stats.statements or stats.caches
+        ):
+            with open(self.stats_dump_path, "a") as file:
+                file.write(json.dumps({"command": line, **stats.dict()}))
+                file.write("\n")
+        return stop
+
+    def run(self, coro: Coroutine[Any, Any, Any]) -> Any:
+        return self.loop.run_until_complete(coro)
+
+    def run_once(self, line: str) -> int:
+        """
+        Runs one command without the interactive loop and returns an exit
+        status: 0 on success, 1 if the command failed, 2 if it is unknown.
+        """
+        command, _, _ = self.parseline(line)
+        if not command or not hasattr(self, f"do_{command}"):
+            print(f"\033[91mUnknown command: {line}\033[0m")
+            return 2
+
+        self.preloop()
+        try:
+            line = self.precmd(line)
+            self.postcmd(self.onecmd(line), line)
+        finally:
+            self.postloop()
+        return 0 if self.last_exception is None else 1
 
     # ----- SHELL COMMAND ENTRYPOINTS -----
     @print_exception
@@ -45,13 +129,112 @@ class _ProtocolGeneratorShellHandler(cmd.Cmd):
         """
         Generates data for protocol
         --accounts, number of accounts using protocol (default: 100)
-        --start, activation date of protocol (default: now - 5 days)
-        --end, deactivation date of protocol (default: now)
+        --start, activation date of protocol, naive dates are UTC
+            (default: now - 5 days)
+        --end, deactivation date of protocol, naive dates are UTC
+            (default: now)
         --deposit, last deposit sum in usd (default: 2_000_000)
+        --chunk, max number of rows generated and written at once
+            (default: 100_000)
+        --seed, seed of generated data, the same seed generates the same
+            data (default: random)
+        --shards, number of processes generating chunks (default: 1)
+        --output, directory to export data to instead of the database
+        --format, parquet or csv, format of exported files
+            (default: parquet)
+        --tvl, numpy: calculate TVL history from generated data in process,
+            sql: calculate it in the database after loading (default: numpy)
+        --load, direct: copy to history tables, staged: copy to unlogged
+            staging tables and move rows to history tables at the end
+            (default: direct)
+        --rebuild_indexes, true to drop secondary indexes of history
+            tables while moving staged rows and build them again; locks
+            the whole history tables meanwhile and rebuilds their indexes
+            over all rows, not only loaded ones (default: false)
+        --account_pool, true to draw accounts from existing ones instead
+            of creating new ones, see grow_account_pool (default: false)
         """
         opts = GenerateProtocolDataCommandOptions.parse_args(arg)
-        protocol_id = asyncio.run(self._generate_protocol_data(opts))
-        print(f"protocol_id={protocol_id}")
+        protocol_id, _, seed = self.run(self._generate_protocol_data(opts))
+        print(f"protocol_id={protocol_id}, seed={seed}")
+
+    @print_exception
+    def do_grow_account_pool(self, arg: str):
+        """
+        Creates accounts which generate_protocol_data --account_pool true
+        draws from
+        --accounts, number of accounts
+        --chunk, max number of accounts written at once (default: 100_000)
+        --seed, seed of wallet addresses (default: random)
+        """
+        opts = GrowAccountPoolCommandOptions.parse_args(arg)
+        seed = self.run(self._grow_account_pool(opts))
+        print(f"accounts={opts.accounts}, seed={seed}")
+
+    @print_exception
+    def do_resume_generation(self, arg: str):
+        """
+        Resumes an interrupted generate_protocol_data from its last
+        committed chunk
+        --protocol, id of protocol
+        --shards, number of processes generating chunks (default: 1)
+        """
+        opts = ResumeGenerationCommandOptions.parse_args(arg)
+        rows = self.run(self._resume_generation(opts))
+        self._invalidate_protocol_price(opts.protocol)
+        print(f"protocol_id={opts.protocol}, rows={rows}")
+
+    @print_exception
+    def do_import_protocol_data(self, arg: str):
+        """
+        Imports protocol data exported by generate_protocol_data --output
+        --path, directory with exported data
+        --chunk, max number of rows read and written at once
+            (default: 100_000)
+        """
+        opts = ImportProtocolDataCommandOptions.parse_args(arg)
+        protocol_id, rows = self.run(self._import_protocol_data(opts))
+        self._invalidate_protocol_price(protocol_id)
+        print(f"protocol_id={protocol_id}, rows={rows}")
+
+    @print_exception
+    def do_generate_protocols(self, arg: str):
+        """
+        Generates data for several protocols concurrently
+        --count, number of protocols (default: 10)
+        --parallelism, number of protocols generated at once
+            (default: PG_POOL_SIZE)
+        --seed, seed of the first protocol, the next ones get seed + 1,
+            seed + 2, ... (default: random)
+        --output, directory to export data to instead of the database,
+            every protocol is written to its own subdirectory 0, 1, ...
+        --accounts, --start, --end, --deposit, --chunk, --shards, --format,
+        --tvl, --load, --rebuild_indexes, --account_pool, same as for
+        generate_protocol_data
+        A failed protocol does not stop the others, failures are printed
+        with the index of the protocol and fail the command.
+        """
+        opts = GenerateProtocolsCommandOptions.parse_args(arg)
+        started_at = time.perf_counter()
+        results = self.run(self._generate_protocols(opts))
+        seconds = time.perf_counter() - started_at
+
+        generated = []
+        for i, result in enumerate(results):
+            if isinstance(result, BaseException):
+                print(f"\033[91mprotocol {i} failed: {result!r}\033[0m")
+                continue
+            protocol_id, rows, seed = result
+            print(f"protocol_id={protocol_id}, rows={rows}, seed={seed}")
+            generated.append(result)
+        rows = sum(rows for _, rows, _ in generated)
+        print(
+            f"protocols={len(generated)}, rows={rows}, "
+            f"seconds={seconds:.2f}, rows_per_second={rows / seconds:.0f}"
+        )
+        failed = len(results) - len(generated)
+        if failed:
+            raise RuntimeError(f"{failed} of {len(results)} protocols failed")
 
     @print_exception
     def do_get_current_deposit(self, arg: str):
@@ -60,26 +243,351 @@ class _ProtocolGeneratorShellHandler(cmd.Cmd):
         --protocol, id of requested protocol
         """
         opts = GetCurrentDepositCommandOptions.parse_args(arg)
-        deposit = asyncio.run(self._get_current_deposit(opts))
+        deposit = self.run(self._get_current_deposit(opts))
         print(f"protocol={opts.protocol}, deposit={deposit}")
 
+    @print_exception
+    def do_get_current_deposits(self, arg: str):
+        """
+        Get current deposits of several protocols with one query
+        --protocols, comma separated ids of requested protocols
+        """
+        opts = GetCurrentDepositsCommandOptions.parse_args(arg)
+        deposits = self.run(self._get_current_deposits(opts))
+        for protocol_id, deposit in deposits.items():
+            print(f"protocol={protocol_id}, deposit={deposit}")
+
+    @print_exception
+    def do_get_deposit_at(self, arg: str):
+        """
+        Get deposit of protocol at a block or a time
+        --protocol, id of requested protocol
+        --block, block number
+        --at, date, naive dates are UTC, instead of --block
+        """
+        opts = GetDepositAtCommandOptions.parse_args(arg)
+        deposit = self.run(self._get_deposit_at(opts))
+        print(
+            f"protocol={opts.protocol}, "
+            f"block={deposit.created_at_block}, "
+            f"created_at={deposit.created_at.isoformat()}, "
+            f"deposit={deposit.amount_usd}"
+        )
+
+    @print_exception
+    def do_top_protocols(self, arg: str):
+        """
+        Get protocols with the highest current deposit
+        --limit, number of protocols (default: 10)
+        """
+        opts = TopProtocolsCommandOptions.parse_args(arg)
+        protocols = self.run(self._get_top_protocols(opts))
+        for protocol in protocols:
+            print(
+                f"protocol={protocol.protocol_id}, name={protocol.name}, "
+                f"deposit={protocol.amount_usd}"
+            )
+
+    @print_exception
+    def do_calculate_tvl_history(self, arg: str):
+        """
+        Calculate TVL history of protocol
+        --protocol, id of protocol
+        --mode, incremental: only blocks after the last calculated one,
+            full: all blocks (default: incremental)
+        """
+        opts = CalculateTVLHistoryCommandOptions.parse_args(arg)
+        rows = self.run(self._calculate_tvl_history(opts))
+        self._invalidate_protocol_price(opts.protocol)
+        print(f"protocol={opts.protocol}, rows={rows}")
+
+    @print_exception
+    def do_get_tvl_history(self, arg: str):
+        """
+        Get TVL of protocol over time
+        --protocol, id of protocol
+        --start, start date, naive dates are UTC
+        --end, end date, naive dates are UTC
+        --resolution, hour or day (default: day)
+        """
+        opts = GetTVLHistoryCommandOptions.parse_args(arg)
+        history = self.run(self._get_tvl_history(opts))
+        for bucket in history:
+            print(
+                f"bucket={bucket.bucket.isoformat()}, "
+                f"amount_usd={bucket.amount_usd}, "
+                f"min_amount_usd={bucket.min_amount_usd}, "
+                f"max_amount_usd={bucket.max_amount_usd}"
+            )
+
+    @print_exception
+    def do_drop_history_before(self, arg: str):
+        """
+        Drop monthly partitions of balance, price and TVL history
+        which only hold rows created before the date
+        --before, date, naive dates are UTC
+        """
+        opts = DropHistoryBeforeCommandOptions.parse_args(arg)
+        partitions = self.run(self._drop_history_before(opts))
+        print(f"dropped={', '.join(partitions) or None}")
+
+    @print_exception
+    def do_compact_token_prices(self, arg: str):
+        """
+        Roll token prices of months older than the age into hourly OHLC
+        rows and drop their monthly partitions
+        --age, age in days, rounded down to the start of its month
+            (default: TOKEN_PRICE_COMPACTION_AGE_DAYS)
+        --archive, directory to write the raw prices to as Parquet
+            before deleting them (default: no archive)
+        --chunk, max number of prices archived at once (default: 100_000)
+        """
+        opts = CompactTokenPricesCommandOptions.parse_args(arg)
+        before, buckets, dropped, deleted = self.run(
+            self._compact_token_prices(opts)
+        )
+        print(
+            f"before={before.isoformat()}, buckets={buckets}, "
+            f"dropped={', '.join(dropped) or None}, deleted={deleted}"
+        )
+
+    @print_exception
+    def do_stats(self, arg: str):
+        """
+        Show time per phase, per SQL statement and cache hits and misses
+        of commands run in this shell
+        --reset, true to clear collected stats (default: false)
+        --dump, file to append JSON stats of every following command to,
+            off to stop (default: STATS_DUMP_PATH)
+        """
+        opts = StatsCommandOptions.parse_args(arg)
+        print(self.session_stats.format())
+        if opts.reset:
+            self.session_stats.reset()
+        if opts.dump:
+            self.stats_dump_path = None if opts.dump == "off" else opts.dump
+
+    def do_exit(self, arg: str) -> bool:
+        """
+        Exit the shell
+        """
+        return True
+
+    do_EOF = do_exit
+
     # ----- SHELL COMMAND HANDLERS -----
-    @inject_session
+    # services are imported by handlers, so a command only imports what it
+    # uses (e.g. NumPy and PyArrow are only needed for generation)
+    def _invalidate_protocol_price(self, protocol_id: int):
+        # called once the session of the command is committed, a read
+        # between an earlier invalidation and the commit would cache the
+        # old price for the whole TTL
+        from core.service import protocol_price_cache
+
+        protocol_price_cache.invalidate(protocol_id)
+
     async def _generate_protocol_data(
         self,
         opts: GenerateProtocolDataCommandOptions,
+        executor: Executor | None = None,
+        seed: int | None = None,
+        output: str | None = None,
+    ) -> tuple[int, int, int]:
+        from core.service import FileSink
+
+        output = output or opts.output
+        if not output:
+            result = await self._generate_protocol_data_into_db(
+                opts,
+                executor,
+                seed,
+            )
+            self._invalidate_protocol_price(result[0])
+            return result
+        # exports do not touch the database
+        sink = FileSink(
+            directory=output,
+            file_format=opts.format,
+            row_group_size=opts.chunk,
+        )
+        return await self._run_generator(opts, sink, executor, seed)
+
+    @inject_session
+    async def _generate_protocol_data_into_db(
+        self,
+        opts: GenerateProtocolDataCommandOptions,
+        executor: Executor | None,
+        seed: int | None,
+        *,
+        session: AsyncSession,
+    ) -> tuple[int, int, int]:
+        from core.service import DatabaseSink
+
+        sink = DatabaseSink(
+            base_repo=BaseRepo(session),
+            bulk_repo=BulkRepo(session),
+            protocol_token_repo=ProtocolTokenRepo(session),
+            tvl_history_repo=TVLHistoryRepo(session),
+            partition_repo=PartitionRepo(session),
+            generation_progress_repo=GenerationProgressRepo(session),
+            load=opts.load,
+            rebuild_indexes=opts.rebuild_indexes,
+            account_repo=AccountRepo(session),
+        )
+        return await self._run_generator(opts, sink, executor, seed)
+
+    async def _run_generator(
+        self,
+        opts: GenerateProtocolDataCommandOptions,
+        sink: "OutputSink",
+        executor: Executor | None,
+        seed: int | None,
+    ) -> tuple[int, int, int]:
+        from core.service import ProtocolDataGeneratorService
+
+        with contextlib.ExitStack() as stack:
+            if executor is None and opts.shards > 1:
+                executor = stack.enter_context(
+                    ProcessPoolExecutor(max_workers=opts.shards)
+                )
+            protocol_generator_service = ProtocolDataGeneratorService(
+                sink=sink,
+                executor=executor,
+                shards=opts.shards,
+                seed=opts.seed if seed is None else seed,
+            )
+            protocol_id = await protocol_generator_service.generate_all(opts)
+        return (
+            protocol_id,
+            protocol_generator_service.rows_written,
+            protocol_generator_service.seed,
+        )
+
+    @inject_session
+    async def _grow_account_pool(
+        self,
+        opts: GrowAccountPoolCommandOptions,
         *,
         session: AsyncSession,
     ) -> int:
-        base_repo = BaseRepo(session)
-        protocol_token_repo = ProtocolTokenRepo(session)
-        tvl_history_repo = TVLHistoryRepo(session)
+        from core.service import DatabaseSink
+        from core.service import ProtocolDataGeneratorService
+
+        sink = DatabaseSink(
+            base_repo=BaseRepo(session),
+            bulk_repo=BulkRepo(session),
+            protocol_token_repo=ProtocolTokenRepo(session),
+            tvl_history_repo=TVLHistoryRepo(session),
+            partition_repo=PartitionRepo(session),
+        )
         protocol_generator_service = ProtocolDataGeneratorService(
-            base_repo=base_repo,
-            protocol_token_repo=protocol_token_repo,
-            tvl_history_repo=tvl_history_repo,
+            sink=sink,
+            seed=opts.seed,
+        )
+        await protocol_generator_service.generate_and_write_accounts(
+            accounts_number=opts.accounts,
+            chunk_size=opts.chunk,
+        )
+        return protocol_generator_service.seed
+
+    @inject_session
+    async def _resume_generation(
+        self,
+        opts: ResumeGenerationCommandOptions,
+        *,
+        session: AsyncSession,
+    ) -> int:
+        from core.service import DatabaseSink
+        from core.service import ProtocolDataGeneratorService
+
+        generation_progress_repo = GenerationProgressRepo(session)
+        progress = await generation_progress_repo.get_progress(opts.protocol)
+        if progress is None:
+            raise ValueError(
+                f"There is no generation progress of protocol {opts.protocol}."
+            )
+        if progress.finished_at is not None:
+            raise ValueError(
+                f"Generation of protocol {opts.protocol} is already finished."
+            )
+
+        sink = DatabaseSink(
+            base_repo=BaseRepo(session),
+            bulk_repo=BulkRepo(session),
+            protocol_token_repo=ProtocolTokenRepo(session),
+            tvl_history_repo=TVLHistoryRepo(session),
+            partition_repo=PartitionRepo(session),
+            generation_progress_repo=generation_progress_repo,
+            account_repo=AccountRepo(session),
+        )
+        with contextlib.ExitStack() as stack:
+            executor = None
+            if opts.shards > 1:
+                executor = stack.enter_context(
+                    ProcessPoolExecutor(max_workers=opts.shards)
+                )
+            protocol_generator_service = ProtocolDataGeneratorService(
+                sink=sink,
+                executor=executor,
+                shards=opts.shards,
+                seed=progress.seed,
+            )
+            await protocol_generator_service.resume_all(progress)
+        return protocol_generator_service.rows_written
+
+    @inject_session
+    async def _import_protocol_data(
+        self,
+        opts: ImportProtocolDataCommandOptions,
+        *,
+        session: AsyncSession,
+    ) -> tuple[int, int]:
+        from core.service import ProtocolDataImportService
+
+        protocol_import_service = ProtocolDataImportService(
+            bulk_repo=BulkRepo(session),
+            tvl_history_repo=TVLHistoryRepo(session),
+            partition_repo=PartitionRepo(session),
+            protocol_token_repo=ProtocolTokenRepo(session),
         )
-        return await protocol_generator_service.generate_all(opts)
+        protocol_id = await protocol_import_service.import_all(opts)
+        return protocol_id, protocol_import_service.rows_written
+
+    async def _generate_protocols(
+        self,
+        opts: GenerateProtocolsCommandOptions,
+    ) -> list[tuple[int, int, int] | BaseException]:
+        """
+        Results of protocols in order, a failed protocol gives its
+        exception, so the other ones are still generated and committed.
+        """
+        if not opts.output:
+            # once, before the protocols open their sessions concurrently
+            await ensure_db()
+        semaphore = asyncio.Semaphore(opts.parallelism)
+
+        async def generate_protocol_data(executor: Executor, i: int):
+            seed = None if opts.seed is None else opts.seed + i
+            # exported protocols are written to subdirectories 0, 1, ...
+            output = opts.output and os.path.join(opts.output, str(i))
+            async with semaphore:
+                return await self._generate_protocol_data(
+                    opts,
+                    executor,
+                    seed,
+                    output,
+                )
+
+        # each protocol is written over its own pooled session while numpy
+        # generation of all of them is spread over worker processes
+        with ProcessPoolExecutor(max_workers=opts.parallelism) as executor:
+            return await asyncio.gather(
+                *(
+                    generate_protocol_data(executor, i)
+                    for i in range(opts.count)
+                ),
+                return_exceptions=True,
+            )
 
     @inject_session
     async def _get_current_deposit(
@@ -88,9 +596,106 @@ class _ProtocolGeneratorShellHandler(cmd.Cmd):
         *,
         session: AsyncSession,
     ) -> Decimal:
+        from core.service import ProtocolPriceService
+
         tvl_history_repo = TVLHistoryRepo(session)
         protocol_generator_service = ProtocolPriceService(tvl_history_repo)
         return await protocol_generator_service.get_protocol_price(opts)
 
+    @inject_session
+    async def _get_current_deposits(
+        self,
+        opts: GetCurrentDepositsCommandOptions,
+        *,
+        session: AsyncSession,
+    ) -> dict[int, Decimal]:
+        from core.service import ProtocolPriceService
+
+        tvl_history_repo = TVLHistoryRepo(session)
+        protocol_price_service = ProtocolPriceService(tvl_history_repo)
+        return await protocol_price_service.get_protocol_prices(opts)
+
+    @inject_session
+    async def _get_deposit_at(
+        self,
+        opts: GetDepositAtCommandOptions,
+        *,
+        session: AsyncSession,
+    ) -> Row:
+        from core.service import ProtocolPriceService
+
+        tvl_history_repo = TVLHistoryRepo(session)
+        protocol_price_service = ProtocolPriceService(tvl_history_repo)
+        return await protocol_price_service.get_protocol_price_at(opts)
+
+    @inject_session
+    async def _get_top_protocols(
+        self,
+        opts: TopProtocolsCommandOptions,
+        *,
+        session: AsyncSession,
+    ) -> list[Row]:
+        from core.service import ProtocolPriceService
+
+        tvl_history_repo = TVLHistoryRepo(session)
+        protocol_price_service = ProtocolPriceService(tvl_history_repo)
+        return await protocol_price_service.get_top_protocols(opts)
+
+    @inject_session
+    async def _calculate_tvl_history(
+        self,
+        opts: CalculateTVLHistoryCommandOptions,
+        *,
+        session: AsyncSession,
+    ) -> int:
+        from core.service import TVLHistoryService
+
+        tvl_history_repo = TVLHistoryRepo(session)
+        tvl_history_service = TVLHistoryService(tvl_history_repo)
+        return await tvl_history_service.calculate_history(opts)
+
+    @inject_session
+    async def _get_tvl_history(
+        self,
+        opts: GetTVLHistoryCommandOptions,
+        *,
+        session: AsyncSession,
+    ) -> list[Row]:
+        from core.service import TVLHistoryService
+
+        tvl_history_repo = TVLHistoryRepo(session)
+        tvl_history_service = TVLHistoryService(tvl_history_repo)
+        return await tvl_history_service.get_history(opts)
+
+    @inject_session
+    async def _drop_history_before(
+        self,
+        opts: DropHistoryBeforeCommandOptions,
+        *,
+        session: AsyncSession,
+    ) -> list[str]:
+        from core.service import PartitionService
+
+        partition_repo = PartitionRepo(session)
+        partition_service = PartitionService(partition_repo)
+        return await partition_service.drop_history_before(opts)
+
+    @inject_session
+    async def _compact_token_prices(
+        self,
+        opts: CompactTokenPricesCommandOptions,
+        *,
+        session: AsyncSession,
+    ) -> tuple[dt.datetime, int, list[str], int]:
+        from core.service import TokenPriceCompactionService
+
+        token_price_repo = TokenPriceRepo(session)
+        partition_repo = PartitionRepo(session)
+        compaction_service = TokenPriceCompactionService(
+            token_price_repo,
+            partition_repo,
+        )
+        return await compaction_service.compact(opts)
+
 
 protocol_generator_shell_handler = _ProtocolGeneratorShellHandler()
@@ -1,13 +1,32 @@
 import argparse
 import datetime as dt
+import shlex
 
 from pydantic import BaseModel
 from pydantic import Field
 from pydantic import root_validator
 from pydantic import validator
+from typing import Literal
 from typing import Optional
 from typing import Self
 
+from core.config import settings
+
+
+def _to_utc(value) -> dt.datetime:
+    """
+    Parses dates of commands as UTC, naive ones included, so a command
+    gives the same results on any host: asyncpg binds naive dates in the
+    time zone of the host.
+    """
+    if isinstance(value, str):
+        value = dt.datetime.fromisoformat(value)
+    if isinstance(value, dt.datetime):
+        if value.tzinfo is None:
+            return value.replace(tzinfo=dt.timezone.utc)
+        return value.astimezone(dt.timezone.utc)
+    return value
+
 
 class CommandOptions(BaseModel):
     @classmethod
@@ -16,7 +35,7 @@ class CommandOptions(BaseModel):
         for field in cls.__fields__.keys():
             parser.add_argument(f"--{field}", type=str)
 
-        opts, _ = parser.parse_known_args(arg.split())
+        opts, _ = parser.parse_known_args(shlex.split(arg))
         return cls(**{
             key: value
             for key, value in vars(opts).items()
@@ -27,19 +46,30 @@ class CommandOptions(BaseModel):
 class GenerateProtocolDataCommandOptions(CommandOptions):
     accounts: Optional[int] = Field(100)
     start: Optional[dt.datetime] = Field(
-        default_factory=lambda: dt.datetime.now() - dt.timedelta(days=5),
+        default_factory=lambda: (
+            dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=5)
+        ),
     )
     end: Optional[dt.datetime] = Field(
-        default_factory=lambda: dt.datetime.now(),
+        default_factory=lambda: dt.datetime.now(dt.timezone.utc),
     )
     deposit: Optional[float] = Field(2_000_000)
+    chunk: Optional[int] = Field(
+        default_factory=lambda: settings.generation_chunk_size,
+        gt=0,
+    )
+    seed: Optional[int] = Field(None, ge=0)
+    shards: Optional[int] = Field(1, gt=0)
+    output: Optional[str] = Field(None)
+    format: Literal["parquet", "csv"] = Field("parquet")
+    tvl: Literal["numpy", "sql"] = Field("numpy")
+    load: Literal["direct", "staged"] = Field("direct")
+    rebuild_indexes: Optional[bool] = Field(False)
+    account_pool: Optional[bool] = Field(False)
 
     @validator("start", "end", pre=True)
     def parse_date(cls, value) -> dt.datetime:
-        if isinstance(value, str):
-            return dt.datetime.fromisoformat(value)
-        else:
-            return value
+        return _to_utc(value)
 
     @root_validator
     def validate_dates(cls, values: dict) -> dict:
@@ -47,6 +77,120 @@ class GenerateProtocolDataCommandOptions(CommandOptions):
             raise ValueError("end date cannot be before start date")
         return values
 
+    @root_validator(skip_on_failure=True)
+    def validate_account_pool(cls, values: dict) -> dict:
+        if values["account_pool"] and values["output"]:
+            raise ValueError("account pool is only kept in the database")
+        return values
+
+
+class GenerateProtocolsCommandOptions(GenerateProtocolDataCommandOptions):
+    count: Optional[int] = Field(10, gt=0)
+    parallelism: Optional[int] = Field(
+        default_factory=lambda: settings.pg_pool_size,
+        gt=0,
+    )
+
+
+class GrowAccountPoolCommandOptions(CommandOptions):
+    accounts: int = Field(..., gt=0)
+    chunk: Optional[int] = Field(
+        default_factory=lambda: settings.generation_chunk_size,
+        gt=0,
+    )
+    seed: Optional[int] = Field(None, ge=0)
+
+
+class ResumeGenerationCommandOptions(CommandOptions):
+    protocol: int = Field(...)
+    shards: Optional[int] = Field(1, gt=0)
+
+
+class ImportProtocolDataCommandOptions(CommandOptions):
+    path: str = Field(...)
+    chunk: Optional[int] = Field(
+        default_factory=lambda: settings.generation_chunk_size,
+        gt=0,
+    )
+
 
 class GetCurrentDepositCommandOptions(CommandOptions):
     protocol: int = Field(...)
+
+
+class GetCurrentDepositsCommandOptions(CommandOptions):
+    protocols: list[int] = Field(..., min_items=1)
+
+    @validator("protocols", pre=True)
+    def parse_protocols(cls, value) -> list:
+        if isinstance(value, str):
+            return value.split(",")
+        else:
+            return value
+
+
+class GetDepositAtCommandOptions(CommandOptions):
+    protocol: int = Field(...)
+    block: Optional[int] = Field(None, ge=0)
+    at: Optional[dt.datetime] = Field(None)
+
+    @validator("at", pre=True)
+    def parse_date(cls, value) -> dt.datetime:
+        return _to_utc(value)
+
+    @root_validator(skip_on_failure=True)
+    def validate_target(cls, values: dict) -> dict:
+        if (values["block"] is None) == (values["at"] is None):
+            raise ValueError("exactly one of block and at is required")
+        return values
+
+
+class TopProtocolsCommandOptions(CommandOptions):
+    limit: Optional[int] = Field(10, gt=0)
+
+
+class CalculateTVLHistoryCommandOptions(CommandOptions):
+    protocol: int = Field(...)
+    mode: Literal["incremental", "full"] = Field("incremental")
+
+
+class GetTVLHistoryCommandOptions(CommandOptions):
+    protocol: int = Field(...)
+    start: dt.datetime = Field(...)
+    end: dt.datetime = Field(...)
+    resolution: Literal["hour", "day"] = Field("day")
+
+    @validator("start", "end", pre=True)
+    def parse_date(cls, value) -> dt.datetime:
+        return _to_utc(value)
+
+    @root_validator(skip_on_failure=True)
+    def validate_dates(cls, values: dict) -> dict:
+        if values["end"] < values["start"]:
+            raise ValueError("end date cannot be before start date")
+        return values
+
+
+class DropHistoryBeforeCommandOptions(CommandOptions):
+    before: dt.datetime = Field(...)
+
+    @validator("before", pre=True)
+    def parse_date(cls, value) -> dt.datetime:
+        return _to_utc(value)
+
+
+class CompactTokenPricesCommandOptions(CommandOptions):
+    age: Optional[int] = Field(
+        default_factory=lambda: settings.token_price_compaction_age_days,
+        gt=0,
+    )
+    archive: Optional[str] = Field(None)
+    chunk: Optional[int] = Field(
+        default_factory=lambda: settings.generation_chunk_size,
+        gt=0,
+    )
+
+
+class StatsCommandOptions(CommandOptions):
+    reset: Optional[bool] = Field(False)
+    dump: Optional[str] = Field(None)
@@ -0,0 +1,119 @@
+import re
+import time
+
+from contextlib import contextmanager
+from pydantic import BaseModel
+from pydantic import Field
+from typing import ClassVar
+from typing import Iterator
+
+
+class PhaseStats(BaseModel):
+    calls: int = 0
+    seconds: float = 0.0
+    rows: int = 0
+
+    def merge(self, other: "PhaseStats"):
+        self.calls += other.calls
+        self.seconds += other.seconds
+        self.rows += other.rows
+
+
+class StatementStats(BaseModel):
+    calls: int = 0
+    seconds: float = 0.0
+    max_seconds: float = 0.0
+
+    def merge(self, other: "StatementStats"):
+        self.calls += other.calls
+        self.seconds += other.seconds
+        self.max_seconds = max(self.max_seconds, other.max_seconds)
+
+
+class CacheStats(BaseModel):
+    hits: int = 0
+    misses: int = 0
+
+    def merge(self, other: "CacheStats"):
+        self.hits += other.hits
+        self.misses += other.misses
+
+
+class Stats(BaseModel):
+    """
+    Wall time and rows per named phase (e.g. `generate`, `copy`,
+    `calculate_tvl`), time per executed SQL statement and hits and misses
+    per cache.
+    """
+    phases: dict[str, PhaseStats] = Field(default_factory=dict)
+    statements: dict[str, StatementStats] = Field(default_factory=dict)
+    caches: dict[str, CacheStats] = Field(default_factory=dict)
+
+    statement_key_length: ClassVar[int] = 80
+
+    def reset(self):
+        self.phases.clear()
+        self.statements.clear()
+        self.caches.clear()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[PhaseStats]:
+        """
+        Measures the wrapped block as one call of the phase. Rows can be
+        added to the yielded phase stats.
+        """
+        phase = PhaseStats(calls=1)
+        started_at = time.perf_counter()
+        try:
+            yield phase
+        finally:
+            phase.seconds = time.perf_counter() - started_at
+            self.phases.setdefault(name, PhaseStats()).merge(phase)
+
+    def record_statement(self, statement: str, seconds: float):
+        key = re.sub(r"\s+", " ", statement).strip()
+        key = key[:self.statement_key_length]
+        self.statements.setdefault(key, StatementStats()).merge(
+            StatementStats(calls=1, seconds=seconds, max_seconds=seconds)
+        )
+
+    def record_cache(self, name: str, hit: bool):
+        self.caches.setdefault(name, CacheStats()).merge(
+            CacheStats(hits=int(hit), misses=int(not hit))
+        )
+
+    def merge(self, other: "Stats"):
+        for name, phase in other.phases.items():
+            self.phases.setdefault(name, PhaseStats()).merge(phase)
+        for key, statement in other.statements.items():
+            self.statements.setdefault(key, StatementStats()).merge(statement)
+        for name, cache in other.caches.items():
+            self.caches.setdefault(name, CacheStats()).merge(cache)
+
+    def format(self) -> str:
+        lines = ["phase: calls, seconds, rows"]
+        for name, phase in sorted(self.phases.items()):
+            lines.append(
+                f"  {name}: {phase.calls}, {phase.seconds:.3f}, {phase.rows}"
+            )
+
+        lines.append("statement: calls, seconds, max seconds")
+        statements = sorted(
+            self.statements.items(),
+            key=lambda item: item[1].seconds,
+            reverse=True,
+        )
+        for key, statement in statements:
+            lines.append(
+                f"  {key}: {statement.calls}, {statement.seconds:.3f}, "
+                f"{statement.max_seconds:.3f}"
+            )
+
+        lines.append("cache: hits, misses")
+        for name, cache in sorted(self.caches.items()):
+            lines.append(f"  {name}: {cache.hits}, {cache.misses}")
+        return "\n".join(lines)
+
+
+# stats of the running command, collected by services, repos and db engine
+stats = Stats()
@@ -0,0 +1,165 @@
+import asyncio
+import pytest
+
+from decimal import Decimal
+from pytest_mock import MockerFixture
+
+from core.cache import AsyncTTLCache
+from core.db.repo import TVLHistoryRepo
+from core.service import ProtocolPriceService
+from core.shell.model import GetCurrentDepositCommandOptions
+from core.shell.model import GetCurrentDepositsCommandOptions
+from core.stats import stats
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _loader(calls: list, value):
+    async def load():
+        calls.append(value)
+        await asyncio.sleep(0)
+        return value
+    return load
+
+
+@pytest.mark.asyncio
+async def test_cache_ttl_and_lru_eviction():
+    clock = _Clock()
+    cache = AsyncTTLCache("test", maxsize=2, ttl=10, clock=clock)
+    calls = []
+
+    assert await cache.get_or_load(1, _loader(calls, "a")) == "a"
+    assert await cache.get_or_load(1, _loader(calls, "b")) == "a"
+    await cache.get_or_load(2, _loader(calls, "c"))
+    # 1 was used after 2, so 2 is evicted by 3
+    await cache.get_or_load(1, _loader(calls, "x"))
+    await cache.get_or_load(3, _loader(calls, "d"))
+    assert list(cache.entries) == [1, 3]
+
+    clock.now = 10
+    assert await cache.get_or_load(1, _loader(calls, "e")) == "e"
+    assert calls == ["a", "c", "d", "e"]
+    assert (cache.hits, cache.misses) == (2, 4)
+
+
+@pytest.mark.asyncio
+async def test_cache_loads_concurrent_misses_once_and_invalidates():
+    cache = AsyncTTLCache("test", maxsize=10, ttl=10)
+    calls = []
+
+    values = await asyncio.gather(*(
+        cache.get_or_load(1, _loader(calls, "a")) for _ in range(5)
+    ))
+    assert values == ["a"] * 5
+    assert calls == ["a"]
+
+    cache.invalidate(1)
+    assert await cache.get_or_load(1, _loader(calls, "b")) == "b"
+    assert await cache.get_or_load(2, _loader(calls, None)) is None
+    assert 2 not in cache.entries
+
+
+@pytest.mark.asyncio
+async def test_cache_cancelled_load_cancels_waiters():
+    cache = AsyncTTLCache("test", maxsize=10, ttl=10)
+    started = asyncio.Event()
+
+    async def load():
+        started.set()
+        await asyncio.sleep(10)
+
+    loading = asyncio.create_task(cache.get_or_load(1, load))
+    await started.wait()
+    waiting = asyncio.create_task(cache.get_or_load(1, load))
+    waiting_many = asyncio.create_task(cache.get_or_load_many([1], load))
+    await asyncio.sleep(0)
+    loading.cancel()
+
+    for task in (loading, waiting, waiting_many):
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(task, 1)
+    assert 1 not in cache.loading
+    assert await cache.get_or_load(1, _loader([], "a")) == "a"
+
+
+@pytest.mark.asyncio
+async def test_protocol_price_is_cached(mocker: MockerFixture):
+    stats.reset()
+    tvl_history_repo = TVLHistoryRepo(mocker.AsyncMock())
+    get_price = mocker.patch.object(
+        tvl_history_repo,
+        "get_current_protocol_price",
+        return_value=(Decimal(10),),
+    )
+    service = ProtocolPriceService(
+        tvl_history_repo,
+        cache=AsyncTTLCache("protocol_price", maxsize=10, ttl=10),
+    )
+    options = GetCurrentDepositCommandOptions(protocol=1)
+
+    assert await service.get_protocol_price(options) == Decimal(10)
+    assert await service.get_protocol_price(options) == Decimal(10)
+    assert get_price.await_count == 1
+    assert stats.caches["protocol_price"].hits == 1
+
+    get_price.return_value = None
+    with pytest.raises(ValueError):
+        await service.get_protocol_price(
+            GetCurrentDepositCommandOptions(protocol=2)
+        )
+
+
+@pytest.mark.asyncio
+async def test_cache_loads_missing_keys_at_once():
+    cache = AsyncTTLCache("test", maxsize=10, ttl=10)
+    calls = []
+
+    async def load(keys: list) -> dict:
+        calls.append(keys)
+        await asyncio.sleep(0)
+        return {key: str(key) for key in keys if key != 4}
+
+    await cache.get_or_load(1, _loader(calls, "a"))
+    values = await asyncio.gather(
+        cache.get_or_load_many([1, 2, 3, 4, 2], load),
+        cache.get_or_load(3, _loader(calls, "x")),
+    )
+
+    assert values == [{1: "a", 2: "2", 3: "3"}, "3"]
+    assert calls == ["a", [2, 3, 4]]
+    assert list(cache.entries) == [1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_protocol_prices_are_read_with_one_query(
+    mocker: MockerFixture,
+):
+    tvl_history_repo = TVLHistoryRepo(mocker.AsyncMock())
+    get_prices = mocker.patch.object(
+        tvl_history_repo,
+        "get_current_protocol_prices",
+        return_value={2: Decimal(20), 1: Decimal(10)},
+    )
+    service = ProtocolPriceService(
+        tvl_history_repo,
+        cache=AsyncTTLCache("protocol_price", maxsize=10, ttl=10),
+    )
+    options = GetCurrentDepositsCommandOptions.parse_args("--protocols 1,2")
+
+    assert await service.get_protocol_prices(options) == {
+        1: Decimal(10),
+        2: Decimal(20),
+    }
+    get_prices.assert_awaited_once_with([1, 2])
+
+    with pytest.raises(ValueError, match=r"\[3\]"):
+        await service.get_protocol_prices(
+            GetCurrentDepositsCommandOptions(protocols=[2, 3])
+        )
+    get_prices.assert_awaited_with([3])
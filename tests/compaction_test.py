@@ -0,0 +1,159 @@
+import datetime as dt
+import pyarrow.parquet as pq
+import pytest
+
+from decimal import Decimal
+from freezegun import freeze_time
+from pytest_mock import MockerFixture
+from types import SimpleNamespace
+
+from core.db.repo import PartitionRepo
+from core.db.repo import TokenPriceRepo
+from core.service import TokenPriceCompactionService
+from core.service.compaction import compaction_cutoff
+from core.shell.model import CompactTokenPricesCommandOptions
+
+
+def test_compaction_cutoff_is_utc_month_start():
+    now = dt.datetime(
+        2022, 3, 10, 12, 45, 30,
+        tzinfo=dt.timezone(dt.timedelta(hours=3)),
+    )
+
+    before = compaction_cutoff(now, dt.timedelta(days=30))
+
+    assert before == dt.datetime(2022, 2, 1, tzinfo=dt.timezone.utc)
+
+
+@freeze_time("2022-03-10T12:00:00+00:00")
+@pytest.mark.asyncio
+async def test_compact_drops_compacted_partitions(mocker: MockerFixture):
+    session = mocker.AsyncMock()
+    token_price_repo = TokenPriceRepo(session)
+    partition_repo = PartitionRepo(session)
+    mocker.patch.object(
+        token_price_repo,
+        "compact_before",
+        return_value=2,
+    )
+    mocker.patch.object(token_price_repo, "delete_before", return_value=0)
+    drop_partitions_before = mocker.patch.object(
+        partition_repo,
+        "drop_partitions_before",
+        return_value=["token_price_p202201"],
+    )
+    service = TokenPriceCompactionService(token_price_repo, partition_repo)
+
+    result = await service.compact(
+        CompactTokenPricesCommandOptions(age=30, chunk=100)
+    )
+
+    before = dt.datetime(2022, 2, 1, tzinfo=dt.timezone.utc)
+    assert result == (before, 2, ["token_price_p202201"], 0)
+    token_price_repo.compact_before.assert_awaited_once_with(before)
+    drop_partitions_before.assert_awaited_once_with(
+        before,
+        tables=("token_price",),
+    )
+    # rows are not deleted one by one from partitioned tables
+    session.commit.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_archive_writes_ticks_to_parquet(
+    mocker: MockerFixture,
+    tmp_path,
+):
+    created_at = dt.datetime(2022, 1, 1, 10, 20, tzinfo=dt.timezone.utc)
+    batches = [
+        [SimpleNamespace(
+            token_id=1,
+            usd_price=Decimal("1.2500000001"),
+            created_at=created_at,
+        )],
+        [SimpleNamespace(
+            token_id=2,
+            usd_price=Decimal("3"),
+            created_at=created_at,
+        )],
+    ]
+
+    async def iter_ticks_before(before, batch_size):
+        for batch in batches:
+            yield batch
+
+    token_price_repo = TokenPriceRepo(mocker.AsyncMock())
+    mocker.patch.object(
+        token_price_repo,
+        "iter_ticks_before",
+        side_effect=iter_ticks_before,
+    )
+    service = TokenPriceCompactionService(
+        token_price_repo,
+        PartitionRepo(token_price_repo.session),
+    )
+
+    before = dt.datetime(2022, 2, 8, 9, tzinfo=dt.timezone.utc)
+    archived_at = dt.datetime(2022, 3, 1, 12, tzinfo=dt.timezone.utc)
+    path = await service.archive(
+        before,
+        str(tmp_path),
+        batch_size=1,
+        archived_at=archived_at,
+    )
+
+    assert path.endswith(
+        "token_price_before_20220208T0900_at_20220301T120000000000.parquet"
+    )
+    table = pq.read_table(path)
+    assert table.column("token_id").to_pylist() == [1, 2]
+    assert table.column("usd_price").to_pylist() == [
+        Decimal("1.2500000001"),
+        Decimal("3"),
+    ]
+    assert table.column("created_at").to_pylist() == [created_at] * 2
+
+
+@pytest.mark.asyncio
+async def test_second_archive_keeps_first_one(
+    mocker: MockerFixture,
+    tmp_path,
+):
+    created_at = dt.datetime(2022, 1, 1, 10, 20, tzinfo=dt.timezone.utc)
+    # partitions are dropped by the first run, the second one finds nothing
+    runs = iter([
+        [[SimpleNamespace(token_id=1, usd_price=1, created_at=created_at)]],
+        [],
+    ])
+
+    async def iter_ticks_before(before, batch_size):
+        for batch in next(runs):
+            yield batch
+
+    token_price_repo = TokenPriceRepo(mocker.AsyncMock())
+    mocker.patch.object(
+        token_price_repo,
+        "iter_ticks_before",
+        side_effect=iter_ticks_before,
+    )
+    service = TokenPriceCompactionService(
+        token_price_repo,
+        PartitionRepo(token_price_repo.session),
+    )
+    before = dt.datetime(2022, 2, 1, tzinfo=dt.timezone.utc)
+    archived_at = dt.datetime(2022, 3, 1, 12, tzinfo=dt.timezone.utc)
+
+    first = await service.archive(before, str(tmp_path), 10, archived_at)
+    second = await service.archive(
+        before,
+        str(tmp_path),
+        10,
+        archived_at + dt.timedelta(days=1),
+    )
+
+    assert first != second
+    assert pq.read_table(first).column("token_id").to_pylist() == [1]
+    assert pq.read_table(second).num_rows == 0
+    with pytest.raises(FileExistsError):
+        await service.archive(before, str(tmp_path), 10, archived_at)
+    assert pq.read_table(first).num_rows == 1
@@ -3,8 +3,11 @@ import pytest
 from pytest_mock import MockerFixture
 
 from core.db.repo import BaseRepo
+from core.db.repo import BulkRepo
+from core.db.repo import PartitionRepo
 from core.db.repo import ProtocolTokenRepo
 from core.db.repo import TVLHistoryRepo
+from core.service import DatabaseSink
 from core.service import ProtocolDataGeneratorService
 
 
@@ -15,12 +18,17 @@ def protocol_data_generator_service(
     db_session = mocker.AsyncMock()
 
     base_repo = BaseRepo(db_session)
+    bulk_repo = BulkRepo(db_session)
     protocol_token_repo = ProtocolTokenRepo(db_session)
     tvl_history_repo = TVLHistoryRepo(db_session)
+    partition_repo = PartitionRepo(db_session)
 
-    service = ProtocolDataGeneratorService(
+    sink = DatabaseSink(
         base_repo=base_repo,
+        bulk_repo=bulk_repo,
         protocol_token_repo=protocol_token_repo,
         tvl_history_repo=tvl_history_repo,
+        partition_repo=partition_repo,
     )
+    service = ProtocolDataGeneratorService(sink=sink)
     return service
@@ -0,0 +1,74 @@
+import datetime as dt
+import pytest
+
+from pytest_mock import MockerFixture
+from sqlmodel import SQLModel
+
+from core.db import _after_cursor_execute
+from core.db import _before_cursor_execute
+from core.db import _handle_error
+from core.db import create_missing_indexes
+from core.db import init_db
+from core.db import schema_version
+from core.stats import stats
+
+
+@pytest.mark.asyncio
+async def test_create_missing_indexes(mocker: MockerFixture):
+    missing = "ix_tvl_history_protocol_token_id_created_at"
+    conn = mocker.AsyncMock()
+    conn.scalar.side_effect = (
+        lambda statement, params: params["name"] != missing
+    )
+
+    created = await create_missing_indexes(conn)
+
+    assert created == [missing]
+    index = conn.run_sync.call_args.args[0].__self__
+    assert index.name == missing
+    assert index.table is SQLModel.metadata.tables["tvl_history"]
+
+
+def test_failed_statement_does_not_shift_timings(mocker: MockerFixture):
+    stats.reset()
+    conn = mocker.MagicMock(info={})
+    perf_counter = mocker.patch("core.db.time.perf_counter")
+
+    perf_counter.return_value = 1
+    failed = object()
+    _before_cursor_execute(conn, None, "SELECT x", {}, failed, False)
+    _handle_error(mocker.MagicMock(connection=conn, execution_context=failed))
+
+    perf_counter.return_value = 10
+    context = object()
+    _before_cursor_execute(conn, None, "SELECT 1", {}, context, False)
+    perf_counter.return_value = 10.5
+    _after_cursor_execute(conn, None, "SELECT 1", {}, context, False)
+
+    assert conn.info["statement_started_at"] == {}
+    assert stats.statements["SELECT 1"].seconds == 0.5
+
+
+@pytest.mark.asyncio
+async def test_init_db_ensures_partitions_of_current_schema(
+    mocker: MockerFixture,
+):
+    conn = mocker.AsyncMock()
+    conn.scalar.side_effect = [True, schema_version()]
+    db_engine = mocker.patch("core.db.db_engine")
+    db_engine.begin.return_value.__aenter__.return_value = conn
+    session = mocker.AsyncMock()
+    get_session = mocker.patch("core.db.get_session")
+    get_session.return_value.__aenter__.return_value = session
+    ensure_partitions = mocker.patch(
+        "core.db.repo.PartitionRepo.ensure_partitions"
+    )
+    mocker.patch("core.db._db_initialized", False)
+
+    await init_db()
+
+    # a current schema is not created again, but a new month may have begun
+    conn.run_sync.assert_not_awaited()
+    session.execute.assert_not_awaited()
+    start = ensure_partitions.await_args.kwargs["start"]
+    assert start.tzinfo is dt.timezone.utc
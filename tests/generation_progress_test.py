@@ -0,0 +1,26 @@
+import pytest
+
+from pytest_mock import MockerFixture
+
+from core.db.repo import GenerationProgressRepo
+
+
+@pytest.mark.asyncio
+async def test_get_account_ids_by_wallet_address_binds_one_array(
+    mocker: MockerFixture,
+):
+    session = mocker.AsyncMock()
+    session.execute.return_value.all = mocker.Mock(
+        return_value=[("00", 1)],
+    )
+    wallet_addresses = [f"{i:040x}" for i in range(40_000)]
+
+    account_ids = await GenerationProgressRepo(
+        session
+    ).get_account_ids_by_wallet_address(wallet_addresses)
+
+    assert account_ids == {"00": 1}
+    statement, params = session.execute.call_args.args
+    # asyncpg takes at most 32767 arguments per statement
+    assert list(statement.compile().params) == ["wallet_addresses"]
+    assert params == {"wallet_addresses": wallet_addresses}
@@ -1,7 +1,19 @@
+import datetime as dt
+import numpy as np
 import pytest
 import string
 
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+from pytest_mock import MockerFixture
+
+from core.db.model import ProtocolToken
+from core.service import OutputSink
 from core.service import ProtocolDataGeneratorService
+from core.service.engine import BalanceHistoryFrame
+from core.service.engine import ColumnarGenerationEngine
+from core.service.engine import TokenPriceFrame
+from core.shell.model import GenerateProtocolDataCommandOptions
 
 
 @pytest.mark.asyncio
@@ -41,3 +53,314 @@ async def test_generate_accounts(
 
     assert len(accounts) == accounts_number
     assert set(map(lambda acc: len(acc.wallet_address), accounts)) == {40}
+
+
+@pytest.mark.asyncio
+async def test_generate_balance_history_and_token_price(
+    protocol_data_generator_service: ProtocolDataGeneratorService,
+    mocker: MockerFixture,
+):
+    protocol = (
+        await protocol_data_generator_service.generate_protocol_with_tokens()
+    )
+    for i, token in enumerate(protocol.tokens, start=1):
+        token.id = i
+    protocol_tokens = [
+        ProtocolToken(id=token.id, token_id=token.id)
+        for token in protocol.tokens
+    ]
+    mocker.patch.object(
+        protocol_data_generator_service.sink.protocol_token_repo,
+        "get_protocol_token_by_protocol_id",
+        return_value=protocol_tokens,
+    )
+
+    account_ids = np.arange(1, 21)
+
+    frames = [
+        frame
+        async for frame in (
+            protocol_data_generator_service
+            .generate_balance_history_and_token_price(
+                protocol=protocol,
+                account_ids=account_ids,
+                start=dt.datetime(2022, 1, 1),
+                end=dt.datetime(2022, 1, 2),
+                deposit=2_000_000,
+                chunk_size=50,
+            )
+        )
+    ]
+    balance_history = [
+        frame for frame in frames if isinstance(frame, BalanceHistoryFrame)
+    ]
+    token_prices = [
+        frame for frame in frames if isinstance(frame, TokenPriceFrame)
+    ]
+
+    assert all(len(frame) <= 50 for frame in balance_history)
+    # prices are generated by whole slices of ticks
+    assert all(len(frame) <= 144 for frame in token_prices)
+    assert set(np.concatenate(
+        [frame.account_id for frame in balance_history]
+    )) == set(account_ids)
+    assert set(np.concatenate(
+        [frame.created_at_block for frame in balance_history]
+    )) == set(range(25))
+    assert sum(map(len, token_prices)) == 144 * len(protocol.tokens)
+
+
+def test_engine_iter_balance_history():
+    engine = ColumnarGenerationEngine(0)
+    end = dt.datetime(2022, 1, 2)
+
+    frames = list(engine.iter_balance_history(
+        protocol_token_ids=np.arange(1, 11),
+        account_ids=np.arange(100, 200),
+        tokens_per_account=2,
+        final_token_amount=100,
+        start=dt.datetime(2022, 1, 1),
+        end=end,
+        chunk_size=30,
+    ))
+    created_at_block = np.concatenate(
+        [frame.created_at_block for frame in frames]
+    )
+    account_id = np.concatenate([frame.account_id for frame in frames])
+    amount = np.concatenate([frame.amount for frame in frames])
+    created_at = np.concatenate([frame.created_at for frame in frames])
+
+    # final balances are generated by whole slices of accounts
+    assert all(len(frame) <= 30 for frame in frames[:-1])
+    # 24 blocks with 5 changing accounts and a final block with all of them
+    assert len(account_id) == (24 * 5 + 100) * 2
+    final_rows = created_at_block == 24
+    assert set(amount[final_rows]) == {100}
+    assert set(created_at[final_rows]) == {end}
+    assert np.all((85 <= amount) & (amount <= 115))
+
+    block_rows = np.stack([created_at_block, account_id], axis=1)
+    assert len(np.unique(block_rows, axis=0)) == len(account_id) // 2
+
+
+def test_engine_iter_token_prices():
+    engine = ColumnarGenerationEngine(0)
+    end = dt.datetime(2022, 1, 2)
+
+    frames = list(engine.iter_token_prices(
+        token_ids=np.array([1, 2]),
+        final_token_price=200.0,
+        start=dt.datetime(2022, 1, 1),
+        end=end,
+        chunk_size=100,
+    ))
+    records = [record for frame in frames for record in frame.records()]
+
+    assert [len(frame) for frame in frames] == [144, 144]
+    assert len(records) == 2 * 144
+    assert records[0] == (1, Decimal(200), end)
+    assert records[144] == (2, Decimal(200), end)
+    assert all(170 <= price <= 230 for _, price, _ in records)
+
+
+def test_engine_iter_token_prices_without_range():
+    engine = ColumnarGenerationEngine(0)
+    day = dt.datetime(2022, 1, 1)
+
+    jobs = list(engine.iter_token_prices_jobs(
+        token_ids=np.array([1, 2]),
+        final_token_price=200.0,
+        start=day,
+        end=day,
+        chunk_size=100,
+    ))
+
+    assert jobs == []
+
+
+def _call(job):
+    return job()
+
+
+def test_engine_jobs_run_in_process_pool():
+    engine = ColumnarGenerationEngine(0)
+    jobs = engine.iter_token_prices_jobs(
+        token_ids=np.array([1, 2, 3]),
+        final_token_price=200.0,
+        start=dt.datetime(2022, 1, 1),
+        end=dt.datetime(2022, 1, 2),
+        chunk_size=144,
+    )
+
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        frames = list(executor.map(_call, jobs))
+
+    assert [set(frame.token_id) for frame in frames] == [{1}, {2}, {3}]
+    # every token has its own random stream, so chunks do not repeat
+    assert len({tuple(frame.usd_price[1:]) for frame in frames}) == 3
+
+
+def _concatenate(frames) -> dict[str, np.ndarray]:
+    return {
+        column: np.concatenate([getattr(frame, column) for frame in frames])
+        for column in frames[0].columns
+    }
+
+
+def _generate(chunk_size: int, executor=None) -> list[dict[str, np.ndarray]]:
+    engine = ColumnarGenerationEngine(42)
+    start, end = dt.datetime(2022, 1, 1), dt.datetime(2022, 1, 30)
+    balance_history_jobs = engine.iter_balance_history_jobs(
+        protocol_token_ids=np.arange(1, 11),
+        account_ids=np.arange(3000),
+        tokens_per_account=2,
+        final_token_amount=100,
+        start=start,
+        end=end,
+        chunk_size=chunk_size,
+    )
+    token_prices_jobs = engine.iter_token_prices_jobs(
+        token_ids=np.arange(1, 4),
+        final_token_price=200.0,
+        start=start,
+        end=end,
+        chunk_size=chunk_size,
+    )
+    run = executor.map if executor else map
+    return [
+        _concatenate(list(run(_call, balance_history_jobs))),
+        _concatenate(list(run(_call, token_prices_jobs))),
+    ]
+
+
+def test_engine_output_does_not_depend_on_chunks_and_shards():
+    expected = _generate(chunk_size=1_000_000)
+
+    with ProcessPoolExecutor(max_workers=3) as executor:
+        for actual in (_generate(500), _generate(3000, executor)):
+            for expected_table, actual_table in zip(expected, actual):
+                for column, values in expected_table.items():
+                    assert np.array_equal(actual_table[column], values)
+
+    assert not np.array_equal(
+        ColumnarGenerationEngine(43).token_prices(
+            token_ids=np.array([1]),
+            first_token=0,
+            final_token_price=200.0,
+            ticks=range(10),
+            end=dt.datetime(2022, 1, 2),
+        ).usd_price,
+        ColumnarGenerationEngine(42).token_prices(
+            token_ids=np.array([1]),
+            first_token=0,
+            final_token_price=200.0,
+            ticks=range(10),
+            end=dt.datetime(2022, 1, 2),
+        ).usd_price,
+    )
+
+
+@pytest.mark.asyncio
+async def test_generate_protocol_with_tokens_is_seeded(
+    protocol_data_generator_service: ProtocolDataGeneratorService,
+):
+    protocols, accounts = [], []
+    for _ in range(2):
+        service = ProtocolDataGeneratorService(
+            sink=protocol_data_generator_service.sink,
+            seed=7,
+        )
+        protocols.append(await service.generate_protocol_with_tokens())
+        accounts.append(await service.generate_accounts(10))
+
+    assert protocols[0].name == protocols[1].name
+    assert [
+        (token.name, token.symbol, token.decimals)
+        for token in protocols[0].tokens
+    ] == [
+        (token.name, token.symbol, token.decimals)
+        for token in protocols[1].tokens
+    ]
+    assert [account.wallet_address for account in accounts[0]] == [
+        account.wallet_address for account in accounts[1]
+    ]
+
+
+class _MemorySink(OutputSink):
+    """Keeps frames until progress is saved, fails on frame `fail_on`."""
+
+    def __init__(self, fail_on: int | None = None):
+        self.fail_on = fail_on
+        self.frames, self.pending = [], []
+        self.token_ids, self.account_ids = {}, {}
+        self.progress = None
+
+    async def write_protocol(self, protocol):
+        protocol.id = 1
+        for i, token in enumerate(protocol.tokens, start=1):
+            token.id = self.token_ids[token.name] = i
+
+    async def restore_protocol(self, protocol, protocol_id):
+        protocol.id = protocol_id
+        for token in protocol.tokens:
+            token.id = self.token_ids[token.name]
+
+    async def get_protocol_tokens(self, protocol):
+        token_ids = np.array([token.id for token in protocol.tokens])
+        return token_ids, token_ids
+
+    async def write_accounts(self, accounts):
+        for account in accounts:
+            account.id = self.account_ids.setdefault(
+                account.wallet_address,
+                len(self.account_ids) + 1,
+            )
+        return np.array([account.id for account in accounts])
+
+    restore_accounts = write_accounts
+
+    async def write_frame(self, frame):
+        if len(self.frames) + len(self.pending) == self.fail_on:
+            raise RuntimeError("interrupted")
+        self.pending.append(frame)
+
+    async def start_progress(self, progress):
+        self.progress = progress
+
+    async def save_progress(self, protocol_id, committed_jobs):
+        self.frames += self.pending
+        self.pending = []
+        self.progress.committed_jobs = committed_jobs
+
+
+@pytest.mark.asyncio
+async def test_resumed_generation_writes_the_same_data():
+    options = GenerateProtocolDataCommandOptions(
+        accounts=30,
+        start=dt.datetime(2022, 1, 1),
+        end=dt.datetime(2022, 1, 3),
+        chunk=100,
+        tvl="sql",
+    )
+    sink = _MemorySink()
+    await ProtocolDataGeneratorService(sink=sink, seed=3).generate_all(
+        options
+    )
+
+    interrupted_sink = _MemorySink(fail_on=5)
+    with pytest.raises(RuntimeError):
+        await ProtocolDataGeneratorService(
+            sink=interrupted_sink,
+            seed=3,
+        ).generate_all(options)
+    # uncommitted frames are rolled back
+    interrupted_sink.pending, interrupted_sink.fail_on = [], None
+    assert interrupted_sink.progress.committed_jobs == 5
+
+    service = ProtocolDataGeneratorService(sink=interrupted_sink, seed=3)
+    await service.resume_all(interrupted_sink.progress)
+
+    assert service.rows_written == sum(map(len, sink.frames[5:]))
+    assert [list(frame.records()) for frame in interrupted_sink.frames] == [
+        list(frame.records()) for frame in sink.frames
+    ]
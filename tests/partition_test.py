@@ -0,0 +1,103 @@
+import datetime as dt
+import pytest
+
+from pytest_mock import MockerFixture
+
+from core.db.repo import PartitionRepo
+
+
+@pytest.mark.asyncio
+async def test_ensure_partitions_creates_missing_months(
+    mocker: MockerFixture,
+):
+    session = mocker.AsyncMock()
+    partition_repo = PartitionRepo(session)
+    mocker.patch.object(
+        partition_repo,
+        "_get_partitioned_tables",
+        return_value=["token_price"],
+    )
+    mocker.patch.object(
+        partition_repo,
+        "_get_partitions",
+        return_value=["token_price_p202201"],
+    )
+
+    created = await partition_repo.ensure_partitions(
+        start=dt.datetime(2022, 1, 1),
+        end=dt.datetime(2022, 2, 15),
+    )
+
+    assert created == ["token_price_p202112", "token_price_p202202"]
+    statement = str(session.execute.call_args_list[-1].args[0])
+    assert "FROM ('2022-02-01 00:00:00+00') TO ('2022-03-01 00:00:00+00')" in (
+        statement
+    )
+
+
+@pytest.mark.asyncio
+async def test_drop_partitions_before(mocker: MockerFixture):
+    session = mocker.AsyncMock()
+    partition_repo = PartitionRepo(session)
+    mocker.patch.object(
+        partition_repo,
+        "_get_partitioned_tables",
+        return_value=["tvl_history"],
+    )
+    mocker.patch.object(
+        partition_repo,
+        "_get_partitions",
+        return_value=[
+            "tvl_history_p202112",
+            "tvl_history_p202201",
+            "tvl_history_p202202",
+        ],
+    )
+
+    dropped = await partition_repo.drop_partitions_before(
+        before=dt.datetime(2022, 2, 10),
+    )
+
+    assert dropped == ["tvl_history_p202112", "tvl_history_p202201"]
+
+
+@pytest.mark.asyncio
+async def test_drop_partitions_before_of_given_tables(mocker: MockerFixture):
+    session = mocker.AsyncMock()
+    session.execute.return_value.scalars = mocker.Mock(
+        return_value=mocker.Mock(all=mocker.Mock(return_value=[]))
+    )
+    partition_repo = PartitionRepo(session)
+
+    await partition_repo.drop_partitions_before(
+        before=dt.datetime(2022, 2, 1),
+        tables=("token_price",),
+    )
+
+    _, params = session.execute.await_args_list[1].args
+    assert params == {"tables": ["token_price"]}
+
+
+@pytest.mark.asyncio
+async def test_drop_partitions_before_takes_utc_month(mocker: MockerFixture):
+    partition_repo = PartitionRepo(mocker.AsyncMock())
+    mocker.patch.object(
+        partition_repo,
+        "_get_partitioned_tables",
+        return_value=["tvl_history"],
+    )
+    mocker.patch.object(
+        partition_repo,
+        "_get_partitions",
+        return_value=["tvl_history_p202201"],
+    )
+
+    # 2022-02-01 in UTC+3 is still January in UTC
+    dropped = await partition_repo.drop_partitions_before(
+        before=dt.datetime(
+            2022, 2, 1, 1,
+            tzinfo=dt.timezone(dt.timedelta(hours=3)),
+        ),
+    )
+
+    assert dropped == []
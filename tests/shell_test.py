@@ -1,9 +1,21 @@
+import asyncio
 import datetime as dt
+import json
 import pytest
 
 from freezegun import freeze_time
+from pydantic import ValidationError
 
+from core.main import main
+from core.service import protocol_price_cache
+from core.shell.handler import _ProtocolGeneratorShellHandler
+from core.shell.model import CalculateTVLHistoryCommandOptions
+from core.shell.model import DropHistoryBeforeCommandOptions
 from core.shell.model import GenerateProtocolDataCommandOptions
+from core.shell.model import GetDepositAtCommandOptions
+from core.shell.model import GetTVLHistoryCommandOptions
+from core.shell.model import ImportProtocolDataCommandOptions
+from core.stats import stats
 
 
 @freeze_time("2022-01-01")
@@ -46,3 +58,230 @@ async def test_generate_protocol_data_command_options_parse(
 ):
     opts = GenerateProtocolDataCommandOptions.parse_args(test_input)
     assert opts == expected
+
+
+@pytest.mark.parametrize(
+    "test_input, expected",
+    [
+        (
+            "--protocol 1",
+            CalculateTVLHistoryCommandOptions(protocol=1, mode="incremental"),
+        ),
+        (
+            "--protocol 1 --mode full",
+            CalculateTVLHistoryCommandOptions(protocol=1, mode="full"),
+        ),
+    ]
+)
+def test_calculate_tvl_history_command_options_parse(
+    test_input: str,
+    expected: CalculateTVLHistoryCommandOptions,
+):
+    opts = CalculateTVLHistoryCommandOptions.parse_args(test_input)
+    assert opts == expected
+
+
+def test_calculate_tvl_history_command_options_invalid_mode():
+    with pytest.raises(ValidationError):
+        CalculateTVLHistoryCommandOptions.parse_args("--protocol 1 --mode x")
+
+
+def test_get_tvl_history_command_options_parse():
+    opts = GetTVLHistoryCommandOptions.parse_args(
+        "--protocol 1 --start 2022-01-01 --end 2022-01-02T15:00+03:00"
+    )
+    assert opts == GetTVLHistoryCommandOptions(
+        protocol=1,
+        start=dt.datetime(2022, 1, 1, tzinfo=dt.timezone.utc),
+        end=dt.datetime(2022, 1, 2, 12, tzinfo=dt.timezone.utc),
+        resolution="day",
+    )
+    assert opts.start.tzinfo is dt.timezone.utc
+
+    with pytest.raises(ValidationError):
+        GetTVLHistoryCommandOptions.parse_args(
+            "--protocol 1 --start 2022-01-02 --end 2022-01-01"
+        )
+    with pytest.raises(ValidationError):
+        GetTVLHistoryCommandOptions.parse_args(
+            "--protocol 1 --start 2022-01-01 --end 2022-01-02 "
+            "--resolution week"
+        )
+
+
+def test_drop_history_before_date_is_utc():
+    opts = DropHistoryBeforeCommandOptions.parse_args(
+        "--before 2022-02-01T01:00+03:00"
+    )
+    assert opts.before == dt.datetime(
+        2022, 1, 31, 22,
+        tzinfo=dt.timezone.utc,
+    )
+    opts = DropHistoryBeforeCommandOptions.parse_args("--before 2022-02-01")
+    assert opts.before == dt.datetime(2022, 2, 1, tzinfo=dt.timezone.utc)
+
+
+def test_stats_are_merged_and_dumped_after_command(tmp_path):
+    handler = _ProtocolGeneratorShellHandler()
+    handler.stats_dump_path = str(tmp_path / "stats.jsonl")
+
+    line = handler.precmd("generate_protocol_data")
+    with stats.phase("generate") as phase:
+        phase.rows += 10
+    stats.record_statement("SELECT\n  1", 0.5)
+    handler.postcmd(False, line)
+
+    assert handler.session_stats.phases["generate"].rows == 10
+    assert handler.session_stats.statements["SELECT 1"].seconds == 0.5
+    dumped = json.loads((tmp_path / "stats.jsonl").read_text())
+    assert dumped["command"] == "generate_protocol_data"
+    assert dumped["phases"]["generate"]["calls"] == 1
+
+
+def test_run_once_returns_exit_status(mocker):
+    handler = _ProtocolGeneratorShellHandler()
+    handler.stats_dump_path = None
+    mocker.patch.object(handler, "preloop")
+    postloop = mocker.patch.object(handler, "postloop")
+
+    assert handler.run_once("unknown --protocol 1") == 2
+    postloop.assert_not_called()
+
+    # options fail validation, so the command fails before touching the db
+    assert handler.run_once("get_current_deposit --protocol x") == 1
+    postloop.assert_called_once()
+
+    # `run` is mocked, so the handler coroutine would never be awaited
+    mocker.patch.object(
+        handler,
+        "_drop_history_before",
+        new=mocker.MagicMock(),
+    )
+    mocker.patch.object(handler, "run", return_value=[])
+    assert handler.run_once("drop_history_before --before 2022-01-01") == 0
+
+
+def test_account_pool_is_not_exported():
+    with pytest.raises(ValidationError, match="account pool"):
+        GenerateProtocolDataCommandOptions.parse_args(
+            "--account_pool true --output exports"
+        )
+
+
+def test_get_deposit_at_command_options_parse():
+    opts = GetDepositAtCommandOptions.parse_args("--protocol 1 --block 10")
+    assert (opts.block, opts.at) == (10, None)
+    opts = GetDepositAtCommandOptions.parse_args(
+        "--protocol 1 --at 2022-01-01T12:00"
+    )
+    assert (opts.block, opts.at) == (
+        None,
+        dt.datetime(2022, 1, 1, 12, tzinfo=dt.timezone.utc),
+    )
+
+    for arg in ("--protocol 1", "--protocol 1 --block 1 --at 2022-01-01"):
+        with pytest.raises(ValidationError):
+            GetDepositAtCommandOptions.parse_args(arg)
+
+
+def test_main_keeps_quoted_arguments(mocker):
+    run_once = mocker.patch(
+        "core.main.protocol_generator_shell_handler.run_once",
+        return_value=0,
+    )
+
+    assert main(["import_protocol_data", "--path", "my exports/p1"]) == 0
+    line = run_once.call_args.args[0]
+    opts = ImportProtocolDataCommandOptions.parse_args(
+        line.split(" ", 1)[1]
+    )
+    assert opts.path == "my exports/p1"
+
+
+def test_generate_protocols_reports_failed_protocols(mocker, capsys):
+    handler = _ProtocolGeneratorShellHandler()
+    handler.stats_dump_path = None
+    mocker.patch.object(handler, "preloop")
+    mocker.patch.object(handler, "postloop")
+    mocker.patch("core.shell.handler.ProcessPoolExecutor")
+    mocker.patch("core.shell.handler.ensure_db")
+
+    async def generate_protocol_data(opts, executor, seed, output):
+        if seed == 11:
+            raise ValueError("duplicate token name")
+        return seed * 10, 100, seed
+
+    mocker.patch.object(
+        handler,
+        "_generate_protocol_data",
+        side_effect=generate_protocol_data,
+    )
+    handler.loop = asyncio.new_event_loop()
+    try:
+        status = handler.run_once("generate_protocols --count 3 --seed 10")
+    finally:
+        handler.loop.close()
+
+    assert status == 1
+    output = capsys.readouterr().out
+    assert "protocol_id=100, rows=100, seed=10" in output
+    assert "protocol 1 failed: ValueError('duplicate token name')" in output
+    assert "protocol_id=120, rows=100, seed=12" in output
+    assert "protocols=2, rows=200" in output
+    assert "1 of 3 protocols failed" in output
+
+
+def test_generate_protocol_data_dates_are_utc():
+    opts = GenerateProtocolDataCommandOptions.parse_args(
+        "--start 2022-01-01T03:00+03:00 --end 2022-01-02"
+    )
+
+    assert opts.start == dt.datetime(2022, 1, 1, tzinfo=dt.timezone.utc)
+    assert opts.end == dt.datetime(2022, 1, 2, tzinfo=dt.timezone.utc)
+    assert opts.start.tzinfo is dt.timezone.utc
+
+
+@pytest.mark.asyncio
+async def test_file_export_does_not_use_database(mocker):
+    handler = _ProtocolGeneratorShellHandler()
+    into_db = mocker.patch.object(handler, "_generate_protocol_data_into_db")
+    run_generator = mocker.patch.object(
+        handler,
+        "_run_generator",
+        return_value=(1, 10, 7),
+    )
+    opts = GenerateProtocolDataCommandOptions.parse_args(
+        "--accounts 5 --output exports"
+    )
+
+    assert await handler._generate_protocol_data(opts) == (1, 10, 7)
+    into_db.assert_not_called()
+    assert run_generator.await_args.args[1].directory == "exports"
+
+
+def test_protocol_price_is_invalidated_after_commit(mocker):
+    handler = _ProtocolGeneratorShellHandler()
+    mocker.patch("core.db.ensure_db")
+    session_factory = mocker.patch("core.db.async_session_factory")
+    session = session_factory.return_value.__aenter__.return_value
+    mocker.patch(
+        "core.service.tvl.TVLHistoryService.calculate_history",
+        return_value=10,
+    )
+    protocol_price_cache._put(1, 100)
+
+    cached_at_commit = []
+
+    async def commit():
+        cached_at_commit.append(1 in protocol_price_cache.entries)
+
+    session.commit = mocker.AsyncMock(side_effect=commit)
+    handler.loop = asyncio.new_event_loop()
+    try:
+        handler.do_calculate_tvl_history("--protocol 1")
+    finally:
+        handler.loop.close()
+
+    # a read before the commit gets the old price, so it is kept until then
+    assert cached_at_commit == [True]
+    assert 1 not in protocol_price_cache.entries
@@ -0,0 +1,327 @@
+import datetime as dt
+import numpy as np
+import pytest
+import tracemalloc
+
+from pytest_mock import MockerFixture
+
+from core.db.repo import BulkRepo
+from core.db.repo import PartitionRepo
+from core.db.repo import ProtocolTokenRepo
+from core.db.repo import TVLHistoryRepo
+from core.service import DatabaseSink
+from core.service import FileSink
+from core.service import ProtocolDataGeneratorService
+from core.service import ProtocolDataImportService
+from core.service.engine import TokenPriceFrame
+from core.shell.model import GenerateProtocolDataCommandOptions
+from core.shell.model import ImportProtocolDataCommandOptions
+
+
+async def _export(directory: str, file_format: str) -> int:
+    service = ProtocolDataGeneratorService(
+        sink=FileSink(directory, file_format, row_group_size=100),
+        seed=1,
+    )
+    await service.generate_all(GenerateProtocolDataCommandOptions(
+        accounts=30,
+        start=dt.datetime(2022, 1, 1),
+        end=dt.datetime(2022, 1, 2),
+        chunk=100,
+    ))
+    return service.rows_written
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("file_format", ["parquet", "csv"])
+async def test_export_and_import(
+    tmp_path,
+    mocker: MockerFixture,
+    file_format: str,
+):
+    rows_written = await _export(str(tmp_path), file_format)
+    assert (tmp_path / f"account_balance_history.{file_format}").exists()
+
+    db_session = mocker.AsyncMock()
+    # a sync method of the session
+    db_session.add_all = mocker.MagicMock()
+    bulk_repo = BulkRepo(db_session)
+    copied = {}
+
+    async def reserve_ids(table_name: str, number: int) -> np.ndarray:
+        first = 1000 * (len(copied) + 1)
+        return np.arange(first, first + number)
+
+    async def copy_records(table_name, columns, records):
+        copied.setdefault(table_name, []).extend(
+            dict(zip(columns, record)) for record in records
+        )
+
+    mocker.patch.object(bulk_repo, "reserve_ids", side_effect=reserve_ids)
+    mocker.patch.object(bulk_repo, "copy_records", side_effect=copy_records)
+    tvl_history_repo = TVLHistoryRepo(db_session)
+    update_watermark = mocker.patch.object(
+        tvl_history_repo,
+        "update_watermark",
+    )
+    service = ProtocolDataImportService(
+        bulk_repo=bulk_repo,
+        tvl_history_repo=tvl_history_repo,
+        partition_repo=PartitionRepo(db_session),
+        protocol_token_repo=ProtocolTokenRepo(db_session),
+    )
+    mocker.patch.object(service.partition_repo, "ensure_partitions")
+    get_existing_names = mocker.patch.object(
+        service.protocol_token_repo,
+        "get_existing_names",
+        return_value=[],
+    )
+
+    protocol_id = await service.import_all(
+        ImportProtocolDataCommandOptions(path=str(tmp_path), chunk=64)
+    )
+
+    assert protocol_id == 1000
+    # exported TVL history is imported instead of being calculated again
+    update_watermark.assert_awaited_once_with(
+        1000,
+        24,
+        dt.datetime(2022, 1, 2, tzinfo=dt.timezone.utc),
+        from_created_at=dt.datetime(2022, 1, 1, tzinfo=dt.timezone.utc),
+    )
+    assert sum(
+        len(copied[table])
+        for table in ("account_balance_history", "token_price", "tvl_history")
+    ) == rows_written
+
+    token_ids = {row["id"] for row in copied["token"]}
+    protocol_token_ids = {row["id"] for row in copied["protocol_token"]}
+    account_ids = {row["id"] for row in copied["account"]}
+    assert len(account_ids) == 30
+    assert {row["protocol_id"] for row in copied["protocol_token"]} == {1000}
+    assert {
+        row["protocol_token_id"] for row in copied["account_balance_history"]
+    } <= protocol_token_ids
+    assert {
+        row["account_id"] for row in copied["account_balance_history"]
+    } == account_ids
+    assert {row["token_id"] for row in copied["token_price"]} == token_ids
+    assert {
+        row["protocol_token_id"] for row in copied["tvl_history"]
+    } <= protocol_token_ids
+    assert {
+        row["created_at"].tzinfo is not None for row in copied["token_price"]
+    } == {True}
+
+    names = get_existing_names.await_args.kwargs
+    assert names["protocol_name"] == copied["protocol"][0]["name"]
+    assert names["token_names"] == [row["name"] for row in copied["token"]]
+    # an import into a database which holds the protocol fails up front
+    get_existing_names.return_value = [
+        f"protocol {names['protocol_name']}",
+    ]
+    copy_records_calls = bulk_repo.copy_records.await_count
+    with pytest.raises(ValueError, match="already imported"):
+        await service.import_all(
+            ImportProtocolDataCommandOptions(path=str(tmp_path), chunk=64)
+        )
+    assert bulk_repo.copy_records.await_count == copy_records_calls
+
+
+@pytest.mark.asyncio
+async def test_staged_load_merges_and_analyzes_on_close(
+    mocker: MockerFixture,
+):
+    bulk_repo = mocker.AsyncMock(spec=BulkRepo)
+    bulk_repo.drop_secondary_indexes.return_value = ["index"]
+    sink = DatabaseSink(
+        base_repo=mocker.AsyncMock(),
+        bulk_repo=bulk_repo,
+        protocol_token_repo=mocker.AsyncMock(),
+        tvl_history_repo=mocker.AsyncMock(),
+        partition_repo=mocker.AsyncMock(),
+        load="staged",
+        rebuild_indexes=True,
+    )
+    frame = TokenPriceFrame(
+        token_id=np.array([1]),
+        usd_price=np.array([1.0]),
+        created_at=np.array([dt.datetime(2022, 1, 1)], dtype=object),
+    )
+
+    await sink.write_frame(frame)
+    await sink.write_frame(frame)
+    staging_table_name = f"staging_token_price_{sink.staging_suffix}"
+    bulk_repo.create_staging_table.assert_awaited_once_with(
+        table_name="token_price",
+        staging_table_name=staging_table_name,
+        columns=frame.columns,
+    )
+    assert {
+        call.kwargs["table_name"]
+        for call in bulk_repo.copy_records.await_args_list
+    } == {staging_table_name}
+
+    await sink.close(protocol_id=1)
+    bulk_repo.merge_staging_table.assert_awaited_once_with(
+        table_name="token_price",
+        staging_table_name=staging_table_name,
+        columns=frame.columns,
+    )
+    bulk_repo.create_indexes.assert_awaited_once_with(["index"])
+    bulk_repo.analyze.assert_awaited_once_with("token_price")
+    sink.tvl_history_repo.calculate_history_by_protocol_id.assert_awaited()
+
+
+@pytest.mark.asyncio
+async def test_database_sink_assigns_reserved_ids(
+    protocol_data_generator_service: ProtocolDataGeneratorService,
+    mocker: MockerFixture,
+):
+    sink = protocol_data_generator_service.sink
+    first_ids = {"protocol": 10, "token": 20, "protocol_token": 30}
+
+    async def reserve_ids(table_name: str, number: int) -> list[int]:
+        first = first_ids.setdefault(table_name, 40)
+        return list(range(first + number - 1, first - 1, -1))
+
+    mocker.patch.object(sink.bulk_repo, "reserve_ids", side_effect=reserve_ids)
+    copy_records = mocker.patch.object(sink.bulk_repo, "copy_records")
+    mocker.patch.object(
+        sink.protocol_token_repo,
+        "get_existing_names",
+        return_value=[],
+    )
+
+    protocol = (
+        await protocol_data_generator_service.generate_protocol_with_tokens()
+    )
+    await sink.write_protocol(protocol)
+    account_ids = await sink.write_accounts(
+        await protocol_data_generator_service.generate_accounts(3)
+    )
+
+    tokens_number = len(protocol.tokens)
+    assert protocol.id == 10
+    assert [token.id for token in protocol.tokens] == list(
+        range(20, 20 + tokens_number)
+    )
+    protocol_token_ids, token_ids = await sink.get_protocol_tokens(protocol)
+    assert protocol_token_ids.tolist() == list(range(30, 30 + tokens_number))
+    assert token_ids.tolist() == [token.id for token in protocol.tokens]
+    assert sorted(account_ids.tolist()) == [40, 41, 42]
+
+    copied = {
+        call.kwargs["table_name"]: [
+            dict(zip(call.kwargs["columns"], record))
+            for record in call.kwargs["records"]
+        ]
+        for call in copy_records.await_args_list
+    }
+    assert list(copied) == ["protocol", "token", "protocol_token", "account"]
+    assert {row["protocol_id"] for row in copied["protocol_token"]} == {10}
+    # no rows are written through the ORM
+    sink.base_repo.session.flush.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_database_sink_rejects_taken_names(
+    protocol_data_generator_service: ProtocolDataGeneratorService,
+    mocker: MockerFixture,
+):
+    sink = protocol_data_generator_service.sink
+    mocker.patch.object(
+        sink.protocol_token_repo,
+        "get_existing_names",
+        return_value=["protocol abcde"],
+    )
+    reserve_ids = mocker.patch.object(sink.bulk_repo, "reserve_ids")
+
+    protocol = (
+        await protocol_data_generator_service.generate_protocol_with_tokens()
+    )
+    with pytest.raises(ValueError, match="protocol abcde already exist"):
+        await sink.write_protocol(protocol)
+    reserve_ids.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_database_sink_samples_accounts_from_pool(
+    protocol_data_generator_service: ProtocolDataGeneratorService,
+    mocker: MockerFixture,
+):
+    sink = protocol_data_generator_service.sink
+    sink.account_repo = mocker.AsyncMock()
+    # every other id of the range is missing
+    sink.account_repo.get_id_range.return_value = (1, 39)
+    sink.account_repo.count_up_to.side_effect = (
+        lambda limit, max_id: min(limit, 20)
+    )
+    sink.account_repo.get_existing_ids.side_effect = (
+        lambda ids: {account_id for account_id in ids if account_id % 2}
+    )
+
+    samples = [
+        await sink.sample_accounts(8, np.random.default_rng(1), max_id=39)
+        for _ in range(2)
+    ]
+
+    account_ids, max_id = samples[0]
+    assert max_id == 39
+    assert len(set(account_ids.tolist())) == 8
+    assert all(account_id % 2 for account_id in account_ids.tolist())
+    assert samples[1][0].tolist() == account_ids.tolist()
+    sink.account_repo.get_id_range.assert_awaited_with(39)
+    sink.account_repo.count_up_to.assert_awaited_with(8, 39)
+
+    with pytest.raises(ValueError, match="grow_account_pool"):
+        await sink.sample_accounts(21, np.random.default_rng(1))
+
+
+@pytest.mark.asyncio
+async def test_database_sink_samples_large_pool_in_batches(
+    protocol_data_generator_service: ProtocolDataGeneratorService,
+    mocker: MockerFixture,
+):
+    sink = protocol_data_generator_service.sink
+    sink.account_repo = mocker.AsyncMock()
+    sink.account_repo.get_id_range.return_value = (1, 10 ** 12)
+    sink.account_repo.count_up_to.side_effect = lambda limit, max_id: limit
+    sink.account_repo.get_existing_ids.side_effect = set
+
+    account_ids, _ = await sink.sample_accounts(
+        1000,
+        np.random.default_rng(1),
+    )
+
+    # ids are drawn without a permutation of the whole range
+    assert len(set(account_ids.tolist())) == 1000
+    batch, = sink.account_repo.get_existing_ids.await_args.args
+    assert len(batch) == 1100
+
+
+@pytest.mark.asyncio
+async def test_database_sink_sample_memory_does_not_grow_with_pool(
+    protocol_data_generator_service: ProtocolDataGeneratorService,
+    mocker: MockerFixture,
+):
+    sink = protocol_data_generator_service.sink
+    sink.account_repo = mocker.AsyncMock()
+    sink.account_repo.count_up_to.side_effect = lambda limit, max_id: limit
+    sink.account_repo.get_existing_ids.side_effect = set
+    peaks = []
+    for last_id in (10 ** 6, 4 * 10 ** 6):
+        sink.account_repo.get_id_range.return_value = (1, last_id)
+        tracemalloc.start()
+        try:
+            account_ids, _ = await sink.sample_accounts(
+                100_000,
+                np.random.default_rng(1),
+            )
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+        assert len(set(account_ids.tolist())) == 100_000
+
+    # a permutation of the range would take 32 MB for the larger one
+    assert peaks[1] < peaks[0] * 1.2
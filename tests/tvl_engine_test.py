@@ -0,0 +1,247 @@
+import datetime as dt
+import numpy as np
+
+from collections import defaultdict
+from decimal import Decimal
+
+from core.service.engine import ColumnarGenerationEngine
+from core.service.tvl_engine import ColumnarTVLEngine
+
+
+def _calculate_history_sql(
+    balance_history,
+    token_prices,
+    token_by_protocol_token,
+):
+    """TVL rows as `TVLHistoryRepo.CALCULATE_HISTORY_SQL` calculates them."""
+    balance = defaultdict(lambda: [None, Decimal(0)])
+    for protocol_token_id, _, amount, created_at, block in balance_history:
+        row = balance[protocol_token_id, block]
+        row[0] = created_at if row[0] is None else min(row[0], created_at)
+        row[1] += amount
+
+    rows = set()
+    for (protocol_token_id, block), (created_at, amount) in balance.items():
+        for token_id, usd_price, price_created_at in token_prices:
+            if (
+                token_id == token_by_protocol_token[protocol_token_id]
+                and created_at
+                <= price_created_at
+                <= created_at + dt.timedelta(hours=1)
+            ):
+                rows.add((
+                    protocol_token_id,
+                    block,
+                    amount,
+                    usd_price * amount,
+                    price_created_at,
+                ))
+    return rows
+
+
+def _hour_rollup_sql(tvl_rows):
+    """
+    Last, min and max protocol TVL per hour as
+    `TVLHistoryRepo.REFRESH_HOUR_ROLLUP_SQL` calculates them from TVL rows.
+    """
+    token_ticks = {}
+    # one row per token and tick, the one of the later block
+    for protocol_token_id, _, _, amount_usd, created_at in sorted(
+        tvl_rows,
+        key=lambda row: row[1],
+    ):
+        token_ticks[protocol_token_id, created_at] = amount_usd
+
+    ticks = defaultdict(Decimal)
+    for (_, created_at), amount_usd in token_ticks.items():
+        ticks[created_at] += amount_usd
+    return _hour_buckets(ticks)
+
+
+def _hour_buckets(ticks):
+    buckets = defaultdict(list)
+    for created_at in sorted(ticks):
+        hour = created_at.replace(minute=0, second=0, microsecond=0)
+        buckets[hour].append(ticks[created_at])
+    return {
+        hour: (amounts[-1], min(amounts), max(amounts))
+        for hour, amounts in buckets.items()
+    }
+
+
+def test_tvl_engine_matches_sql():
+    engine = ColumnarGenerationEngine(0)
+    start, end = dt.datetime(2022, 1, 1), dt.datetime(2022, 1, 2)
+    protocol_token_ids = np.array([21, 23, 22, 24])
+    token_ids = np.array([1, 3, 2, 4])
+
+    balance_history = list(engine.iter_balance_history(
+        protocol_token_ids=protocol_token_ids,
+        account_ids=np.arange(100, 160),
+        tokens_per_account=2,
+        final_token_amount=100,
+        start=start,
+        end=end,
+        chunk_size=40,
+    ))
+    token_prices = list(engine.iter_token_prices(
+        token_ids=token_ids,
+        final_token_price=3.5,
+        start=start,
+        end=end,
+        chunk_size=100,
+    ))
+
+    tvl_engine = ColumnarTVLEngine(protocol_token_ids, token_ids, start, end)
+    tvl_frames = [
+        tvl_frame
+        for frame in balance_history + token_prices
+        for tvl_frame in tvl_engine.add_frame(frame)
+    ]
+
+    actual = [record for frame in tvl_frames for record in frame.records()]
+    expected = _calculate_history_sql(
+        balance_history=[
+            record for frame in balance_history for record in frame.records()
+        ],
+        token_prices=[
+            record for frame in token_prices for record in frame.records()
+        ],
+        token_by_protocol_token=dict(zip(protocol_token_ids, token_ids)),
+    )
+    assert len(actual) == len(set(actual))
+    assert set(actual) == expected
+    assert tvl_engine.watermark() == (24, end)
+
+
+def test_tvl_engine_without_balances():
+    start, end = dt.datetime(2022, 1, 1), dt.datetime(2022, 1, 2)
+    tvl_engine = ColumnarTVLEngine(np.array([21]), np.array([1]), start, end)
+    token_prices = ColumnarGenerationEngine(0).iter_token_prices(
+        token_ids=np.array([1]),
+        final_token_price=3.5,
+        start=start,
+        end=end,
+        chunk_size=100,
+    )
+
+    for frame in token_prices:
+        assert list(tvl_engine.add_frame(frame)) == []
+    assert tvl_engine.watermark() is None
+
+
+def test_compacted_prices_keep_calculated_tvl():
+    engine = ColumnarGenerationEngine(0)
+    start, end = dt.datetime(2022, 1, 1), dt.datetime(2022, 1, 2)
+    protocol_token_ids, token_ids = np.array([21, 22]), np.array([1, 2])
+    balance_history = [
+        record
+        for frame in engine.iter_balance_history(
+            protocol_token_ids=protocol_token_ids,
+            account_ids=np.arange(100, 120),
+            tokens_per_account=1,
+            final_token_amount=100,
+            start=start,
+            end=end,
+            chunk_size=40,
+        )
+        for record in frame.records()
+    ]
+    token_prices = [
+        record
+        for frame in engine.iter_token_prices(
+            token_ids=token_ids,
+            final_token_price=3.5,
+            start=start,
+            end=end,
+            chunk_size=100,
+        )
+        for record in frame.records()
+    ]
+    # close prices of hours, as `TokenPriceRepo.COMPACT_SQL` keeps them
+    close_prices = {}
+    for token_id, usd_price, created_at in sorted(
+        token_prices,
+        key=lambda record: record[2],
+    ):
+        hour = created_at.replace(minute=0, second=0, microsecond=0)
+        close_prices[token_id, hour] = (token_id, usd_price, created_at)
+    token_by_protocol_token = dict(zip(protocol_token_ids, token_ids))
+
+    raw = _calculate_history_sql(
+        balance_history,
+        token_prices,
+        token_by_protocol_token,
+    )
+    compacted = _calculate_history_sql(
+        balance_history,
+        list(close_prices.values()),
+        token_by_protocol_token,
+    )
+
+    # recalculation upserts rows equal to the calculated ones and deletes
+    # none, so TVL history calculated from raw prices is kept
+    assert compacted
+    assert compacted < raw
+
+
+def test_hour_rollup_sums_one_row_per_token_tick():
+    engine = ColumnarGenerationEngine(0)
+    start, end = dt.datetime(2022, 1, 1), dt.datetime(2022, 1, 2)
+    protocol_token_ids, token_ids = np.array([21, 22]), np.array([1, 2])
+    balance_history = [
+        record
+        for frame in engine.iter_balance_history(
+            protocol_token_ids=protocol_token_ids,
+            account_ids=np.arange(100, 120),
+            tokens_per_account=1,
+            final_token_amount=100,
+            start=start,
+            end=end,
+            chunk_size=40,
+        )
+        for record in frame.records()
+    ]
+    token_prices = [
+        record
+        for frame in engine.iter_token_prices(
+            token_ids=token_ids,
+            final_token_price=3.5,
+            start=start,
+            end=end,
+            chunk_size=100,
+        )
+        for record in frame.records()
+    ]
+    token_by_protocol_token = dict(zip(protocol_token_ids, token_ids))
+    tvl_rows = _calculate_history_sql(
+        balance_history,
+        token_prices,
+        token_by_protocol_token,
+    )
+
+    # TVL of a token at a price tick is its amount of the last block before
+    # the tick, within the hour of the block, at the price of the tick
+    blocks = defaultdict(lambda: [None, Decimal(0)])
+    for protocol_token_id, _, amount, created_at, block in balance_history:
+        row = blocks[protocol_token_id, block]
+        row[0] = created_at if row[0] is None else min(row[0], created_at)
+        row[1] += amount
+    ticks = defaultdict(Decimal)
+    for token_id, usd_price, tick in token_prices:
+        for protocol_token_id in protocol_token_ids:
+            if token_by_protocol_token[protocol_token_id] != token_id:
+                continue
+            amounts = [
+                (block, amount)
+                for (block_token_id, block), (created_at, amount)
+                in blocks.items()
+                if block_token_id == protocol_token_id
+                and created_at <= tick <= created_at + dt.timedelta(hours=1)
+            ]
+            if amounts:
+                ticks[tick] += usd_price * max(amounts)[1]
+
+    # ticks on block boundaries have rows of two blocks
+    assert len({(row[0], row[4]) for row in tvl_rows}) < len(tvl_rows)
+    assert _hour_rollup_sql(tvl_rows) == _hour_buckets(ticks)
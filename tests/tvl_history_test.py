@@ -0,0 +1,160 @@
+import datetime as dt
+import pytest
+
+from pytest_mock import MockerFixture
+
+from core.db.repo import TVLHistoryRepo
+
+
+@pytest.mark.asyncio
+async def test_calculate_history_refreshes_rollups_from_watermark(
+    mocker: MockerFixture,
+):
+    watermark = dt.datetime(2022, 1, 2, 5, tzinfo=dt.timezone.utc)
+    tvl_history_repo = TVLHistoryRepo(mocker.AsyncMock())
+    mocker.patch.object(
+        tvl_history_repo,
+        "get_watermark",
+        return_value=(29, watermark),
+    )
+
+    await tvl_history_repo.calculate_history_by_protocol_id(
+        protocol_id=1,
+        incremental=True,
+    )
+
+    statements = [
+        call.args for call in tvl_history_repo.session.execute.await_args_list
+    ]
+    assert [statement for statement, _ in statements[-2:]] == [
+        TVLHistoryRepo.REFRESH_HOUR_ROLLUP_SQL,
+        TVLHistoryRepo.REFRESH_DAY_ROLLUP_SQL,
+    ]
+    assert statements[-1][1] == {
+        "protocol_id": 1,
+        "from_created_at": watermark,
+    }
+
+
+@pytest.mark.asyncio
+async def test_update_watermark_refreshes_all_rollups(mocker: MockerFixture):
+    tvl_history_repo = TVLHistoryRepo(mocker.AsyncMock())
+
+    await tvl_history_repo.update_watermark(
+        protocol_id=1,
+        created_at_block=24,
+        created_at=dt.datetime(2022, 1, 2, tzinfo=dt.timezone.utc),
+    )
+
+    statements = [
+        call.args for call in tvl_history_repo.session.execute.await_args_list
+    ]
+    assert [statement for statement, _ in statements] == [
+        TVLHistoryRepo.SET_WATERMARK_SQL,
+        TVLHistoryRepo.REFRESH_PROTOCOL_TVL_SQL,
+        TVLHistoryRepo.REFRESH_HOUR_ROLLUP_SQL,
+        TVLHistoryRepo.REFRESH_DAY_ROLLUP_SQL,
+    ]
+    assert statements[-1][1]["from_created_at"] == (
+        TVLHistoryRepo.MIN_CREATED_AT
+    )
+
+
+@pytest.mark.asyncio
+async def test_update_watermark_refreshes_rollups_from_first_row(
+    mocker: MockerFixture,
+):
+    tvl_history_repo = TVLHistoryRepo(mocker.AsyncMock())
+    first_created_at = dt.datetime(2022, 1, 1, tzinfo=dt.timezone.utc)
+
+    await tvl_history_repo.update_watermark(
+        protocol_id=1,
+        created_at_block=24,
+        created_at=dt.datetime(2022, 1, 2, tzinfo=dt.timezone.utc),
+        from_created_at=first_created_at,
+    )
+
+    _, params = tvl_history_repo.session.execute.await_args.args
+    assert params["from_created_at"] == first_created_at
+
+
+@pytest.mark.asyncio
+async def test_get_protocol_price_at_block_or_time(mocker: MockerFixture):
+    tvl_history_repo = TVLHistoryRepo(mocker.AsyncMock())
+    result = tvl_history_repo.session.execute.return_value
+    result.one = mocker.Mock(return_value=mocker.Mock(amount_usd=None))
+    at = dt.datetime(2022, 1, 2, tzinfo=dt.timezone.utc)
+
+    assert await tvl_history_repo.get_protocol_price_at(1, block=5) is None
+    assert await tvl_history_repo.get_protocol_price_at(1, at=at) is None
+
+    statements = [
+        call.args for call in tvl_history_repo.session.execute.await_args_list
+    ]
+    assert statements == [
+        (
+            TVLHistoryRepo.GET_PROTOCOL_PRICE_AT_BLOCK_SQL,
+            {"protocol_id": 1, "block": 5},
+        ),
+        (
+            TVLHistoryRepo.GET_PROTOCOL_PRICE_AT_SQL,
+            {"protocol_id": 1, "at": at},
+        ),
+    ]
+
+
+def _protocol_price_at_sql(rows, block=None, at=None):
+    """
+    Price as `TVLHistoryRepo.GET_PROTOCOL_PRICE_AT_BLOCK_SQL` (`block`) or
+    `GET_PROTOCOL_PRICE_AT_SQL` (`at`) calculates it from TVL history rows.
+    """
+    last = {}
+    for row in rows:
+        protocol_token_id, created_at_block, _, created_at = row
+        if block is not None and created_at_block > block:
+            continue
+        if at is not None and created_at > at:
+            continue
+        order = (
+            (created_at_block, created_at)
+            if block is not None
+            else (created_at, created_at_block)
+        )
+        if protocol_token_id not in last or order > last[protocol_token_id][0]:
+            last[protocol_token_id] = (order, row)
+    if not last:
+        return None
+    _, blocks, amounts, times = zip(*(row for _, row in last.values()))
+    return sum(amounts), max(blocks), max(times)
+
+
+def test_protocol_price_at_takes_last_tick_of_every_token():
+    hour = dt.datetime(2022, 1, 1, tzinfo=dt.timezone.utc)
+    # (protocol_token_id, created_at_block, amount_usd, created_at), every
+    # block has a row per tick of the hour after it, the 1:00 tick is in
+    # the windows of blocks 1 and 2 of token 21, token 22 has no block 2
+    rows = [
+        (21, 1, 10, hour),
+        (21, 1, 11, hour + dt.timedelta(hours=1)),
+        (21, 2, 20, hour + dt.timedelta(hours=1)),
+        (21, 2, 21, hour + dt.timedelta(hours=2)),
+        (22, 1, 5, hour),
+        (22, 1, 6, hour + dt.timedelta(hours=1)),
+    ]
+
+    assert _protocol_price_at_sql(rows, block=2) == (
+        27,
+        2,
+        hour + dt.timedelta(hours=2),
+    )
+    assert _protocol_price_at_sql(rows, block=1) == (
+        17,
+        1,
+        hour + dt.timedelta(hours=1),
+    )
+    assert _protocol_price_at_sql(rows, block=0) is None
+    # the 1:00 tick is taken from the later block
+    at = hour + dt.timedelta(hours=1)
+    assert _protocol_price_at_sql(rows, at=at) == (26, 2, at)
+    at = hour + dt.timedelta(minutes=30)
+    assert _protocol_price_at_sql(rows, at=at) == (15, 1, hour)